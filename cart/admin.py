@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Cart, CartItem
+from .models import Cart, CartItem, StockReservation
 
 # Register your models here.
 
@@ -14,11 +14,25 @@ class CartAdmin(admin.ModelAdmin):
     list_filter = ("created_at",)  # Filter by creation date
     # Prevent modification of calculated total cost
     readonly_fields = ("total_cost",)
+    list_select_related = ("user",)
+
+    def get_queryset(self, request):
+        # The total cost column is annotated in the list query instead of being computed per cart
+        return super().get_queryset(request).with_totals()
 
 
 @admin.register(CartItem)
 class CartItemAdmin(admin.ModelAdmin):
     list_display = ("id", "cart", "product", "quantity", "cost", "created_at")
+    list_select_related = ("cart__user", "product")
     search_fields = ("cart__user__username", "product__name")
     list_filter = ("created_at", "product")
     readonly_fields = ("cost",)
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ("id", "cart", "product", "quantity", "expires_at", "created_at")
+    list_select_related = ("cart__user", "product")
+    search_fields = ("cart__user__username", "product__name")
+    list_filter = ("expires_at",)
@@ -0,0 +1,73 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from products.cache import get_price_versions
+
+
+def _summary_key(cart_id):
+    return f"cart:summary:{cart_id}"
+
+
+def _summary_version_key(cart_id):
+    return f"cart:summary:version:{cart_id}"
+
+
+def _cart_id_key(user_id):
+    return f"cart:id:{user_id}"
+
+
+def get_cached_cart_id(user_id):
+    return cache.get(_cart_id_key(user_id))
+
+
+def set_cached_cart_id(user_id, cart_id):
+    # A cart always belongs to the same user so this never has to be invalidated
+    cache.set(_cart_id_key(user_id), cart_id, timeout=None)
+
+
+def get_cached_summary(cart_id):
+    '''
+    Returns the cached {items, total} summary of the cart (None when it isn't cached or is outdated)
+    and the current version of the cart, with one cache read: (<summary>, <version>)
+
+    A summary is outdated once the cart changed (its version moved) or one of its products changed price.
+    The other products and the stock changes never invalidate it.
+    '''
+    found = cache.get_many([_summary_key(cart_id), _summary_version_key(cart_id)])
+    version = found.get(_summary_version_key(cart_id))
+    cached = found.get(_summary_key(cart_id))
+    if cached is None:
+        return None, version
+    cart_version, price_versions, summary = cached
+    if cart_version != version or get_price_versions(price_versions)[0] != price_versions:
+        return None, version
+    return summary, version
+
+
+def set_cached_summary(cart_id, summary, version, price_versions):
+    '''
+    Caches the summary with the cart version, read before the cart was queried,
+    and the price versions of the cart's products it was computed from
+    '''
+    cache.set(_summary_key(cart_id), (version, price_versions, summary),
+              timeout=getattr(settings, "CART_SUMMARY_TIMEOUT", 300))
+
+
+def invalidate_cart_summary(cart_id):
+    '''
+    Moves the cart to a new version once the current transaction commits.
+
+    A read that queried the cart before the commit stores its summary with the version it read beforehand,
+    which is not the current one anymore, so the data from before the change is never served.
+    '''
+    def bump():
+        try:
+            cache.incr(_summary_version_key(cart_id))
+        except ValueError:
+            # incr raises ValueError when the key does not exist
+            cache.set(_summary_version_key(cart_id), time.time_ns(), timeout=None)
+
+    transaction.on_commit(bump)
@@ -6,3 +6,9 @@ class AddingOwnProductToCartException(APIException):
     status_code = 403
     default_detail = _("Adding your own product to the cart is not allowed.")
     default_code = "add_to_cart_not_allowed"
+
+
+class CartBusyException(APIException):
+    status_code = 409
+    default_detail = _("The cart is being updated, please try again.")
+    default_code = "cart_busy"
@@ -0,0 +1,75 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from cart.models import CartItem
+from cart.views import CartListAPIView
+from products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    '''
+    Measures the cart read (GET /api/cart/) for carts of 1, 50 and 500 items,
+    next to the per item Python loop the cart totals used to run.
+
+    Everything is created inside a transaction that is rolled back, so the command leaves no data behind.
+    Usage: python manage.py benchmark_cart
+    '''
+    help = "Benchmark the cart read for growing cart sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1, 50, 500])
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'items':>6} {'queries':>8} {'cart read ms':>13} {'python loop queries':>20} {'python loop ms':>15}")
+        with transaction.atomic():
+            for size in options["sizes"]:
+                self.benchmark(size, options["repeat"])
+            transaction.set_rollback(True)
+
+    def benchmark(self, size, repeat):
+        seller = User.objects.create_user(
+            email=f"bench-seller-{size}@example.com", username=f"bench-seller-{size}", password="password")
+        buyer = User.objects.create_user(
+            email=f"bench-buyer-{size}@example.com", username=f"bench-buyer-{size}", password="password")
+        category = ProductCategory.objects.create(name="Benchmark")
+        products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="9.99", quantity=100)
+            for i in range(size)
+        ])
+        CartItem.objects.bulk_create([CartItem(cart=buyer.cart, product=product, quantity=2) for product in products])
+
+        view = CartListAPIView.as_view()
+        request = APIRequestFactory().get("/api/cart/")
+        force_authenticate(request, user=buyer)
+
+        def read_cart():
+            view(request).render()
+
+        def python_loop():
+            # What Cart.total_cost and total_cartitems used to do
+            cart = type(buyer.cart).objects.get(user=buyer)
+            round(sum(round(item.quantity * item.product.price, 2) for item in cart.cart_items.all()), 2)
+            sum(item.quantity for item in cart.cart_items.all())
+
+        read_queries, read_ms = self.measure(read_cart, repeat)
+        loop_queries, loop_ms = self.measure(python_loop, repeat)
+        self.stdout.write(f"{size:>6} {read_queries:>8} {read_ms:>13.2f} {loop_queries:>20} {loop_ms:>15.2f}")
+
+    def measure(self, func, repeat):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return len(queries), statistics.median(timings)
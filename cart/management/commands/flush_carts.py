@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cart.store import flush_dirty_carts, is_enabled
+
+
+class Command(BaseCommand):
+    '''
+    Periodic flusher of the carts stored in the cache (CART_STORAGE = "cache"),
+    writes the pending cart changes to the database in batches.
+
+    Usage: python manage.py flush_carts --interval 5
+    '''
+    help = "Write the pending changes of the carts stored in the cache to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0,
+                            help="Seconds between two flushes, the command runs forever when given")
+        parser.add_argument("--batch-size", type=int, default=100, help="Number of carts written per transaction")
+
+    def handle(self, *args, **options):
+        if not is_enabled():
+            raise CommandError('The carts are only flushed when CART_STORAGE is "cache"')
+
+        while True:
+            started = time.monotonic()
+            flushed = flush_dirty_carts(batch_size=options["batch_size"])
+            if flushed or not options["interval"]:
+                self.stdout.write(f"Flushed {flushed} carts in {time.monotonic() - started:.3f}s")
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
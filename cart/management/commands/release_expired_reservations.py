@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cart.reservations import release_expired
+
+
+class Command(BaseCommand):
+    '''
+    Sweeper of the expired stock reservations. The availability checks already ignore the expired holds,
+    the sweeper keeps the reservations table and its indexes small.
+
+    Usage: python manage.py release_expired_reservations --interval 60
+    '''
+    help = "Delete the expired stock reservations in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0,
+                            help="Seconds between two sweeps, the command runs forever when given")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of holds deleted per statement")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            released = release_expired(batch_size=options["batch_size"])
+            if released or not options["interval"]:
+                self.stdout.write(f"Released {released} expired reservations in {time.monotonic() - started:.3f}s")
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
@@ -1,12 +1,43 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.db.models import DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
 from django.utils.functional import cached_property
 from django.contrib.auth import get_user_model
 from products.models import Product
 from django.utils.translation import gettext_lazy as _
+from .cache import invalidate_cart_summary
 
 User = get_user_model()
 
 
+def cart_items_totals(prefix=""):
+    '''
+    Returns the aggregate expressions of the total cost and the number of items of the cart items,
+    computed in the database as SUM(quantity * product.price) and SUM(quantity).
+
+    Args:
+        prefix (str): The lookup path to the cart items, "cart_items__" when aggregating from the carts.
+    '''
+    money = DecimalField(max_digits=12, decimal_places=2)
+    return {
+        "total_cost": Coalesce(
+            Sum(F(f"{prefix}quantity") * F(f"{prefix}product__price"), output_field=money),
+            Value(0), output_field=money),
+        "total_cartitems": Coalesce(Sum(f"{prefix}quantity"), Value(0)),
+    }
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        '''
+        Annotates every cart with its total_cost and total_cartitems in the same query,
+        the annotations take the place of the cached properties of the Cart model.
+        '''
+        return self.annotate(**cart_items_totals("cart_items__"))
+
+
 class Cart(models.Model):
     '''
     This is a cart model that belongs to each users logged in
@@ -17,6 +48,8 @@ class Cart(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartQuerySet.as_manager()
+
     class Meta:
         ordering = ("-created_at",)
         verbose_name = _("Cart")
@@ -27,21 +60,25 @@ class Cart(models.Model):
     # The @cached_property is given because it improves performance:
     # If a method is called multiple times within a single request,
     # the computed result is stored and reused, rather than recalculating it each time.
-    # Without @cached_property, every time cart.total_cost is accessed, Django would query the database and iterate through the cart_items again.
+    # Carts loaded with Cart.objects.with_totals() already have these values annotated and never run these queries.
     @cached_property
     def total_cost(self):
         '''
         Returns the total cost of the cart items in the cart.
         '''
-        # This takes the sum and rounds of the decimal point value upto 2 decimal places
-        return round(sum(item.cost for item in self.cart_items.all()), 2)
+        return self.totals["total_cost"]
 
     @cached_property
     def total_cartitems(self):
         '''
         Returns the total items in the cart
         '''
-        return sum(item.quantity for item in self.cart_items.all())
+        return self.totals["total_cartitems"]
+
+    @cached_property
+    def totals(self):
+        # A single aggregate query in the database instead of loading every item and its product
+        return self.cart_items.aggregate(**cart_items_totals())
 
 
 class CartItem(models.Model):
@@ -73,3 +110,43 @@ class CartItem(models.Model):
         This function is used to calculate the total cost of this cart item
         '''
         return round(self.quantity * self.product.price, 2)
+
+
+@receiver([post_save, post_delete], sender=CartItem)
+def invalidate_cart_item_summary(sender, instance, **kwargs):
+    # The statements that write the cart items directly (batch changes, cart store flushes) invalidate it themselves
+    invalidate_cart_summary(instance.cart_id)
+
+
+class StockReservation(models.Model):
+    '''
+    A time-limited hold on the stock of a product for the cart it was added to.
+
+    The held quantity is not available to the other carts until the hold expires, the product is ordered and paid
+    or it is removed from the cart. Expired holds are ignored by the availability checks and deleted by the
+    release_expired_reservations command.
+    '''
+    cart = models.ForeignKey(
+        Cart, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Stock Reservation")
+        verbose_name_plural = _("Stock Reservations")
+        constraints = [
+            models.UniqueConstraint(fields=("cart", "product"), name="unique_cart_product_reservation"),
+        ]
+        indexes = [
+            # The sweeper deletes the oldest expired holds first
+            models.Index(fields=("expires_at",), name="reservation_expires_idx"),
+            # The availability checks sum the live holds of the products
+            models.Index(fields=("product", "expires_at"), name="reservation_product_exp_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product.name} held until {self.expires_at}"
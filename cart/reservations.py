@@ -0,0 +1,140 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Now
+from django.utils.translation import gettext_lazy as _
+from rest_framework import serializers
+
+from products.models import Product
+from .models import StockReservation
+
+
+def reserved_quantity(product_ref="pk", exclude_cart=None):
+    '''
+    Returns a subquery expression of the quantity held by the live (not expired) reservations of a product.
+
+    Args:
+        product_ref (str): The lookup of the product id in the outer query.
+        exclude_cart (Cart | int | OuterRef): Leaves out the holds of this cart, a cart never competes with its own holds.
+    '''
+    holds = StockReservation.objects.filter(product=OuterRef(product_ref), expires_at__gt=Now())
+    if exclude_cart is not None:
+        holds = holds.exclude(cart=exclude_cart)
+    total = holds.order_by().values("product").annotate(total=Sum("quantity")).values("total")
+    return Coalesce(Subquery(total, output_field=IntegerField()), Value(0))
+
+
+def with_available_stock(queryset, exclude_cart=None, product_ref="pk", quantity_field="quantity"):
+    '''
+    Annotates available_quantity, the stock minus the live holds of the other carts, in the same query
+    '''
+    return queryset.annotate(
+        available_quantity=F(quantity_field) - reserved_quantity(product_ref, exclude_cart))
+
+
+def get_available_stock(product_ids, cart=None, lock=False):
+    '''
+    Returns the reserved-aware stock of the products in one query: {<product_id>: <available quantity>}
+
+    Args:
+        lock (bool): Locks the product rows (in id order, so concurrent callers can't deadlock) until the end of
+                     the transaction, so that the stock can't be reserved by another cart before the caller holds it.
+    '''
+    queryset = with_available_stock(Product.objects.filter(id__in=product_ids).order_by("pk"), exclude_cart=cart)
+    if lock:
+        queryset = queryset.select_for_update(of=("self",))
+    return dict(queryset.values_list("id", "available_quantity"))
+
+
+def hold_stock(cart, quantities, ttl=None):
+    '''
+    Creates or refreshes the holds of the cart on the products for STOCK_RESERVATION_TTL seconds,
+    with one INSERT ... ON CONFLICT. The availability must have been checked by the caller.
+
+    Args:
+        quantities (dict): {<product_id>: <quantity held>}
+    '''
+    if not quantities:
+        return
+
+    cart_id = getattr(cart, "pk", cart)
+    ttl = ttl if ttl is not None else getattr(settings, "STOCK_RESERVATION_TTL", 900)
+    table = connection.ops.quote_name(StockReservation._meta.db_table)
+    params = []
+    for product_id in sorted(quantities):
+        params += [cart_id, product_id, quantities[product_id]]
+
+    with connection.cursor() as cursor:
+        # The expiry is computed by the database so it compares with the Now() of the availability checks
+        cursor.execute(f"""
+            INSERT INTO {table} (cart_id, product_id, quantity, expires_at, created_at)
+            SELECT v.cart_id, v.product_id, v.quantity, now() + %s * interval '1 second', now()
+            FROM (VALUES {", ".join(["(%s, %s, %s)"] * len(quantities))}) AS v (cart_id, product_id, quantity)
+            ON CONFLICT (cart_id, product_id)
+            DO UPDATE SET quantity = EXCLUDED.quantity, expires_at = EXCLUDED.expires_at
+        """, [ttl] + params)
+
+
+def check_stock(cart, quantities, lock=False):
+    '''
+    Checks the reserved-aware stock of the products with one query.
+
+    Args:
+        quantities (dict): {<product_id>: <quantity wanted by the cart>}
+        lock (bool): See get_available_stock().
+
+    Raises:
+        ValidationError: When another cart holds the stock or there isn't enough of it.
+    '''
+    available = get_available_stock(list(quantities), cart=cart, lock=lock)
+    insufficient = [str(product_id) for product_id, quantity in quantities.items()
+                    if quantity > available.get(product_id, 0)]
+    if insufficient:
+        raise serializers.ValidationError({
+            "quantity": _("Requested quantity exceeds available stock."),
+            "products": insufficient,
+        })
+
+
+def reserve_stock(cart, quantities):
+    '''
+    Checks the reserved-aware stock of the products and holds the quantities for the cart.
+    Must be called inside a transaction, the product rows stay locked until it ends.
+    '''
+    check_stock(cart, quantities, lock=True)
+    hold_stock(cart, quantities)
+
+
+def release_stock(cart, product_ids=None):
+    '''
+    Deletes the holds of the cart, on the given products only when product_ids is given
+    '''
+    holds = StockReservation.objects.filter(cart=cart)
+    if product_ids is not None:
+        holds = holds.filter(product_id__in=product_ids)
+    return holds.delete()[0]
+
+
+def release_expired(batch_size=1000):
+    '''
+    Deletes the expired holds in batches of batch_size rows, oldest first, walking the expires_at index.
+
+    Every batch is its own statement so the sweeper never holds many row locks, and rows locked by a
+    refreshing cart are skipped instead of waited for (they are no longer expired once it commits).
+
+    Returns:
+        int: The number of deleted holds.
+    '''
+    table = connection.ops.quote_name(StockReservation._meta.db_table)
+    released = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {table} WHERE expires_at <= now()
+                    ORDER BY expires_at LIMIT %s FOR UPDATE SKIP LOCKED
+                )
+            """, [batch_size])
+            released += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return released
@@ -1,6 +1,8 @@
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
+from django.db.models import Prefetch
 from .models import Cart, CartItem
+from .utils import ADD, SET, REMOVE
 from products.models import Product
 
 
@@ -113,3 +115,32 @@ class CartReadSerializer(serializers.ModelSerializer):
         This function return the total cost of the cartItems
         """
         return obj.total_cost
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Annotates the totals in the cart query and loads the items with their products in one more query,
+        so reading a cart takes the same number of queries however many items it holds
+        """
+        return queryset.with_totals().prefetch_related(
+            Prefetch("cart_items", queryset=CartItem.objects.select_related("product")))
+
+
+class CartBatchOperationSerializer(serializers.Serializer):
+    """
+    This serializer validates one operation of a batch cart mutation.
+
+    add: adds the quantity to the product in the cart (or adds the product),
+    set: sets the quantity of the product in the cart (0 removes it),
+    remove: removes the product from the cart.
+    """
+    op = serializers.ChoiceField(choices=(ADD, SET, REMOVE))
+    product = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, validated_data):
+        if validated_data["op"] == ADD and validated_data.get("quantity", 1) < 1:
+            raise serializers.ValidationError({"quantity": _("Must be at least 1 when adding a product.")})
+        if validated_data["op"] == SET and "quantity" not in validated_data:
+            raise serializers.ValidationError({"quantity": _("This field is required.")})
+        return validated_data
@@ -0,0 +1,371 @@
+import logging
+import secrets
+import time
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from products.models import Product
+from .cache import invalidate_cart_summary
+from .exceptions import CartBusyException
+from .models import Cart, CartItem, StockReservation
+
+# Cart storage modes, see the CART_STORAGE setting
+DATABASE_STORAGE = "database"
+CACHE_STORAGE = "cache"
+
+# Redis set of the users whose stored cart has unflushed changes,
+# the other cache backends keep one marker key per user instead
+DIRTY_KEY = "cart:dirty"
+
+logger = logging.getLogger(__name__)
+
+# Seconds before its expiry from which a lock is no longer released by its holder,
+# the cache may already have expired it and handed it to another worker
+LOCK_RELEASE_MARGIN = 1
+
+# Deletes the lock only while it still holds the token of its holder, in one step on the redis server
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def _cart_key(user_id):
+    return f"cart:items:{user_id}"
+
+
+def _lock_key(name):
+    return f"cart:lock:{name}"
+
+
+def _dirty_key(user_id):
+    return f"cart:dirty:{user_id}"
+
+
+def get_cache():
+    return caches[getattr(settings, "CART_CACHE_ALIAS", "default")]
+
+
+def is_enabled():
+    '''
+    Returns True when the carts are stored write-behind in the cache instead of being written to the database on every change
+    '''
+    return getattr(settings, "CART_STORAGE", DATABASE_STORAGE) == CACHE_STORAGE
+
+
+@contextmanager
+def cart_lock(name, blocking=True, timeout=None):
+    '''
+    A lock shared by all the workers using the same cache, built on the atomic cache.add().
+    The lock expires after CART_LOCK_TIMEOUT seconds (or the given timeout) so a crashed worker can't hold it forever.
+
+    Yields:
+        bool: Whether the lock was acquired, only False when blocking is False.
+
+    Raises:
+        CartBusyException: When a blocking lock can't be acquired in time.
+    '''
+    cache = get_cache()
+    # An integer token is stored as is by the redis backend, so the release script can compare it
+    key, token = _lock_key(name), secrets.randbits(63)
+    wait = getattr(settings, "CART_LOCK_TIMEOUT", 10)
+    timeout = timeout or wait
+    deadline = time.monotonic() + wait
+
+    acquired = cache.add(key, token, timeout)
+    while not acquired and blocking:
+        if time.monotonic() > deadline:
+            raise CartBusyException()
+        time.sleep(0.005)
+        acquired = cache.add(key, token, timeout)
+    expires_at = time.monotonic() + timeout
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            _release_lock(cache, key, token, expires_at)
+
+
+def _release_lock(cache, key, token, expires_at):
+    '''
+    Deletes the lock key if it still belongs to this holder.
+
+    Redis compares and deletes in one script. The other cache backends have no compare-and-delete,
+    there the key is only deleted while the lock can't have expired yet: until then nobody else can hold it.
+    '''
+    if isinstance(cache, RedisCache):
+        client = cache._cache.get_client(key, write=True)
+        client.eval(RELEASE_LOCK_SCRIPT, 1, cache.make_and_validate_key(key), token)
+    elif time.monotonic() < expires_at - LOCK_RELEASE_MARGIN:
+        cache.delete(key)
+    else:
+        logger.warning("The cart lock %s was held until its expiry and is left to expire", key)
+
+
+def _load_entry(user_id):
+    '''
+    Returns the stored cart of the user, loading it from the database when it isn't in the cache.
+
+    The entry is a compact dict: {"cart": <cart_id>, "items": {<product_id>: <quantity>}, "version": n, "flushed": n}
+    The entry has unflushed changes when its version is ahead of its flushed version.
+    '''
+    cache = get_cache()
+    entry = cache.get(_cart_key(user_id))
+    if entry is None:
+        rows = list(Cart.objects.filter(user_id=user_id).order_by().values_list(
+            "id", "cart_items__product_id", "cart_items__quantity"))
+        if not rows:
+            raise Cart.DoesNotExist()
+        items = {product_id: quantity for _cart_id, product_id, quantity in rows if product_id is not None}
+        entry = {"cart": rows[0][0], "items": items, "version": 0, "flushed": 0}
+        # add() never overwrites an entry stored meanwhile by a locked writer.
+        # The entries never expire, the changes only live here until they are flushed.
+        if not cache.add(_cart_key(user_id), entry, timeout=None):
+            entry = cache.get(_cart_key(user_id), entry)
+    return entry
+
+
+def _mark_dirty(user_id):
+    '''
+    Records that the user's stored cart has unflushed changes, the caller holds the user's lock.
+    No lock is shared between the users: redis adds the user to a set in one step, the other backends set a marker key.
+    '''
+    cache = get_cache()
+    if isinstance(cache, RedisCache):
+        cache._cache.get_client(DIRTY_KEY, write=True).sadd(cache.make_and_validate_key(DIRTY_KEY), user_id)
+    else:
+        cache.set(_dirty_key(user_id), True, timeout=None)
+
+
+def _clear_dirty(user_ids):
+    '''
+    Forgets the dirty markers of the flushed carts, the caller holds the users' locks
+    '''
+    if not user_ids:
+        return
+    cache = get_cache()
+    if isinstance(cache, RedisCache):
+        cache._cache.get_client(DIRTY_KEY, write=True).srem(cache.make_and_validate_key(DIRTY_KEY), *user_ids)
+    else:
+        cache.delete_many([_dirty_key(user_id) for user_id in user_ids])
+
+
+def _iter_dirty(batch_size):
+    '''
+    Yields the users with a dirty marker in lists of at most batch_size users.
+
+    Redis scans its set incrementally. The other backends can't list their keys,
+    there the markers of all the carts are read batch_size at a time.
+    '''
+    cache = get_cache()
+    if isinstance(cache, RedisCache):
+        client = cache._cache.get_client(DIRTY_KEY)
+        members = (int(member) for member in client.sscan_iter(
+            cache.make_and_validate_key(DIRTY_KEY), count=batch_size))
+        while batch := list(islice(members, batch_size)):
+            yield batch
+        return
+
+    user_ids = Cart.objects.order_by("user_id").values_list("user_id", flat=True).iterator(chunk_size=batch_size)
+    while batch := list(islice(user_ids, batch_size)):
+        markers = cache.get_many([_dirty_key(user_id) for user_id in batch])
+        dirty = [user_id for user_id in batch if _dirty_key(user_id) in markers]
+        if dirty:
+            yield dirty
+
+
+def get_cart_items(user_id):
+    '''
+    Returns the {<product_id>: <quantity>} items of the user's cart, including the unflushed changes
+    '''
+    return dict(_load_entry(user_id)["items"])
+
+
+def get_cart_id(user_id):
+    return _load_entry(user_id)["cart"]
+
+
+def set_quantity(user_id, product_id, quantity):
+    '''
+    Sets the quantity of a product in the stored cart, a quantity of 0 removes it.
+    The change is written to the database by the next flush.
+    '''
+    with cart_lock(user_id):
+        entry = _load_entry(user_id)
+        # The user is marked dirty before the entry changes, so a crash in between
+        # only costs an empty flush and never leaves a changed cart that the flusher doesn't know about.
+        _mark_dirty(user_id)
+        if quantity:
+            entry["items"][product_id] = quantity
+        else:
+            entry["items"].pop(product_id, None)
+        entry["version"] += 1
+        get_cache().set(_cart_key(user_id), entry, timeout=None)
+    invalidate_cart_summary(entry["cart"])
+
+
+def remove_item(user_id, product_id):
+    set_quantity(user_id, product_id, 0)
+
+
+def has_item(user_id, product_id):
+    return product_id in _load_entry(user_id)["items"]
+
+
+def _save_carts(entries):
+    '''
+    Writes the stored carts to the database with one DELETE and one INSERT ... ON CONFLICT for all of them.
+    Writing the full state instead of the individual changes makes a repeated flush harmless.
+
+    Args:
+        entries (list): The stored cart entries.
+    '''
+    keep = Q()
+    for entry in entries:
+        keep |= Q(cart_id=entry["cart"], product_id__in=list(entry["items"]))
+
+    rows = [(entry["cart"], product_id, quantity)
+            for entry in entries for product_id, quantity in sorted(entry["items"].items())]
+
+    with transaction.atomic():
+        cart_ids = [entry["cart"] for entry in entries]
+        CartItem.objects.filter(cart_id__in=cart_ids).exclude(keep).delete()
+        # The stock held for the removed items is released with them
+        StockReservation.objects.filter(cart_id__in=cart_ids).exclude(keep).delete()
+        if not rows:
+            return
+
+        table = connection.ops.quote_name(CartItem._meta.db_table)
+        products = connection.ops.quote_name(Product._meta.db_table)
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            # Products deleted since they were added to the cart are skipped instead of failing the whole batch,
+            # and the rows whose quantity didn't change keep their updated_at (and the cart's ETag)
+            cursor.execute(f"""
+                INSERT INTO {table} (cart_id, product_id, quantity, created_at, updated_at)
+                SELECT v.cart_id, v.product_id, v.quantity, %s, %s
+                FROM (VALUES {", ".join(["(%s, %s, %s)"] * len(rows))}) AS v (cart_id, product_id, quantity)
+                WHERE EXISTS (SELECT 1 FROM {products} p WHERE p.id = v.product_id)
+                ON CONFLICT (cart_id, product_id)
+                DO UPDATE SET quantity = EXCLUDED.quantity, updated_at = EXCLUDED.updated_at
+                WHERE {table}.quantity <> EXCLUDED.quantity
+            """, [now, now] + [value for row in rows for value in row])
+
+
+def _mark_flushed(entries):
+    '''
+    Marks the flushed entries as clean and forgets their dirty markers, the caller holds their locks.
+    An entry changed since it was written keeps its changes pending for the next flush.
+
+    Args:
+        entries (dict): {<user_id>: <entry as written to the database>}
+    '''
+    cache = get_cache()
+    clean = []
+    for user_id, flushed in entries.items():
+        entry = cache.get(_cart_key(user_id))
+        if entry is not None and entry["items"] == flushed["items"]:
+            entry["flushed"] = entry["version"]
+            cache.set(_cart_key(user_id), entry, timeout=None)
+        # An entry dropped meanwhile is loaded again from the committed database
+        if entry is None or entry["version"] == entry["flushed"]:
+            clean.append(user_id)
+    _clear_dirty(clean)
+
+
+def _mark_flushed_on_commit(entries):
+    '''
+    Marks the entries as clean once the transaction that wrote them commits, the cart locks are taken again for it.
+    A cart that is locked meanwhile stays dirty and its next flush writes the same rows again, which is harmless.
+    '''
+    def mark():
+        with ExitStack() as stack:
+            _mark_flushed({user_id: entry for user_id, entry in entries.items()
+                           if stack.enter_context(cart_lock(user_id, blocking=False))})
+
+    transaction.on_commit(mark)
+
+
+def _flush_locked(user_ids):
+    entries = {}
+    for user_id in user_ids:
+        entry = get_cache().get(_cart_key(user_id))
+        if entry is not None and entry["version"] != entry["flushed"]:
+            entries[user_id] = entry
+
+    if entries:
+        _save_carts(list(entries.values()))
+        if connection.in_atomic_block:
+            # The carts are written by the caller's transaction (an order), they are only clean once it commits:
+            # marked clean right away, a rolled back transaction would leave the changes nowhere but in the cache
+            _mark_flushed_on_commit(entries)
+        else:
+            _mark_flushed(entries)
+    # The users without changes (already flushed or evicted) lose their dirty markers as well
+    _clear_dirty([user_id for user_id in user_ids if user_id not in entries])
+    return len(entries)
+
+
+def flush_cart(user_id):
+    '''
+    Writes the unflushed changes of the user's cart to the database before it is read from there.
+    This is a single cache read when the cart has no pending changes.
+    '''
+    if not is_enabled():
+        return False
+
+    entry = get_cache().get(_cart_key(user_id))
+    if entry is None or entry["version"] == entry["flushed"]:
+        return False
+
+    with cart_lock(user_id):
+        return bool(_flush_locked([user_id]))
+
+
+def flush_dirty_carts(batch_size=100):
+    '''
+    Writes the unflushed changes of every stored cart to the database, batch_size carts per transaction.
+    Carts that are being changed while the flusher runs are skipped and flushed on the next run.
+
+    Returns:
+        int: The number of flushed carts.
+    '''
+    flushed = 0
+    # The locks of a batch are held while all its carts are written, a large batch needs more than a cart change
+    timeout = getattr(settings, "CART_FLUSH_LOCK_TIMEOUT", 60)
+
+    for batch in _iter_dirty(batch_size):
+        with ExitStack() as stack:
+            locked = [user_id for user_id in batch
+                      if stack.enter_context(cart_lock(user_id, blocking=False, timeout=timeout))]
+            if locked:
+                flushed += _flush_locked(locked)
+    return flushed
+
+
+@contextmanager
+def write_through(user_id):
+    '''
+    Locks the user's stored cart while the database is changed directly (adding a product, a batch of changes).
+    The pending changes are flushed before and the entry is reloaded from the database afterwards.
+    '''
+    if not is_enabled():
+        yield
+        return
+
+    with cart_lock(user_id):
+        _flush_locked([user_id])
+        try:
+            yield
+        finally:
+            get_cache().delete(_cart_key(user_id))
@@ -1,3 +1,481 @@
-from django.test import TestCase
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from products.models import Product, ProductCategory
+from products.utils import bulk_update_products
+from orders.models import OrderItem
+from users.exceptions import InternalServerErrorException
+from . import store
+from .cache import get_cached_summary, invalidate_cart_summary, set_cached_summary
+from .models import Cart, CartItem, StockReservation
+from .reservations import get_available_stock, release_expired
+
+User = get_user_model()
+
+
+class CartTestCase(TestCase):
+    '''
+    Base test case with a buyer whose cart holds one product of another seller
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.buyer = User.objects.create_user(
+            email="buyer@example.com", username="buyer", password="password")
+        cls.category = ProductCategory.objects.create(name="Audio")
+        cls.product = Product.objects.create(seller=cls.seller, category=cls.category, name="Speaker",
+                                             desc="desc", price="60.00", quantity=10)
+        cls.item = CartItem.objects.create(cart=cls.buyer.cart, product=cls.product, quantity=2)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+
+class CartConditionalGetTests(CartTestCase):
+    '''
+    Tests for the ETag and If-None-Match support of the cart read
+    '''
+
+    def get_etag(self):
+        return self.client.get("/api/cart/")["ETag"]
+
+    def test_unchanged_cart_returns_not_modified(self):
+        etag = self.get_etag()
+        response = self.client.get("/api/cart/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_item_changes_change_the_etag(self):
+        etag = self.get_etag()
+        self.item.quantity = 3
+        self.item.save()
+        self.assertNotEqual(self.get_etag(), etag)
+
+        etag = self.get_etag()
+        self.item.delete()
+        self.assertNotEqual(self.get_etag(), etag)
+
+    def test_product_price_changes_change_the_etag(self):
+        etag = self.get_etag()
+        self.product.price = "65.00"
+        self.product.save()
+        response = self.client.get("/api/cart/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_is_per_user(self):
+        etag = self.get_etag()
+        self.client.force_authenticate(self.seller)
+        self.assertEqual(self.client.get("/api/cart/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CartTotalsTests(CartTestCase):
+    '''
+    Tests for the cart totals computed in the database
+    '''
+
+    def add_products(self, count):
+        products = Product.objects.bulk_create([
+            Product(seller=self.seller, category=self.category, name=f"Product {i}",
+                    desc="desc", price="1.50", quantity=10)
+            for i in range(count)
+        ])
+        CartItem.objects.bulk_create([
+            CartItem(cart=self.buyer.cart, product=product, quantity=2) for product in products
+        ])
+
+    def test_totals(self):
+        self.add_products(3)
+        cart = Cart.objects.with_totals().get(user=self.buyer)
+        self.assertEqual((cart.total_cost, cart.total_cartitems), (Decimal("129.00"), 8))
+
+        cart = Cart.objects.get(user=self.buyer)
+        with self.assertNumQueries(1):
+            self.assertEqual((cart.total_cost, cart.total_cartitems), (Decimal("129.00"), 8))
+
+    def test_empty_cart(self):
+        self.item.delete()
+        cart = Cart.objects.with_totals().get(user=self.buyer)
+        self.assertEqual((cart.total_cost, cart.total_cartitems), (0, 0))
+        self.assertEqual(Cart.objects.get(user=self.buyer).total_cost, 0)
+
+    def test_cart_read_uses_a_fixed_number_of_queries(self):
+        for count in (1, 50):
+            self.add_products(count)
+            # etag aggregate, cart with totals and items with products
+            with self.assertNumQueries(3):
+                response = self.client.get("/api/cart/")
+        self.assertEqual(len(response.data[0]["cart_items"]), 52)
+        self.assertEqual(response.data[0]["total_cost"], Decimal("273.00"))
+
+
+class CartBatchTests(CartTestCase):
+    '''
+    Tests for the batch cart mutation endpoint
+    '''
+    url = "/api/cart/cartItems/batch/"
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = Product.objects.create(seller=cls.seller, category=cls.category, name="Cable",
+                                           desc="desc", price="5.00", quantity=3)
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.buyer.cart).values_list("product_id", "quantity"))
+
+    def test_applies_add_set_and_remove(self):
+        response = self.client.post(self.url, [
+            {"op": "add", "product": self.product.id, "quantity": 3},
+            {"op": "set", "product": self.other.id, "quantity": 2},
+        ], format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {self.product.id: 5, self.other.id: 2})
+        self.assertEqual(response.data["total_cost"], Decimal("310.00"))
+
+        response = self.client.post(self.url, [
+            {"op": "remove", "product": self.product.id},
+            {"op": "set", "product": self.other.id, "quantity": 1},
+        ], format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {self.other.id: 1})
+
+    def test_operations_on_the_same_product_are_folded_in_order(self):
+        response = self.client.post(self.url, [
+            {"op": "remove", "product": self.product.id},
+            {"op": "add", "product": self.product.id, "quantity": 1},
+            {"op": "add", "product": self.product.id, "quantity": 2},
+        ], format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {self.product.id: 3})
+
+    def test_errors_leave_the_cart_unchanged(self):
+        response = self.client.post(self.url, [
+            {"op": "remove", "product": self.product.id},
+            {"op": "add", "product": self.other.id, "quantity": 4},
+        ], format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(self.other.id), response.data["products"])
+
+        response = self.client.post(self.url, [{"op": "add", "product": 999999}], format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.quantities(), {self.product.id: 2})
+
+    def test_adding_own_product_is_forbidden(self):
+        own = Product.objects.create(seller=self.buyer, category=self.category, name="Own",
+                                     desc="desc", price="1.00", quantity=5)
+        response = self.client.post(self.url, [{"op": "add", "product": own.id}], format="json")
+        self.assertEqual(response.status_code, 403)
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        products = Product.objects.bulk_create([
+            Product(seller=self.seller, category=self.category, name=f"Product {i}",
+                    desc="desc", price="1.00", quantity=10)
+            for i in range(50)
+        ])
+        operations = [{"op": "add", "product": product.id, "quantity": 2} for product in products]
+        operations += [{"op": "set", "product": self.other.id, "quantity": 1},
+                       {"op": "remove", "product": self.product.id}]
+
+        # cart, savepoint, locked stock check, removed items select and delete (for their signals), holds delete,
+        # 2 upserts, holds, release, cart with totals and items
+        with self.assertNumQueries(12):
+            response = self.client.post(self.url, operations, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["cart_items"]), 51)
+
+
+CART_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "carts": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": tempfile.mkdtemp()},
+}
+
+
+@override_settings(CART_STORAGE="cache", CART_CACHE_ALIAS="carts", CACHES=CART_CACHES)
+class CartStoreTests(CartTestCase):
+    '''
+    Tests for the write-behind cart storage in a file based cache, which outlives the worker processes like redis would
+    '''
+
+    def setUp(self):
+        super().setUp()
+        caches["carts"].clear()
+        self.url = f"/api/cart/cartItems/{self.item.id}/"
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.buyer.cart).values_list("product_id", "quantity"))
+
+    def restart(self):
+        '''
+        Returns a context with new cache connections, like the ones of a restarted worker after a crash
+        '''
+        return self.settings(CACHES=dict(CART_CACHES))
+
+    def test_changes_are_written_behind(self):
+        self.client.patch(self.url, {"quantity": 4})
+        # The cart item with its product, savepoint, locked reserved-aware stock, hold upsert, release,
+        # the cart item itself is not written
+        with self.assertNumQueries(5):
+            response = self.client.patch(self.url, {"quantity": 5})
+        self.assertEqual(response.data["quantity"], 5)
+        self.assertEqual(self.quantities(), {self.product.id: 2})
+        # The hold follows the new quantity right away
+        self.assertEqual(StockReservation.objects.get(cart=self.buyer.cart).quantity, 5)
+        self.assertEqual(store.get_cart_items(self.buyer.id), {self.product.id: 5})
+        self.assertTrue(caches["carts"].get(f"cart:dirty:{self.buyer.id}"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(store.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {self.product.id: 5})
+        self.assertIsNone(caches["carts"].get(f"cart:dirty:{self.buyer.id}"))
+        self.assertEqual(store.flush_dirty_carts(), 0)
+
+    def test_reads_and_orders_flush_the_cart_first(self):
+        self.client.patch(self.url, {"quantity": 4})
+        response = self.client.get("/api/cart/")
+        self.assertEqual(response.data[0]["cart_items"][0]["quantity"], 4)
+
+        self.client.patch(self.url, {"quantity": 3})
+        self.assertEqual(self.client.post("/api/orders/").status_code, 201)
+        self.assertEqual(OrderItem.objects.get(order__buyer=self.buyer).quantity, 3)
+
+    def test_failed_order_keeps_the_flushed_changes_pending(self):
+        self.client.patch(self.url, {"quantity": 4})
+        with mock.patch("orders.serializers.get_insufficient_products", side_effect=RuntimeError("order failed")):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.client.post("/api/orders/").status_code,
+                                 InternalServerErrorException.status_code)
+        # The flush was rolled back with the order, the stored cart must not be taken as flushed
+        self.assertEqual(self.quantities(), {self.product.id: 2})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(store.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {self.product.id: 4})
+        self.assertEqual(store.flush_dirty_carts(), 0)
+
+    def test_removed_items(self):
+        self.assertEqual(self.client.delete(self.url).status_code, 204)
+        self.assertEqual(self.client.patch(self.url, {"quantity": 1}).status_code, 404)
+        self.assertEqual(self.quantities(), {self.product.id: 2})
+
+        store.flush_cart(self.buyer.id)
+        self.assertEqual(self.quantities(), {})
+
+    def test_pending_changes_survive_a_restart(self):
+        self.client.patch(self.url, {"quantity": 6})
+        with self.restart():
+            self.assertEqual(store.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {self.product.id: 6})
+
+    def test_failed_flush_keeps_the_changes(self):
+        self.client.patch(self.url, {"quantity": 6})
+        with mock.patch("cart.store.CartItem.objects.filter", side_effect=RuntimeError("connection lost")):
+            with self.assertRaises(RuntimeError):
+                store.flush_dirty_carts()
+        self.assertEqual(self.quantities(), {self.product.id: 2})
+
+        with self.restart():
+            self.assertEqual(store.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {self.product.id: 6})
+
+    def test_repeated_flush_after_a_crash_is_harmless(self):
+        self.client.patch(self.url, {"quantity": 6})
+        # The database is written but the worker dies before the cart is marked as flushed
+        with mock.patch("cart.store._mark_flushed", side_effect=RuntimeError("worker killed")):
+            with self.assertRaises(RuntimeError), self.captureOnCommitCallbacks(execute=True):
+                store.flush_dirty_carts()
+        self.assertEqual(self.quantities(), {self.product.id: 6})
+
+        with self.restart():
+            self.assertEqual(store.flush_dirty_carts(), 1)
+        self.assertEqual(self.quantities(), {self.product.id: 6})
+
+    def test_flusher_skips_locked_carts(self):
+        self.client.patch(self.url, {"quantity": 6})
+        with store.cart_lock(self.buyer.id):
+            self.assertEqual(store.flush_dirty_carts(), 0)
+        self.assertEqual(store.flush_dirty_carts(), 1)
+
+    def test_lock_release_keeps_the_lock_of_the_next_holder(self):
+        cache = store.get_cache()
+        with store.cart_lock("test"):
+            self.assertFalse(cache.add("cart:lock:test", 1))
+        self.assertIsNone(cache.get("cart:lock:test"))
+
+        with store.cart_lock("test", timeout=1):
+            # The lock expired during a long flush and another worker took it
+            cache.set("cart:lock:test", 123)
+        self.assertEqual(cache.get("cart:lock:test"), 123)
+
+    def test_direct_writes_reload_the_stored_cart(self):
+        other = Product.objects.create(seller=self.seller, category=self.category, name="Cable",
+                                       desc="desc", price="5.00", quantity=3)
+        self.client.patch(self.url, {"quantity": 7})
+        response = self.client.post("/api/cart/cartItems/", {"product": other.id, "quantity": 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.quantities(), {self.product.id: 7, other.id: 1})
+        self.assertEqual(store.get_cart_items(self.buyer.id), {self.product.id: 7, other.id: 1})
+
+
+class StockReservationTests(CartTestCase):
+    '''
+    Tests for the stock held by the carts
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_buyer = User.objects.create_user(
+            email="other@example.com", username="other", password="password")
+
+    def other_client(self):
+        client = APIClient()
+        client.force_authenticate(self.other_buyer)
+        return client
+
+    def add(self, client, quantity):
+        return client.post("/api/cart/cartItems/batch/", [
+            {"op": "add", "product": self.product.id, "quantity": quantity}], format="json")
+
+    def test_cart_changes_hold_the_stock(self):
+        response = self.client.patch(f"/api/cart/cartItems/{self.item.id}/", {"quantity": 8})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StockReservation.objects.get(cart=self.buyer.cart).quantity, 8)
+        self.assertEqual(get_available_stock([self.product.id]), {self.product.id: 2})
+        # A cart doesn't compete with its own holds
+        self.assertEqual(get_available_stock([self.product.id], cart=self.buyer.cart), {self.product.id: 10})
+
+        self.assertEqual(self.add(self.other_client(), 3).status_code, 400)
+        self.assertEqual(self.add(self.other_client(), 2).status_code, 200)
+
+        self.client.delete(f"/api/cart/cartItems/{self.item.id}/")
+        self.assertFalse(StockReservation.objects.filter(cart=self.buyer.cart).exists())
+
+    def test_expired_holds_are_not_counted(self):
+        self.client.patch(f"/api/cart/cartItems/{self.item.id}/", {"quantity": 8})
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.add(self.other_client(), 3).status_code, 200)
+
+    def test_orders_only_use_the_stock_not_held_by_other_carts(self):
+        self.assertEqual(self.add(self.other_client(), 9).status_code, 200)
+        response = self.client.post("/api/orders/")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Speaker", response.data["detail"])
+
+    def test_sweeper_releases_expired_holds_in_batches(self):
+        products = Product.objects.bulk_create([
+            Product(seller=self.seller, category=self.category, name=f"Product {i}",
+                    desc="desc", price="1.00", quantity=10)
+            for i in range(5)
+        ])
+        expired = timezone.now() - timedelta(minutes=1)
+        StockReservation.objects.bulk_create([
+            StockReservation(cart=self.buyer.cart, product=product, quantity=1, expires_at=expired)
+            for product in products
+        ] + [StockReservation(cart=self.other_buyer.cart, product=self.product, quantity=1,
+                              expires_at=timezone.now() + timedelta(minutes=1))])
+
+        with self.assertNumQueries(3):
+            self.assertEqual(release_expired(batch_size=2), 5)
+        self.assertEqual(list(StockReservation.objects.values_list("cart", flat=True)), [self.other_buyer.cart.id])
+
+
+class CartSummaryTests(CartTestCase):
+    '''
+    Tests for the cached cart summary
+    '''
+    url = "/api/cart/summary/"
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_summary_is_cached(self):
+        # The id of the user's cart, then its totals
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data, {"items": 2, "total": "120.00"})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data, {"items": 2, "total": "120.00"})
+
+    def test_cart_item_changes_invalidate_the_summary(self):
+        self.client.get(self.url)
+        # The summary is invalidated when the change commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"/api/cart/cartItems/{self.item.id}/", {"quantity": 3})
+        self.assertEqual(self.client.get(self.url).data, {"items": 3, "total": "180.00"})
+
+        other = Product.objects.create(seller=self.seller, category=self.category, name="Cable",
+                                       desc="desc", price="5.00", quantity=3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/cart/cartItems/batch/", [{"op": "add", "product": other.id, "quantity": 2}],
+                             format="json")
+        self.assertEqual(self.client.get(self.url).data, {"items": 5, "total": "190.00"})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/cart/cartItems/{self.item.id}/")
+        self.assertEqual(self.client.get(self.url).data, {"items": 2, "total": "10.00"})
+
+    def test_price_changes_invalidate_the_summary(self):
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = "50.00"
+            self.product.save()
+        self.assertEqual(self.client.get(self.url).data, {"items": 2, "total": "100.00"})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_update_products([{"id": self.product.id, "price": "40.00"}], self.seller)
+        self.assertEqual(self.client.get(self.url).data, {"items": 2, "total": "80.00"})
+
+    def test_other_product_changes_keep_the_summary(self):
+        other = Product.objects.create(seller=self.seller, category=self.category, name="Cable",
+                                       desc="desc", price="5.00", quantity=3)
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            # Stock changes of the cart's product, a full save without a price change, another product's price
+            Product.objects.filter(id=self.product.id).update(quantity=1)
+            product = Product.objects.get(id=self.product.id)
+            product.quantity = 7
+            product.save()
+            bulk_update_products([{"id": self.product.id, "quantity": 9}, {"id": other.id, "price": "6.00"}],
+                                 self.seller)
+            other.price = "7.00"
+            other.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).data, {"items": 2, "total": "120.00"})
+
+    def test_summary_computed_before_a_change_is_not_served(self):
+        cart_id = self.buyer.cart.id
+        _summary, version = get_cached_summary(cart_id)
+        # The cart changes and commits while a read computes its summary from the rows before the change
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_cart_summary(cart_id)
+        set_cached_summary(cart_id, {"items": 2, "total": Decimal("120.00")}, version, {})
+        self.assertEqual(get_cached_summary(cart_id)[0], None)
+
+        self.client.patch(f"/api/cart/cartItems/{self.item.id}/", {"quantity": 3})
+        self.assertEqual(self.client.get(self.url).data, {"items": 3, "total": "180.00"})
+
+    def test_summary_is_per_user(self):
+        self.client.get(self.url)
+        self.client.force_authenticate(self.seller)
+        self.assertEqual(self.client.get(self.url).data, {"items": 0, "total": "0.00"})
+
+    @override_settings(CART_STORAGE="cache", CART_CACHE_ALIAS="carts", CACHES=CART_CACHES)
+    def test_summary_includes_the_unflushed_changes(self):
+        caches["carts"].clear()
+        self.client.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"/api/cart/cartItems/{self.item.id}/", {"quantity": 4})
+        self.assertEqual(self.client.get(self.url).data, {"items": 4, "total": "240.00"})
+        self.assertEqual(CartItem.objects.get(pk=self.item.pk).quantity, 2)
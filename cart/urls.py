@@ -1,6 +1,6 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
-from .views import CartListAPIView, CartItemViewSet
+from .views import CartListAPIView, CartItemViewSet, CartSummaryAPIView
 
 app_name = "cart"
 
@@ -10,5 +10,6 @@ router.register(r"", CartItemViewSet)
 
 urlpatterns = [
     path("", CartListAPIView.as_view(), name="cart-list"),
+    path("summary/", CartSummaryAPIView.as_view(), name="cart-summary"),
     path("cartItems/", include(router.urls)),
 ]
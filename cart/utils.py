@@ -0,0 +1,178 @@
+from decimal import Decimal
+
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import connection
+from django.db.models import FilteredRelation, Q, Value
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import serializers
+
+from products.cache import get_price_versions
+from products.models import Product
+from . import store
+from .exceptions import AddingOwnProductToCartException
+from .cache import (
+    get_cached_cart_id, get_cached_summary, invalidate_cart_summary, set_cached_cart_id, set_cached_summary,
+)
+from .models import Cart, CartItem
+from .reservations import hold_stock, release_stock, with_available_stock
+
+ADD = "add"
+SET = "set"
+REMOVE = "remove"
+
+
+def fold_cart_operations(operations):
+    '''
+    Reduces the operations to one change per product, applied in the order they were sent.
+
+    Returns:
+        dict: {<product_id>: (ADD, quantity) | (SET, quantity) | (REMOVE, None)}
+              ADD is relative to the quantity already in the cart, SET is absolute.
+    '''
+    changes = {}
+    for operation in operations:
+        product_id, op = operation["product"], operation["op"]
+        quantity = operation.get("quantity", 1)
+        current = changes.get(product_id)
+
+        if op == REMOVE or (op == SET and quantity == 0):
+            changes[product_id] = (REMOVE, None)
+        elif op == SET:
+            changes[product_id] = (SET, quantity)
+        elif current is None:
+            changes[product_id] = (ADD, quantity)
+        elif current[0] == REMOVE:
+            changes[product_id] = (SET, quantity)
+        else:
+            changes[product_id] = (current[0], current[1] + quantity)
+    return changes
+
+
+def apply_cart_operations(cart, operations, user):
+    '''
+    Applies a batch of add / set-quantity / remove operations to the cart with a constant number of statements:
+    one query that locks the products and reads their reserved-aware stock, their seller and their quantity in the cart,
+    one DELETE for the removed products and one INSERT ... ON CONFLICT (cart_id, product_id) DO UPDATE
+    for the added and for the set products each. The stock holds of the cart follow the final quantities.
+
+    Must be called inside a transaction.
+
+    Raises:
+        ValidationError: When a product doesn't exist or the resulting quantity exceeds its stock.
+        AddingOwnProductToCartException: When the user adds a product they are selling.
+    '''
+    changes = fold_cart_operations(operations)
+    if not changes:
+        return
+
+    # The product rows stay locked until the holds are written so no other cart can reserve the same stock meanwhile
+    products = Product.objects.filter(id__in=changes).annotate(
+        in_cart=FilteredRelation("cart_product_item", condition=Q(cart_product_item__cart=cart))
+    ).select_for_update(of=("self",)).order_by("pk")
+    products = {
+        product["id"]: product
+        for product in with_available_stock(products, exclude_cart=cart).values(
+            "id", "available_quantity", "seller_id", "in_cart__quantity")
+    }
+
+    errors = {}
+    holds = {}
+    for product_id, (op, quantity) in changes.items():
+        product = products.get(product_id)
+        if product is None:
+            errors[str(product_id)] = [_("Product not found.")]
+            continue
+        if op == REMOVE:
+            continue
+        if product["seller_id"] == user.id:
+            raise AddingOwnProductToCartException()
+
+        final_quantity = quantity + (product["in_cart__quantity"] or 0) if op == ADD else quantity
+        if final_quantity > product["available_quantity"]:
+            errors[str(product_id)] = [_("Requested quantity exceeds available stock.")]
+        holds[product_id] = final_quantity
+    if errors:
+        raise serializers.ValidationError({"products": errors})
+
+    removed = [product_id for product_id, (op, _quantity) in changes.items() if op == REMOVE]
+    if removed:
+        CartItem.objects.filter(cart=cart, product_id__in=removed).delete()
+        release_stock(cart, removed)
+
+    upsert_cart_items(cart, {p: q for p, (op, q) in changes.items() if op == ADD}, relative=True)
+    upsert_cart_items(cart, {p: q for p, (op, q) in changes.items() if op == SET}, relative=False)
+    hold_stock(cart, holds)
+    # The upserts don't send the post_save signals
+    invalidate_cart_summary(cart.id)
+
+
+def upsert_cart_items(cart, quantities, relative):
+    '''
+    Inserts the cart items or updates the ones that already exist through the unique (cart, product) constraint.
+
+    Args:
+        quantities (dict): {<product_id>: quantity}
+        relative (bool): Add the quantities to the existing ones instead of replacing them.
+    '''
+    if not quantities:
+        return
+
+    table = connection.ops.quote_name(CartItem._meta.db_table)
+    now = timezone.now()
+    values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(quantities))
+    params = []
+    # Sorted product ids make concurrent batches lock the rows in the same order
+    for product_id in sorted(quantities):
+        params += [cart.id, product_id, quantities[product_id], now, now]
+
+    quantity = f"{table}.quantity + EXCLUDED.quantity" if relative else "EXCLUDED.quantity"
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {table} (cart_id, product_id, quantity, created_at, updated_at)
+            VALUES {values}
+            ON CONFLICT (cart_id, product_id)
+            DO UPDATE SET quantity = {quantity}, updated_at = EXCLUDED.updated_at
+        """, params)
+
+
+def get_cart_summary(user_id):
+    '''
+    Returns the {"items": <number of items>, "total": <total cost>} summary of the user's cart.
+
+    The summary is cached per cart, so a hit costs a few cache reads and no query,
+    a miss runs one aggregate query of the cart (only the prices with the cache cart storage).
+    '''
+    cart_id = get_cached_cart_id(user_id)
+    if cart_id is None:
+        # The version of the cart is read before its summary is computed, so its id is needed first
+        if store.is_enabled():
+            cart_id = store.get_cart_id(user_id)
+        else:
+            cart_id = Cart.objects.filter(user_id=user_id).values_list("id", flat=True).get()
+        set_cached_cart_id(user_id, cart_id)
+
+    summary, version = get_cached_summary(cart_id)
+    if summary is not None:
+        return summary
+
+    # Read before the query, a price that changes meanwhile moves it and the summary is not cached
+    _versions, prices_version = get_price_versions([])
+    if store.is_enabled():
+        items = store.get_cart_items(user_id)
+        prices = dict(Product.objects.filter(id__in=items).values_list("id", "price"))
+        product_ids = list(prices)
+        summary = {
+            "items": sum(items[product_id] for product_id in prices),
+            "total": sum((items[product_id] * price for product_id, price in prices.items()), Decimal("0.00")),
+        }
+    else:
+        total_items, total_cost, product_ids = Cart.objects.filter(id=cart_id).with_totals().annotate(
+            product_ids=ArrayAgg("cart_items__product_id", filter=Q(cart_items__isnull=False), default=Value([])),
+        ).values_list("total_cartitems", "total_cost", "product_ids").get()
+        summary = {"items": total_items, "total": total_cost}
+
+    price_versions, current_prices_version = get_price_versions(sorted(product_ids))
+    if current_prices_version == prices_version:
+        set_cached_summary(cart_id, summary, version, price_versions)
+    return summary
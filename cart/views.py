@@ -1,13 +1,21 @@
 from rest_framework import viewsets, generics, permissions
-from .serializers import CartItemReadSerializer, CartItemWriteSerializer, CartReadSerializer
+from .serializers import CartItemReadSerializer, CartItemWriteSerializer, CartReadSerializer, CartBatchOperationSerializer
+from .utils import apply_cart_operations, get_cart_summary
+from . import store
+from .reservations import release_stock, reserve_stock
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from .models import Cart, CartItem
 from .permissions import IsNotSellerOfProduct
 from django.utils.translation import gettext_lazy as _
 from .exceptions import AddingOwnProductToCartException
 from users.exceptions import InternalServerErrorException
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, NotFound
 # Fro enabling transaction
 from django.db import transaction
+from django.db.models import Count, Max
+from users.mixins import ConditionalGetMixin
 
 # *********************** BEST APPROACH FOR WRAPPING A TRANSACTION ***********************
 # Since perform_create, perform_update, and perform_destroy are entry points for modifying data, wrap them inside a transaction.
@@ -16,7 +24,11 @@ class CartItemViewSet(viewsets.ModelViewSet):
     permission_classes = [IsNotSellerOfProduct]
 
     def get_queryset(self):
-        return CartItem.objects.filter(cart__user=self.request.user)
+        # With the cache cart storage the reads see the pending changes, the writes go to the stored cart
+        if self.action in ("list", "retrieve"):
+            store.flush_cart(self.request.user.id)
+        # The serializers and the IsNotSellerOfProduct permission read the product of every item
+        return CartItem.objects.filter(cart__user=self.request.user).select_related("product")
 
     def get_serializer_class(self):
         if self.action in ("create", "update", "partial_update", "delete"):
@@ -30,13 +42,15 @@ class CartItemViewSet(viewsets.ModelViewSet):
     # It then calls serializer.save(), which internally invokes the create method inside your serializer.
     def perform_create(self, serializer):
         try:
-            with transaction.atomic():
+            with store.write_through(self.request.user.id), transaction.atomic():
                 product = serializer.validated_data.get("product")
 
                 if self.request.user == product.seller:
                     raise AddingOwnProductToCartException()
 
-                serializer.save(cart=self.request.user.cart)
+                instance = serializer.save(cart=self.request.user.cart)
+                # The stock is held for the cart for STOCK_RESERVATION_TTL seconds
+                reserve_stock(instance.cart, {product.id: instance.quantity})
         except APIException as e:
             raise e
         except Exception as e:
@@ -48,9 +62,22 @@ class CartItemViewSet(viewsets.ModelViewSet):
         """
         Handle updating a cart item.
         """
+        if store.is_enabled():
+            # The quantity only changes in the stored cart and reaches the database with the next flush
+            instance = serializer.instance
+            if not store.has_item(self.request.user.id, instance.product_id):
+                raise NotFound()
+            instance.quantity = serializer.validated_data.get("quantity", instance.quantity)
+            # The holds live in the database in both modes, the hold follows the new quantity like in the database mode
+            with transaction.atomic():
+                reserve_stock(instance.cart_id, {instance.product_id: instance.quantity})
+                store.set_quantity(self.request.user.id, instance.product_id, instance.quantity)
+            return
+
         try:
             with transaction.atomic():  # Start transaction
-                serializer.save()
+                instance = serializer.save()
+                reserve_stock(instance.cart_id, {instance.product_id: instance.quantity})
         except APIException as e:
             raise e
         except Exception as e:
@@ -62,23 +89,89 @@ class CartItemViewSet(viewsets.ModelViewSet):
         """
         Handle removing a cart item.
         """
+        if store.is_enabled():
+            if not store.has_item(self.request.user.id, instance.product_id):
+                raise NotFound()
+            store.remove_item(self.request.user.id, instance.product_id)
+            return
+
         try:
             with transaction.atomic():  # Start transaction
                 instance.delete()
+                release_stock(instance.cart_id, [instance.product_id])
         except APIException as e:
             raise e
         except Exception as e:
             print("Error while adding item to cart: ", e)
             raise InternalServerErrorException()
 
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """
+        Applies a list of add / set / remove operations to the cart in one transaction
+        PATH: /api/cart/cartItems/batch/
+        BODY: [{"op": "add", "product": 1, "quantity": 2}, {"op": "set", "product": 2, "quantity": 1}, {"op": "remove", "product": 3}]
+
+        Returns the updated cart.
+        """
+        serializer = CartBatchOperationSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        cart = Cart.objects.get(user=request.user)
+
+        try:
+            with store.write_through(request.user.id), transaction.atomic():
+                apply_cart_operations(cart, serializer.validated_data, request.user)
+        except APIException as e:
+            raise e
+        except Exception as e:
+            print("Error while applying the cart operations: ", e)
+            raise InternalServerErrorException()
+
+        cart = CartReadSerializer.setup_eager_loading(Cart.objects.filter(pk=cart.pk)).get()
+        return Response(CartReadSerializer(cart, context=self.get_serializer_context()).data)
+
 
 # The ReadOnlyModelViewSet:- only allows GET request
-class CartListAPIView(generics.ListAPIView):
+# The ConditionalGetMixin answers the repeated polls of an unchanged cart with a 304 Not Modified
+class CartListAPIView(ConditionalGetMixin, generics.ListAPIView):
     queryset = Cart.objects.all()
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = CartReadSerializer
     # Inorder to disable pagination in this view
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        store.flush_cart(request.user.id)
+        return super().list(request, *args, **kwargs)
+
     def get_queryset(self):
-        return Cart.objects.filter(user=self.request.user)
+        # The totals are annotated in the cart query and the items are loaded with their products in one more query,
+        # so reading a cart takes the same number of queries however many items it holds
+        return CartReadSerializer.setup_eager_loading(Cart.objects.filter(user=self.request.user))
+
+    def get_etag_fingerprint(self, queryset):
+        return super().get_etag_fingerprint(Cart.objects.filter(user=self.request.user))
+
+    def get_etag_aggregates(self):
+        # The cart response also shows the items and the current prices of their products
+        return {
+            "updated_at": Max("updated_at"),
+            "count": Count("pk", distinct=True),
+            "items_updated_at": Max("cart_items__updated_at"),
+            "items": Count("cart_items", distinct=True),
+            "products_updated_at": Max("cart_items__product__updated_at"),
+        }
+
+
+class CartSummaryAPIView(APIView):
+    '''
+    Returns the number of items and the total cost of the user's cart for the header badges: {"items": 3, "total": "120.00"}
+    PATH: /api/cart/summary/
+
+    The summary is cached per cart and invalidated by the cart item changes, so the frontend can poll it on every page view.
+    '''
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        summary = get_cart_summary(request.user.id)
+        return Response({"items": summary["items"], "total": f'{summary["total"]:.2f}'})
@@ -32,6 +32,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # For the postgres full text search on the products
+    'django.contrib.postgres',
 
     # Third party apps
     # this is added inorder to setup the django admin panel when the DB is postgres
@@ -164,6 +166,42 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+# Cache used for the catalog responses (products.cache)
+# The local memory cache is per process, in production point this to a shared backend like redis or memcached
+# so that the cache versions bumped by one worker invalidate the responses of all the workers.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
+
+# Number of seconds the anonymous catalog responses stay cached
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', default=300, cast=int)
+
+# Where the cart items are written: "database" writes every change to the cart_cartitem table,
+# "cache" keeps the carts in the CART_CACHE_ALIAS cache and writes them to the database in batches
+# with the flush_carts command and before an order is created from the cart.
+# The cache mode needs a shared, persistent cache (like redis) because the unflushed changes only live there.
+CART_STORAGE = config('CART_STORAGE', default='database')
+CART_CACHE_ALIAS = config('CART_CACHE_ALIAS', default='default')
+
+# Number of seconds a cart summary (/api/cart/summary/) stays cached, the changes of its items and of their prices invalidate it before
+CART_SUMMARY_TIMEOUT = config('CART_SUMMARY_TIMEOUT', default=300, cast=int)
+
+# Number of seconds the stock of a product is held for a cart after it is added (cart.reservations)
+STOCK_RESERVATION_TTL = config('STOCK_RESERVATION_TTL', default=900, cast=int)
+
+# The payment webhooks are stored and acknowledged right away, the process_webhook_events workers apply them (payment.webhooks).
+# A failing event is retried after WEBHOOK_RETRY_DELAY seconds, doubled on every attempt, until WEBHOOK_MAX_ATTEMPTS.
+WEBHOOK_MAX_ATTEMPTS = config('WEBHOOK_MAX_ATTEMPTS', default=5, cast=int)
+WEBHOOK_RETRY_DELAY = config('WEBHOOK_RETRY_DELAY', default=30, cast=int)
+# Seconds before an event that lost a deadlock between the workers is retried, doubled on every attempt
+WEBHOOK_TRANSIENT_RETRY_DELAY = config('WEBHOOK_TRANSIENT_RETRY_DELAY', default=0.2, cast=float)
+
+# Number of seconds the response of a request sent with an Idempotency-Key header is replayed (users.mixins.IdempotencyMixin)
+IDEMPOTENCY_KEY_TTL = config('IDEMPOTENCY_KEY_TTL', default=86400, cast=int)
+
 # This is inorder to view the django admin panel
 SITE_ID = 1
 
@@ -257,3 +295,6 @@ SPECTACULAR_SETTINGS = {
 # Configuration to setup and view the media uploaded to the avatar folder
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Number of worker processes that generate the thumbnails and WebP variants of the uploaded images
+IMAGE_DERIVATIVE_WORKERS = config('IMAGE_DERIVATIVE_WORKERS', default=2, cast=int)
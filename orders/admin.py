@@ -6,18 +6,20 @@ from .models import Order, OrderItem
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ("id", "buyer", "total_cost", "status", "shipping_address", "billing_address",
+    list_display = ("id", "buyer", "total_amount", "status", "shipping_address", "billing_address",
                     "created_at", "updated_at")  # Fields displayed in list
     # Allow searching by username and email
     search_fields = ("buyer__username", "buyer__email")
     list_filter = ("created_at",)  # Filter by creation date
-    # Prevent modification of calculated total cost
-    readonly_fields = ("total_cost",)
+    # Prevent modification of calculated total cost, it is maintained by the database
+    readonly_fields = ("total_amount",)
+    list_select_related = ("buyer", "shipping_address", "billing_address")
 
 
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
-    list_display = ("id", "order", "product", "quantity", "cost", "created_at")
-    search_fields = ("order__buyer__username", "product__name")
+    list_display = ("id", "order", "product_name", "unit_price", "quantity", "cost", "created_at")
+    list_select_related = ("order__buyer",)
+    search_fields = ("order__buyer__username", "product_name")
     list_filter = ("created_at", "product")
-    readonly_fields = ("cost",)
+    readonly_fields = ("cost", "unit_price", "product_name", "product_desc")
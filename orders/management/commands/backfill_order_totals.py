@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from orders.models import Order
+
+
+class Command(BaseCommand):
+    '''
+    Fills Order.total_amount for the orders created before the column existed.
+    The orders are walked in id order and every batch is recomputed by one statement in its own transaction,
+    so the command never holds more than batch_size order rows locked and can be re-run safely.
+
+    Usage: python manage.py backfill_order_totals --batch-size 1000
+    '''
+    help = "Compute the stored total of the existing orders in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        started = time.monotonic()
+        last_id = 0
+        processed = 0
+
+        while True:
+            ids = list(Order.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size])
+            if not ids:
+                break
+
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SELECT orders_order_recalculate_totals(%s::bigint[])", [ids])
+
+            processed += len(ids)
+            last_id = ids[-1]
+            self.stdout.write(f"{processed} orders processed")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled the totals of {processed} orders in {time.monotonic() - started:.2f}s"))
@@ -0,0 +1,107 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from cart.models import CartItem
+from orders.models import Order, OrderItem
+from orders.views import OrderViewSet
+from products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    '''
+    Measures the cart to order conversion (POST /api/orders/) of a large cart, next to the per item loop it used to run.
+
+    Three cases are measured: a new pending order, an existing pending order where every line changed
+    and an existing pending order with the same lines (nothing to write).
+    Everything is created inside a transaction that is rolled back, so the command leaves no data behind.
+    Usage: python manage.py benchmark_order_create --lines 1000
+    '''
+    help = "Benchmark the conversion of a large cart to an order"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lines", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.benchmark(options["lines"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def benchmark(self, lines, repeat):
+        seller = User.objects.create_user(
+            email="bench-order-seller@example.com", username="bench-order-seller", password="password")
+        buyer = User.objects.create_user(
+            email="bench-order-buyer@example.com", username="bench-order-buyer", password="password")
+        category = ProductCategory.objects.create(name="Benchmark")
+        products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="9.99", quantity=100)
+            for i in range(lines)
+        ])
+        CartItem.objects.bulk_create([CartItem(cart=buyer.cart, product=product, quantity=2) for product in products])
+
+        view = OrderViewSet.as_view({"post": "create"})
+
+        def create_order():
+            request = APIRequestFactory().post("/api/orders/")
+            force_authenticate(request, user=buyer)
+            response = view(request)
+            assert response.status_code == 201, response.data
+
+        def new_order():
+            Order.objects.filter(buyer=buyer).delete()
+
+        def changed_lines():
+            CartItem.objects.filter(cart=buyer.cart).update(quantity=3 - (CartItem.objects.first().quantity % 2))
+
+        self.stdout.write(f"{'case':<18} {'queries':>8} {'ms':>10} {'loop queries':>13} {'loop ms':>10}")
+        for name, setup in (("new order", new_order), ("changed lines", changed_lines), ("same lines", None)):
+            queries, ms = self.measure(create_order, setup, repeat)
+            loop_queries, loop_ms = self.measure(lambda: self.per_item_loop(buyer), setup, repeat)
+            self.stdout.write(f"{name:<18} {queries:>8} {ms:>10.2f} {loop_queries:>13} {loop_ms:>10.2f}")
+
+    def per_item_loop(self, buyer):
+        '''
+        What OrderWriteSerializer.create used to do: exists(), get_or_create() and one save() per existing line
+        '''
+        with transaction.atomic():
+            cart_items = CartItem.objects.filter(cart__user=buyer).select_related("product")
+            cart_items.exists()
+            [item for item in cart_items if item.quantity > item.product.quantity]
+            order, created = Order.objects.get_or_create(buyer=buyer, status="P")
+            existing = {item.product.id: item for item in order.order_items.all()}
+            new_items = []
+            for item in cart_items:
+                if item.product.id in existing:
+                    existing[item.product.id].quantity = item.quantity
+                    existing[item.product.id].save()
+                else:
+                    new_items.append(OrderItem(order=order, product=item.product, quantity=item.quantity,
+                                               unit_price=item.product.price, product_name=item.product.name,
+                                               product_desc=item.product.desc))
+            OrderItem.objects.bulk_create(new_items)
+            order.order_items.exclude(product__id__in=[item.product.id for item in cart_items]).delete()
+
+    def measure(self, func, setup, repeat):
+        timings = []
+        queries = 0
+        for run in range(repeat + 1):
+            if setup:
+                setup()
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                func()
+                elapsed = (time.perf_counter() - started) * 1000
+            if run == 0:
+                queries = len(captured)
+            else:
+                timings.append(elapsed)
+        return queries, statistics.median(timings)
@@ -0,0 +1,113 @@
+import datetime
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from orders.models import Order, OrderItem
+from orders.pagination import OrderKeysetPagination
+from orders.views import OrderViewSet
+from products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    '''
+    Measures the order history (GET /api/orders/) of a buyer with many orders,
+    page-number pagination next to the cursor pagination mode, at increasing depths, with and without a status filter.
+
+    Everything is created inside a transaction that is rolled back, so the command leaves no data behind.
+    Usage: python manage.py benchmark_order_history --orders 10000
+    '''
+    help = "Benchmark the order history of a buyer with many orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, default=10000)
+        parser.add_argument("--items", type=int, default=2, help="Order items per order")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.benchmark(options["orders"], options["items"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def benchmark(self, orders, items, repeat):
+        seller = User.objects.create_user(
+            email="bench-history-seller@example.com", username="bench-history-seller", password="password")
+        buyer = User.objects.create_user(
+            email="bench-history-buyer@example.com", username="bench-history-buyer", password="password")
+        category = ProductCategory.objects.create(name="Benchmark")
+        products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="9.99", quantity=100)
+            for i in range(items)
+        ])
+
+        statuses = (Order.COMPLETED, Order.COMPLETED, Order.CANCELLED)
+        started = timezone.now()
+        created = Order.objects.bulk_create([
+            Order(buyer=buyer, status=statuses[i % len(statuses)]) for i in range(orders)
+        ])
+        # Spread the orders over time, auto_now_add gives them all the same timestamp
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE orders_order SET created_at = %s - (id - %s) * interval '1 minute' WHERE buyer_id = %s",
+                [started, created[0].id, buyer.id])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, unit_price=product.price,
+                      product_name=product.name, product_desc=product.desc)
+            for order in created for product in products
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE orders_order")
+            cursor.execute("ANALYZE orders_orderitem")
+
+        page_size = OrderKeysetPagination.page_size
+        view = OrderViewSet.as_view({"get": "list"})
+        keyset = OrderKeysetPagination()
+        self.stdout.write(f"{orders} orders of one buyer, {items} items each, page size {page_size}")
+        self.stdout.write(f"{'status':>7} {'page':>7} {'page-number q':>14} {'ms':>9} {'cursor q':>9} {'ms':>9}")
+
+        for status_filter in (None, Order.CANCELLED):
+            history = Order.objects.filter(buyer=buyer).order_by("-created_at", "-id")
+            if status_filter:
+                history = history.filter(status=status_filter)
+            last_page = (history.count() - 1) // page_size + 1
+
+            for page in sorted({1, 10, last_page // 2, last_page}):
+                params = {"status": status_filter} if status_filter else {}
+                page_number = self.measure(view, buyer, {**params, "page": page}, repeat)
+
+                params["pagination"] = "cursor"
+                if page > 1:
+                    # Position the cursor on the last row of the previous page, the lookup itself is not timed
+                    anchor = history.only("created_at", "id")[(page - 1) * page_size - 1]
+                    params["cursor"] = keyset.encode_cursor(anchor.created_at, anchor.id)
+                cursor = self.measure(view, buyer, params, repeat)
+
+                self.stdout.write(f"{status_filter or '-':>7} {page:>7} {page_number[0]:>14} {page_number[1]:>9.2f} "
+                                  f"{cursor[0]:>9} {cursor[1]:>9.2f}")
+
+    def measure(self, view, buyer, params, repeat):
+        timings = []
+        queries = 0
+        for run in range(repeat + 1):
+            request = APIRequestFactory().get("/api/orders/", params)
+            force_authenticate(request, user=buyer)
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = view(request)
+                response.render()
+                elapsed = (time.perf_counter() - started) * 1000
+            assert response.status_code == 200, response.data
+            if run == 0:
+                queries = len(captured)
+            else:
+                timings.append(elapsed)
+        return queries, statistics.median(timings)
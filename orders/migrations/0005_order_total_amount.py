@@ -0,0 +1,81 @@
+# Generated by Django 4.0.4 on 2026-10-17 08:09
+
+from django.db import migrations, models
+
+
+# Recomputes the totals of the given orders in one statement, only the orders whose total changed are written
+CREATE_FUNCTION_SQL = """
+CREATE FUNCTION orders_order_recalculate_totals(order_ids bigint[]) RETURNS void AS $$
+    UPDATE orders_order AS o
+    SET total_amount = totals.total
+    FROM (
+        SELECT ids.id, COALESCE(SUM(item.quantity * product.price), 0) AS total
+        FROM unnest(order_ids) AS ids (id)
+        LEFT JOIN orders_orderitem AS item ON item.order_id = ids.id
+        LEFT JOIN products_product AS product ON product.id = item.product_id
+        GROUP BY ids.id
+    ) AS totals
+    WHERE o.id = totals.id AND o.total_amount IS DISTINCT FROM totals.total;
+$$ LANGUAGE sql;
+"""
+
+# Statement level triggers, so bulk_create, queryset.update() and the set based writes of the cart conversion
+# recompute every touched order once per statement
+CREATE_TRIGGER_SQL = """
+CREATE FUNCTION orders_orderitem_total_amount_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM orders_order_recalculate_totals(ARRAY(SELECT DISTINCT order_id FROM new_rows ORDER BY 1));
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM orders_order_recalculate_totals(ARRAY(
+            SELECT order_id FROM new_rows UNION SELECT order_id FROM old_rows ORDER BY 1));
+    ELSE
+        PERFORM orders_order_recalculate_totals(ARRAY(SELECT DISTINCT order_id FROM old_rows ORDER BY 1));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER orders_orderitem_total_amount_insert
+    AFTER INSERT ON orders_orderitem REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION orders_orderitem_total_amount_update();
+
+CREATE TRIGGER orders_orderitem_total_amount_update
+    AFTER UPDATE ON orders_orderitem REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION orders_orderitem_total_amount_update();
+
+CREATE TRIGGER orders_orderitem_total_amount_delete
+    AFTER DELETE ON orders_orderitem REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION orders_orderitem_total_amount_update();
+"""
+
+DROP_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS orders_orderitem_total_amount_insert ON orders_orderitem;
+DROP TRIGGER IF EXISTS orders_orderitem_total_amount_update ON orders_orderitem;
+DROP TRIGGER IF EXISTS orders_orderitem_total_amount_delete ON orders_orderitem;
+DROP FUNCTION IF EXISTS orders_orderitem_total_amount_update();
+"""
+
+DROP_FUNCTION_SQL = "DROP FUNCTION IF EXISTS orders_order_recalculate_totals(bigint[]);"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_alter_order_billing_address'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['buyer', 'total_amount'], name='order_buyer_total_idx'),
+        ),
+        migrations.RunSQL(CREATE_FUNCTION_SQL, DROP_FUNCTION_SQL),
+        migrations.RunSQL(CREATE_TRIGGER_SQL, DROP_TRIGGER_SQL),
+        # The existing orders are filled by the backfill_order_totals command, in batches
+    ]
@@ -0,0 +1,92 @@
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 5000
+
+# The stored totals are computed from the snapshots from now on, the products are no longer joined
+RECALCULATE_FROM_SNAPSHOT_SQL = """
+CREATE OR REPLACE FUNCTION orders_order_recalculate_totals(order_ids bigint[]) RETURNS void AS $$
+    UPDATE orders_order AS o
+    SET total_amount = totals.total
+    FROM (
+        SELECT ids.id, COALESCE(SUM(item.quantity * item.unit_price), 0) AS total
+        FROM unnest(order_ids) AS ids (id)
+        LEFT JOIN orders_orderitem AS item ON item.order_id = ids.id
+        GROUP BY ids.id
+    ) AS totals
+    WHERE o.id = totals.id AND o.total_amount IS DISTINCT FROM totals.total;
+$$ LANGUAGE sql;
+"""
+
+RECALCULATE_FROM_PRODUCTS_SQL = """
+CREATE OR REPLACE FUNCTION orders_order_recalculate_totals(order_ids bigint[]) RETURNS void AS $$
+    UPDATE orders_order AS o
+    SET total_amount = totals.total
+    FROM (
+        SELECT ids.id, COALESCE(SUM(item.quantity * product.price), 0) AS total
+        FROM unnest(order_ids) AS ids (id)
+        LEFT JOIN orders_orderitem AS item ON item.order_id = ids.id
+        LEFT JOIN products_product AS product ON product.id = item.product_id
+        GROUP BY ids.id
+    ) AS totals
+    WHERE o.id = totals.id AND o.total_amount IS DISTINCT FROM totals.total;
+$$ LANGUAGE sql;
+"""
+
+
+def backfill_snapshots(apps, schema_editor):
+    '''
+    Copies the current price, name and description of the products to the existing order items,
+    one id range per transaction so the table is never locked as a whole.
+    The update trigger recomputes the totals of the touched orders with the copied prices.
+    '''
+    OrderItem = apps.get_model("orders", "OrderItem")
+    connection = schema_editor.connection
+    bounds = OrderItem.objects.aggregate(low=models.Min("id"), high=models.Max("id"))
+    if bounds["low"] is None:
+        return
+
+    for start in range(bounds["low"], bounds["high"] + 1, BATCH_SIZE):
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE orders_orderitem AS item
+                SET unit_price = product.price, product_name = product.name, product_desc = product."desc"
+                FROM products_product AS product
+                WHERE product.id = item.product_id AND item.id >= %s AND item.id < %s AND item.unit_price IS NULL
+            """, [start, start + BATCH_SIZE])
+
+
+class Migration(migrations.Migration):
+    # Every backfill batch commits on its own
+    atomic = False
+
+    dependencies = [
+        ('orders', '0005_order_total_amount'),
+        ('products', '0004_product_facets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_name',
+            field=models.CharField(default='', max_length=200),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_desc',
+            field=models.CharField(default='', max_length=300),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_snapshots, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.RunSQL(RECALCULATE_FROM_SNAPSHOT_SQL, RECALCULATE_FROM_PRODUCTS_SQL),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.4 on 2026-10-17 08:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_orderitem_product_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['buyer', '-created_at', '-id'], name='order_buyer_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['buyer', 'status', '-created_at', '-id'], name='order_buyer_status_created_idx'),
+        ),
+    ]
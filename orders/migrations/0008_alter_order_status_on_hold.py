@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-17 09:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_order_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('P', 'pending'), ('C', 'completed'), ('X', 'cancelled'), ('H', 'on hold')], default='P', max_length=1),
+        ),
+    ]
@@ -13,9 +13,11 @@ class Order(models.Model):
     PENDING = "P"
     COMPLETED = "C"
     CANCELLED = "X"
+    # Paid but some products were out of stock when the payment came in, a staff member ships or refunds it
+    ON_HOLD = "H"
 
     STATUS_CHOICES = ((PENDING, _("pending")), (COMPLETED,
-                      _("completed")), (CANCELLED, _("cancelled")))
+                      _("completed")), (CANCELLED, _("cancelled")), (ON_HOLD, _("on hold")))
 
     buyer = models.ForeignKey(
         User, related_name='orders', on_delete=models.CASCADE)
@@ -26,21 +28,45 @@ class Order(models.Model):
     billing_address = models.ForeignKey(
         Address, related_name="billing_orders", on_delete=models.SET_NULL, blank=True, null=True)
 
+    # Total cost of all the items, maintained by the database triggers on orders_orderitem
+    # in the same transaction as every item change (see migration 0005_order_total_amount)
+    total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ("-created_at",)
+        indexes = [
+            # Sorting and filtering a buyer's orders by their value
+            models.Index(fields=("buyer", "total_amount"), name="order_buyer_total_idx"),
+            # The order history of a buyer, newest first, with and without the status filter
+            models.Index(fields=("buyer", "-created_at", "-id"), name="order_buyer_created_idx"),
+            models.Index(fields=("buyer", "status", "-created_at", "-id"), name="order_buyer_status_created_idx"),
+        ]
 
     def __str__(self):
         return f"Order of {self.buyer.get_full_name()}"
 
-    @cached_property
+    def save(self, *args, **kwargs):
+        '''
+        An update never writes total_amount: the value loaded with the instance may be older than the one
+        the triggers stored since, so only the triggers write it.
+        '''
+        if not self._state.adding and kwargs.get("update_fields") is None and not kwargs.get("force_insert"):
+            deferred = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "total_amount" and field.attname not in deferred
+            ]
+        return super().save(*args, **kwargs)
+
+    @property
     def total_cost(self):
         """
         Total cost of all the items in an order
         """
-        return round(sum([order_item.cost for order_item in self.order_items.all()]), 2)
+        return self.total_amount
 
 
 class OrderItem(models.Model):
@@ -50,6 +76,12 @@ class OrderItem(models.Model):
         Product, related_name="product_orders", on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
 
+    # Snapshot of the product when it was ordered, so the order history neither joins the products
+    # nor changes when the product is edited later
+    unit_price = models.DecimalField(decimal_places=2, max_digits=10)
+    product_name = models.CharField(max_length=200)
+    product_desc = models.CharField(max_length=300)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -57,11 +89,11 @@ class OrderItem(models.Model):
         ordering = ("-created_at",)
 
     def __str__(self):
-        return f"{self.quantity} x {self.product.name} in {self.order.buyer.get_full_name()}'s order"
+        return f"{self.quantity} x {self.product_name} in {self.order.buyer.get_full_name()}'s order"
 
     @cached_property
     def cost(self):
         '''
         This function is used to calculate the total cost of this cart item
         '''
-        return round(self.quantity * self.product.price, 2)
+        return round(self.quantity * self.unit_price, 2)
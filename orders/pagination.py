@@ -0,0 +1,11 @@
+from products.pagination import ProductKeysetPagination
+
+
+class OrderKeysetPagination(ProductKeysetPagination):
+    '''
+    Keyset (cursor) pagination for the order history of a buyer, keyed on (created_at, id) like the product catalog.
+
+    Every page is a `WHERE buyer_id = <user> [AND status = <status>] AND (created_at, id) < (<cursor>) LIMIT n`
+    served from the orders_order (buyer, created_at, id) and (buyer, status, created_at, id) indexes,
+    so a buyer with thousands of orders pages through them without a COUNT(*) or an OFFSET.
+    '''
@@ -12,7 +12,8 @@ class IsOrderByBuyerOrAdmin(BasePermission):
         return request.user.is_authenticated is True
 
     def has_object_permission(self, request, view, obj):
-        return obj.buyer == request.user or request.user.is_staff
+        # Compares the ids so the buyer of the order is not loaded
+        return obj.buyer_id == request.user.id or request.user.is_staff
 
 
 class CanUpdateOrderPermission(BasePermission):
@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from .models import Order, OrderItem
+from .utils import update_order_items
 from cart.models import CartItem
+from cart.store import flush_cart
 from django.utils.translation import gettext_lazy as _
 from users.utils import get_insufficient_products
 
@@ -9,9 +11,8 @@ class OrderItemSerializer(serializers.ModelSerializer):
     '''
     Serializer class for serializing the order items
     '''
-    price = serializers.CharField(source="product.price", read_only=True)
-    product_name = serializers.CharField(source="product.name", read_only=True)
-    product_desc = serializers.CharField(source="product.desc", read_only=True)
+    # The snapshot taken when the product was ordered, not the current product
+    price = serializers.CharField(source="unit_price", read_only=True)
 
     class Meta:
         model = OrderItem
@@ -25,7 +26,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
             "created_at",
             "updated_at",
         )
-        read_only_fields = ("order",)
+        read_only_fields = ("order", "product_name", "product_desc")
 
 
 class OrderReadSerializer(serializers.ModelSerializer):
@@ -69,24 +70,22 @@ class OrderWriteSerializer(serializers.ModelSerializer):
                   "created_at", "updated_at")
 
     def create(self, validated_data):
-        # select_related():
-        #   * This optimizes database queries by using JOINs instead of making separate queries.
-        #   * Instead of fetching each Product separately for every CartItem, Django fetches all data in a single SQL query.
-        #   * It is used when there is a ForeignKey relationship between CartItem and Product.
-
-        # prefetch_related():
-        #  When you have a ManyToManyField or reverse ForeignKey, Django does separate queries and handles joins in Python.
         user = self.context["request"].user
-        cart_items = CartItem.objects.filter(
-            cart__user=user).select_related("product")
+        # The pending changes of a cart stored in the cache must be in the database before the cart is read
+        flush_cart(user.id)
+        # The order items keep a snapshot of the price, name and description of the products
+        cart_items = list(CartItem.objects.filter(cart__user=user).select_related("product").only(
+            "cart_id", "product_id", "quantity", "product__price", "product__name", "product__desc"))
 
-        if not cart_items.exists():
+        if not cart_items:
             raise serializers.ValidationError({
                 "detail": _("Your cart is empty, Can't place an order.")
             })
 
-        # Checking the if the products quantities are sufficient enough to place an order
-        insufficent_products = get_insufficient_products(cart_items)
+        # Checking the if the products quantities are sufficient enough to place an order,
+        # the stock held by the other carts is not available to this order
+        insufficent_products = get_insufficient_products(
+            cart_items, lock=True, exclude_cart=cart_items[0].cart_id)
 
         if insufficent_products:
             raise serializers.ValidationError({
@@ -97,48 +96,38 @@ class OrderWriteSerializer(serializers.ModelSerializer):
         order_instance, created = Order.objects.get_or_create(
             buyer=user, status="P")
 
-        # Get the exiting products that are present in the order items
-        # a dictionary like: { <product_id>: <order_item1> }
-        existing_products = {
-            order_item.product.id: order_item for order_item in order_instance.order_items.all()}
-
+        # The order items are converted with a constant number of statements whatever the size of the cart:
+        # one query for the existing items, one UPDATE ... FROM (VALUES ...), one bulk INSERT and one DELETE.
+        # The pending order is still a draft, so its existing lines also get the current snapshot of their product.
+        # a dictionary like: { <product_id>: (<order_item_id>, <quantity>, <unit_price>, <product_name>, <product_desc>) }
+        existing_items = {} if created else {
+            item[1]: (item[0],) + item[2:]
+            for item in order_instance.order_items.values_list(
+                "id", "product_id", "quantity", "unit_price", "product_name", "product_desc")
+        }
+
+        # a dictionary like: { <order_item_id>: (<quantity>, <unit_price>, <product_name>, <product_desc>) }
+        changed_items = {}
         new_order_items = []
-
-        # To track the product ids being added to the order from the cart
-        cart_product_ids = set()
-
         for item in cart_items:
-            cart_product_ids.add(item.product.id)
-            if item.product.id in existing_products:
-                # Update the quantity to match the lastest cart quantity
-                existing_order_item = existing_products[item.product.id]
-                # Update the existing_order_item quantity
-                existing_order_item.quantity = item.quantity
-                # Saving the order item
-                existing_order_item.save()
-            else:
-                new_order_items.append(
-                    OrderItem(
-                        order=order_instance,
-                        product=item.product,
-                        quantity=item.quantity,
-                    )
-                )
-
-        # Now bulk saving all the order items
+            product = item.product
+            line = (item.quantity, product.price, product.name, product.desc)
+            existing_item = existing_items.pop(item.product_id, None)
+            if existing_item is None:
+                new_order_items.append(OrderItem(
+                    order=order_instance, product_id=item.product_id, quantity=item.quantity,
+                    unit_price=product.price, product_name=product.name, product_desc=product.desc))
+            elif existing_item[1:] != line:
+                # Update the line to match the lastest cart quantity and product snapshot
+                changed_items[existing_item[0]] = line
+
+        update_order_items(changed_items)
+
         if new_order_items:
             OrderItem.objects.bulk_create(new_order_items)
 
-        # Now, remove any order items from the order that are no longer in the cart
-        # These are products that were previously ordered but now they are removed from the cart
-
-        # product__id__in:
-        #   * This is a query lookup syntax in Django that is used to filter objects based on a relationship.
-        #   * product: This refers to a related model field on the OrderItem model
-        #   * id: This is the field in the Product model that holds the unique identifier of each product.
-        #   * __in: This is a lookup operator that allows you to filter for records where a field matches any value in a provided list or set.
-        order_instance.order_items.exclude(
-            product__id__in=cart_product_ids
-        ).delete()
+        # What is left of the existing items are the products that were removed from the cart since
+        if existing_items:
+            OrderItem.objects.filter(id__in=[item[0] for item in existing_items.values()]).delete()
 
         return order_instance
@@ -1,3 +1,351 @@
+import io
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from cart.models import CartItem
+from products.models import Product, ProductCategory
+from users.models import IdempotencyKey
+from .models import Order, OrderItem
+
+User = get_user_model()
+
+
+class OrderTestCase(TestCase):
+    '''
+    Base test case with a buyer who has a pending order of one product of another seller
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.buyer = User.objects.create_user(
+            email="buyer@example.com", username="buyer", password="password")
+        cls.category = ProductCategory.objects.create(name="Audio")
+        cls.product = Product.objects.create(seller=cls.seller, category=cls.category, name="Speaker",
+                                             desc="desc", price="60.00", quantity=10)
+        cls.order = Order.objects.create(buyer=cls.buyer)
+        cls.item = OrderItem.objects.create(order=cls.order, product=cls.product, quantity=2, unit_price="60.00",
+                                           product_name="Speaker", product_desc="desc")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+
+class OrderConditionalGetTests(OrderTestCase):
+    '''
+    Tests for the ETag and If-None-Match support of the order list and retrieve actions
+    '''
+
+    def test_unchanged_orders_return_not_modified(self):
+        for url in ("/api/orders/", f"/api/orders/{self.order.id}/"):
+            etag = self.client.get(url)["ETag"]
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_order_changes_change_the_etag(self):
+        url = f"/api/orders/{self.order.id}/"
+        etag = self.client.get(url)["ETag"]
+        self.item.quantity = 5
+        self.item.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_other_users_orders_are_not_found(self):
+        self.client.force_authenticate(self.seller)
+        response = self.client.get(f"/api/orders/{self.order.id}/", HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, 404)
+
+
+class CartOrderTestCase(OrderTestCase):
+    '''
+    Base test case with more products for the buyer's cart
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.products = Product.objects.bulk_create([
+            Product(seller=cls.seller, category=cls.category, name=f"Product {i}",
+                    desc="desc", price="1.00", quantity=10)
+            for i in range(3)
+        ])
+
+    def set_cart(self, quantities):
+        CartItem.objects.filter(cart=self.buyer.cart).delete()
+        CartItem.objects.bulk_create([
+            CartItem(cart=self.buyer.cart, product_id=product_id, quantity=quantity)
+            for product_id, quantity in quantities.items()
+        ])
+
+    def order_quantities(self):
+        return dict(OrderItem.objects.filter(order=self.order).values_list("product_id", "quantity"))
+
+
+class OrderCreateTests(CartOrderTestCase):
+    '''
+    Tests for the conversion of the cart to the pending order
+    '''
+
+    def test_pending_order_follows_the_cart(self):
+        first, second, third = (product.id for product in self.products)
+        self.set_cart({self.product.id: 3, first: 1, second: 2})
+        self.assertEqual(self.client.post("/api/orders/").status_code, 201)
+        self.assertEqual(self.order_quantities(), {self.product.id: 3, first: 1, second: 2})
+
+        unchanged = OrderItem.objects.get(order=self.order, product_id=second)
+        self.set_cart({first: 4, second: 2, third: 5})
+        self.assertEqual(self.client.post("/api/orders/").status_code, 201)
+        self.assertEqual(self.order_quantities(), {first: 4, second: 2, third: 5})
+        self.assertEqual(OrderItem.objects.get(pk=unchanged.pk).updated_at, unchanged.updated_at)
+        self.assertEqual(Order.objects.filter(buyer=self.buyer).count(), 1)
+
+    def test_empty_cart_is_rejected(self):
+        self.set_cart({})
+        self.assertEqual(self.client.post("/api/orders/").status_code, 400)
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        for count in (1, 50):
+            products = Product.objects.bulk_create([
+                Product(seller=self.seller, category=self.category, name=f"Bulk {count} {i}",
+                        desc="desc", price="1.00", quantity=10)
+                for i in range(count)
+            ])
+            # One line changed, one removed and the new products added
+            quantities = {product.id: 1 for product in products}
+            quantities.update({self.product.id: 3, self.products[0].id: 1})
+            self.set_cart(quantities)
+            OrderItem.objects.filter(order=self.order).exclude(product=self.product).delete()
+            OrderItem.objects.create(order=self.order, product=self.products[1], quantity=1, unit_price="1.00",
+                                     product_name="Product 1", product_desc="desc")
+            OrderItem.objects.filter(pk=self.item.pk).update(quantity=2)
+
+            # savepoint, cart items, locked stock check, pending order, order items, update, insert, delete, release
+            with self.assertNumQueries(9):
+                self.assertEqual(self.client.post("/api/orders/").status_code, 201)
+            self.assertEqual(self.order_quantities(), quantities)
+
+
+class OrderTotalTests(OrderTestCase):
+    '''
+    Tests for the stored order total maintained by the database
+    '''
+
+    def total(self, order=None):
+        return Order.objects.values_list("total_amount", flat=True).get(pk=(order or self.order).pk)
+
+    def test_item_changes_update_the_total(self):
+        self.assertEqual(self.total(), Decimal("120.00"))
+
+        self.item.quantity = 3
+        self.item.save()
+        self.assertEqual(self.total(), Decimal("180.00"))
+
+        cable = Product.objects.create(seller=self.seller, category=self.category, name="Cable",
+                                       desc="desc", price="2.50", quantity=10)
+        OrderItem.objects.bulk_create([OrderItem(order=self.order, product=cable, quantity=2, unit_price=cable.price,
+                                                 product_name=cable.name, product_desc=cable.desc)])
+        self.assertEqual(self.total(), Decimal("185.00"))
+
+        OrderItem.objects.filter(order=self.order).update(quantity=1)
+        self.assertEqual(self.total(), Decimal("62.50"))
+
+        OrderItem.objects.filter(order=self.order).delete()
+        self.assertEqual(self.total(), Decimal("0.00"))
+
+    def test_order_saves_keep_the_total_of_the_triggers(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        # The items change after the order was loaded
+        self.item.quantity = 3
+        self.item.save()
+
+        stale.shipping_address = None
+        stale.save()
+        self.assertEqual(self.total(), Decimal("180.00"))
+
+        response = self.client.delete(f"/api/orders/{self.order.id}/cancel/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.total(), Decimal("180.00"))
+
+    def test_list_filters_and_sorts_by_total(self):
+        small = Order.objects.create(buyer=self.buyer, status=Order.COMPLETED)
+        OrderItem.objects.create(order=small, product=self.product, quantity=1, unit_price="60.00",
+                                 product_name="Speaker", product_desc="desc")
+
+        response = self.client.get("/api/orders/", {"ordering": "total_amount"})
+        self.assertEqual([order["id"] for order in response.data["results"]], [small.id, self.order.id])
+        self.assertEqual(response.data["results"][0]["total_cost"], Decimal("60.00"))
+
+        response = self.client.get("/api/orders/", {"min_total": "100"})
+        self.assertEqual([order["id"] for order in response.data["results"]], [self.order.id])
+
+        response = self.client.get("/api/orders/", {"max_total": "abc", "ordering": "buyer"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {"max_total", "ordering"})
+
+    def test_backfill_command(self):
+        Order.objects.update(total_amount=0)
+        other = Order.objects.create(buyer=self.buyer, status=Order.COMPLETED)
+        call_command("backfill_order_totals", batch_size=1, stdout=io.StringIO())
+        self.assertEqual(self.total(), Decimal("120.00"))
+        self.assertEqual(self.total(other), Decimal("0.00"))
+
+
+class OrderItemSnapshotTests(OrderTestCase):
+    '''
+    Tests for the product snapshot kept on the order items
+    '''
+
+    def test_product_changes_do_not_alter_the_history(self):
+        Product.objects.filter(pk=self.product.pk).update(price="99.00", name="Renamed", desc="new desc")
+
+        response = self.client.get(f"/api/orders/{self.order.id}/")
+        item = response.data["order_items"][0]
+        self.assertEqual((item["price"], item["product_name"], item["product_desc"]), ("60.00", "Speaker", "desc"))
+        self.assertEqual(item["cost"], Decimal("120.00"))
+        self.assertEqual(response.data["total_cost"], Decimal("120.00"))
+
+    def test_pending_order_takes_the_current_snapshot(self):
+        Product.objects.filter(pk=self.product.pk).update(price="50.00", name="Renamed")
+        CartItem.objects.create(cart=self.buyer.cart, product=self.product, quantity=2)
+        self.assertEqual(self.client.post("/api/orders/").status_code, 201)
+
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.unit_price, self.item.product_name), (Decimal("50.00"), "Renamed"))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).total_amount, Decimal("100.00"))
+
+    def test_history_does_not_read_the_products(self):
+        for i in range(3):
+            order = Order.objects.create(buyer=self.buyer, status=Order.COMPLETED)
+            OrderItem.objects.create(order=order, product=self.product, quantity=i + 1, unit_price="60.00",
+                                     product_name="Speaker", product_desc="desc")
+
+        # etag, (count,) orders with their buyer, order items
+        for url, queries in (("/api/orders/", 4), (f"/api/orders/{self.order.id}/", 3)):
+            with self.assertNumQueries(queries) as captured:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            self.assertFalse(any("products_product" in query["sql"] for query in captured.captured_queries))
+
+
+class OrderHistoryTests(OrderTestCase):
+    '''
+    Tests for the order history list and its opt-in cursor pagination mode (?pagination=cursor)
+    '''
+
+    def add_orders(self, count, status=Order.COMPLETED):
+        orders = Order.objects.bulk_create([Order(buyer=self.buyer, status=status) for _ in range(count)])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=self.product, quantity=1, unit_price="60.00",
+                      product_name="Speaker", product_desc="desc")
+            for order in orders
+        ])
+        return orders
+
+    def walk(self, url):
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            seen += [order["id"] for order in response.data["results"]]
+            url = response.data["next"]
+        return seen
+
+    def test_cursor_walks_the_history_newest_first(self):
+        # Orders created in the same transaction share their created_at, the id breaks the tie
+        self.add_orders(12)
+        self.add_orders(5, status=Order.CANCELLED)
+        expected = list(Order.objects.filter(buyer=self.buyer).order_by("-created_at", "-id")
+                        .values_list("id", flat=True))
+        self.assertEqual(self.walk("/api/orders/?pagination=cursor"), expected)
+
+        cancelled = list(Order.objects.filter(buyer=self.buyer, status=Order.CANCELLED)
+                         .order_by("-created_at", "-id").values_list("id", flat=True))
+        self.assertEqual(self.walk(f"/api/orders/?pagination=cursor&status={Order.CANCELLED}"), cancelled)
+
+    def test_list_query_count_does_not_grow_with_the_history(self):
+        # etag, (count,) orders with their buyer, order items
+        for count in (1, 25):
+            self.add_orders(count)
+            with self.assertNumQueries(4):
+                self.assertEqual(self.client.get("/api/orders/").status_code, 200)
+            with self.assertNumQueries(3) as captured:
+                self.assertEqual(self.client.get("/api/orders/?pagination=cursor").status_code, 200)
+            self.assertFalse(any("COUNT(*)" in query["sql"] for query in captured.captured_queries))
+
+    def test_cursor_etag_only_depends_on_the_page(self):
+        newest = self.add_orders(12)
+        first = self.client.get("/api/orders/?pagination=cursor")
+        second_url = first.data["next"]
+        etag = self.client.get(second_url)["ETag"]
+
+        # A newer order shifts the first page but not the ones behind the cursor
+        self.add_orders(1)
+        self.assertEqual(self.client.get(second_url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        item = OrderItem.objects.get(order=newest[0])
+        item.quantity = 3
+        item.save()
+        self.assertEqual(self.client.get(second_url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_cursor_cannot_be_sorted_by_total(self):
+        response = self.client.get("/api/orders/?pagination=cursor&ordering=-total_amount")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("ordering", response.data)
+
+
+class OrderIdempotencyTests(CartOrderTestCase):
+    '''
+    Tests for the Idempotency-Key header of the order creation
+    '''
+
+    def create(self, key):
+        return self.client.post("/api/orders/", HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_first_response(self):
+        self.set_cart({self.product.id: 3})
+        first = self.create("order-1")
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", first)
+
+        # The retry neither reads the cart nor changes the order
+        self.set_cart({self.products[0].id: 1})
+        with self.assertNumQueries(1):
+            retry = self.create("order-1")
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(self.order_quantities(), {self.product.id: 3})
+
+        # Another key is another request
+        self.assertEqual(self.create("order-2").status_code, 201)
+        self.assertEqual(self.order_quantities(), {self.products[0].id: 1})
+
+    def test_failed_request_can_be_retried(self):
+        self.set_cart({})
+        self.assertEqual(self.create("order-1").status_code, 400)
+        self.set_cart({self.product.id: 1})
+        response = self.create("order-1")
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+
+    def test_key_in_use_or_reused_for_another_request(self):
+        IdempotencyKey.objects.create(user=self.buyer, key="running", request_hash="")
+        self.assertEqual(self.create("running").status_code, 409)
+
+        self.set_cart({self.product.id: 1})
+        self.create("order-1")
+        response = self.client.post("/api/orders/?other=1", HTTP_IDEMPOTENCY_KEY="order-1")
+        self.assertEqual(response.status_code, 422)
 
-# Create your tests here.
+    def test_expired_key_is_taken_over(self):
+        self.set_cart({self.product.id: 1})
+        self.create("order-1")
+        self.set_cart({self.product.id: 4})
+        with self.settings(IDEMPOTENCY_KEY_TTL=0):
+            response = self.create("order-1")
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(self.order_quantities(), {self.product.id: 4})
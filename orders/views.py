@@ -4,15 +4,22 @@ from .models import Order
 from cart.models import CartItem
 from .permissions import IsOrderByBuyerOrAdmin, CanUpdateOrderPermission, IsStaffForOrderDeletion
 from .serializers import OrderReadSerializer, OrderWriteSerializer
+from .pagination import OrderKeysetPagination
 from django.db import transaction
-from rest_framework.exceptions import APIException
+from django.db.models import Count, Max
+from users.mixins import ConditionalGetMixin, IdempotencyMixin
+from rest_framework.exceptions import APIException, ValidationError
+from django.utils.translation import gettext_lazy as _
+from decimal import Decimal, InvalidOperation
 from users.exceptions import InternalServerErrorException
 
 # Inorder to manually add another custom endpoint in a viewset
 from rest_framework.decorators import action
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+# The ConditionalGetMixin answers the repeated polls of unchanged orders with a 304 Not Modified
+# and the IdempotencyMixin replays the order creation retried with the same Idempotency-Key header
+class OrderViewSet(ConditionalGetMixin, IdempotencyMixin, viewsets.ModelViewSet):
     queryset = Order.objects.all()
     permission_classes = [IsOrderByBuyerOrAdmin, CanUpdateOrderPermission]
 
@@ -38,6 +45,22 @@ class OrderViewSet(viewsets.ModelViewSet):
         # For other actions, apply the default permissions
         return [permission() for permission in self.permission_classes]
 
+    @property
+    def paginator(self):
+        """
+        Clients opt in to keyset pagination of the order history with ?pagination=cursor,
+        otherwise the default PageNumberPagination from the settings is used.
+        """
+        if not hasattr(self, "_paginator"):
+            if self.action == "list" and self.is_cursor_pagination():
+                self._paginator = OrderKeysetPagination()
+            else:
+                return super().paginator
+        return self._paginator
+
+    def is_cursor_pagination(self):
+        return self.request.query_params.get("pagination") == "cursor"
+
     def get_queryset(self):
         """
         Dynamically filter orders based on query parameters: status.
@@ -45,17 +68,73 @@ class OrderViewSet(viewsets.ModelViewSet):
         """
         user = self.request.user
         status_filter = self.request.query_params.get("status", None)
+        # The order items hold a snapshot of their products, so the history is read from the order tables alone.
+        # The buyer is joined for the buyer name of every order, and the (created_at, id) ordering
+        # is the one of the (buyer, [status,] created_at, id) indexes.
         queryset = Order.objects.filter(
-            buyer=user).prefetch_related("order_items__product")
+            buyer=user).select_related("buyer").prefetch_related("order_items").order_by("-created_at", "-id")
 
         if status_filter:
             allowed_statuses = [Order.PENDING,
-                                Order.COMPLETED, Order.CANCELLED]
+                                Order.COMPLETED, Order.CANCELLED, Order.ON_HOLD]
             if status_filter in allowed_statuses:
                 queryset = queryset.filter(status=status_filter)
 
+        if self.action == "list":
+            queryset = self.filter_by_total(queryset)
+
+        return queryset
+
+    def filter_by_total(self, queryset):
+        """
+        Filters and sorts the orders by their stored total, served by the (buyer, total_amount) index.
+        Query parameters: min_total, max_total, ordering=total_amount|-total_amount
+        """
+        params = self.request.query_params
+        errors = {}
+
+        for param, lookup in (("min_total", "total_amount__gte"), ("max_total", "total_amount__lte")):
+            if param in params:
+                try:
+                    total = Decimal(params[param])
+                except InvalidOperation:
+                    total = None
+                if total is None or not total.is_finite():
+                    errors[param] = _("Must be a number.")
+                else:
+                    queryset = queryset.filter(**{lookup: total})
+
+        ordering = params.get("ordering")
+        if ordering is not None and self.is_cursor_pagination():
+            # The cursor is a (created_at, id) position, the pages can't be sorted by anything else
+            errors["ordering"] = _("Can't be used with the cursor pagination.")
+        elif ordering in ("total_amount", "-total_amount"):
+            queryset = queryset.order_by(ordering, "-id")
+        elif ordering is not None:
+            errors["ordering"] = _("Must be total_amount or -total_amount.")
+
+        if errors:
+            raise ValidationError(errors)
         return queryset
 
+    def get_etag_aggregates(self):
+        # The order response also shows the items, which keep their own snapshot of the products
+        return {
+            "updated_at": Max("updated_at"),
+            "count": Count("pk", distinct=True),
+            "items_updated_at": Max("order_items__updated_at"),
+            "items": Count("order_items", distinct=True),
+        }
+
+    def get_etag_fingerprint(self, queryset):
+        if self.action == "list" and self.is_cursor_pagination():
+            # A cursor page keeps the same orders whatever is added or removed outside of it,
+            # so the ETag only aggregates the rows of the page (and the one after it, which decides the next link)
+            # instead of the whole order history of the buyer
+            page = self.paginator.get_page_queryset(queryset.values("pk"), self.request)
+            queryset = queryset.filter(pk__in=page)
+        return super().get_etag_fingerprint(queryset)
+
     def get_serializer_class(self):
         if self.action in ("create"):
             return OrderWriteSerializer
@@ -90,7 +169,7 @@ class OrderViewSet(viewsets.ModelViewSet):
 
         # Mark the order status as Canceled
         order.status = Order.CANCELLED
-        order.save()
+        order.save(update_fields=["status", "updated_at"])
 
         return Response(
             {"detail": "Order has been cancelled."},
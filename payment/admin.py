@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Payment
+from .models import Payment, WebhookEvent
 
 
 @admin.register(Payment)
@@ -24,3 +24,11 @@ class PaymentAdmin(admin.ModelAdmin):
         return obj.order.buyer.get_full_name()
 
     get_buyer_name.short_description = "Buyer Name"
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ("id", "event_id", "type", "status", "attempts", "available_at", "created_at", "processed_at")
+    list_filter = ("status", "type")
+    search_fields = ("event_id",)
+    readonly_fields = ("event_id", "type", "payload", "created_at", "processed_at")
@@ -7,3 +7,4 @@ class IsOrderOrPaymentAlreadyConfirmed(APIException):
     default_detail = _(
         "This order/payment is already confirmed. You cannot proceed further")
     default_code = "order_or_payment not allowed"
+
@@ -0,0 +1,112 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from orders.models import Order, OrderItem
+from payment.models import Payment, WebhookEvent
+from payment.views import StripeWebhookAPIView
+from products.models import Product, ProductCategory
+
+User = get_user_model()
+
+PREFIX = "evt_benchmark_"
+
+
+class Command(BaseCommand):
+    '''
+    Measures the payment webhook: the time to store and acknowledge an event,
+    and the throughput of the process_webhook_events workers for increasing pool sizes.
+
+    The workers commit, so the data is created for real and deleted at the end.
+    Usage: python manage.py benchmark_webhook_events --events 2000 --workers 1 2 4 8
+    '''
+    help = "Benchmark the webhook ingestion and the throughput of the webhook workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=2000)
+        parser.add_argument("--products", type=int, default=50, help="Products shared by the orders")
+        parser.add_argument("--lines", type=int, default=3, help="Order items per order")
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+        parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 10])
+        parser.add_argument("--pool", choices=("thread", "process"), default="thread")
+
+    def handle(self, *args, **options):
+        seller = User.objects.create_user(
+            email="bench-webhook-seller@example.com", username="bench-webhook-seller", password="password")
+        buyer = User.objects.create_user(
+            email="bench-webhook-buyer@example.com", username="bench-webhook-buyer", password="password")
+        try:
+            self.benchmark(seller, buyer, options)
+        finally:
+            WebhookEvent.objects.filter(event_id__startswith=PREFIX).delete()
+            Product.objects.filter(seller=seller).delete()
+            Order.objects.filter(buyer=buyer).delete()
+            seller.delete()
+            buyer.delete()
+
+    def benchmark(self, seller, buyer, options):
+        count, lines = options["events"], options["lines"]
+        category, _ = ProductCategory.objects.get_or_create(name="Benchmark")
+        products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="9.99",
+                    quantity=count * lines)
+            for i in range(options["products"])
+        ])
+        orders = Order.objects.bulk_create([Order(buyer=buyer) for _ in range(count)])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, unit_price=product.price,
+                      product_name=product.name, product_desc=product.desc)
+            for index, order in enumerate(orders)
+            for product in (products[(index + line) % len(products)] for line in range(lines))
+        ])
+        Payment.objects.bulk_create([Payment(order=order, payment_option=Payment.STRIPE) for order in orders])
+
+        # Ingestion: every event goes through the view like a stripe delivery
+        view = StripeWebhookAPIView.as_view()
+        factory = APIRequestFactory()
+        timings = []
+        for index, order in enumerate(orders):
+            event = {"id": f"{PREFIX}{order.id}", "type": "checkout.session.completed",
+                     "data": {"object": {"metadata": {"order_id": order.id}}}}
+            request = factory.post("/api/payment/stripe/webhook/", {"event": event}, format="json")
+            started = time.perf_counter()
+            response = view(request)
+            timings.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.data
+        timings.sort()
+        self.stdout.write(f"{count} events of {lines} lines stored, "
+                          f"median {statistics.median(timings):.2f} ms, p99 {timings[int(len(timings) * 0.99)]:.2f} ms")
+
+        self.stdout.write(f"{'workers':>8} {'batch':>6} {'seconds':>9} {'events/s':>9}")
+        for batch_size in options["batch_size"]:
+            for workers in options["workers"]:
+                self.reset(products, orders, count * lines)
+                started = time.perf_counter()
+                pending = WebhookEvent.objects.filter(event_id__startswith=PREFIX, status=WebhookEvent.PENDING)
+                # The deadlock victims are retried after WEBHOOK_TRANSIENT_RETRY_DELAY, the pool runs until they are applied
+                while pending.exists():
+                    call_command("process_webhook_events", workers=workers, batch_size=batch_size,
+                                 pool=options["pool"], stdout=open("/dev/null", "w"))
+                    if pending.exists():
+                        time.sleep(0.01)
+                elapsed = time.perf_counter() - started
+
+                left = WebhookEvent.objects.filter(event_id__startswith=PREFIX).exclude(
+                    status=WebhookEvent.PROCESSED).count()
+                assert not left, f"{left} events were not processed"
+                self.stdout.write(f"{workers:>8} {batch_size:>6} {elapsed:>9.2f} {count / elapsed:>9.0f}")
+
+    def reset(self, products, orders, quantity):
+        '''
+        Puts the orders, the payments, the stock and the events back to their state before the workers ran
+        '''
+        Product.objects.filter(pk__in=[product.pk for product in products]).update(quantity=quantity)
+        Order.objects.filter(pk__in=[order.pk for order in orders]).update(status=Order.PENDING)
+        Payment.objects.filter(order__in=orders).update(status=Payment.PENDING)
+        WebhookEvent.objects.filter(event_id__startswith=PREFIX).update(
+            status=WebhookEvent.PENDING, attempts=0, last_error="", available_at=timezone.now(), processed_at=None)
@@ -0,0 +1,65 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from payment.webhooks import process_webhook_events
+
+
+def drain(batch_size):
+    '''
+    Applies pending events until none is left to claim, returns the number of claimed events.
+    Runs in a pool worker, so the worker's own database connection is closed at the end.
+    '''
+    total = 0
+    try:
+        while True:
+            claimed = process_webhook_events(batch_size=batch_size)
+            if not claimed:
+                return total
+            total += claimed
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    '''
+    Worker pool that applies the stored payment webhook events (payment.webhooks).
+    Every worker claims its own batches with SELECT ... FOR UPDATE SKIP LOCKED,
+    so several workers, and several copies of this command, can run side by side.
+
+    Usage: python manage.py process_webhook_events --workers 4 --interval 1
+    '''
+    help = "Apply the pending payment webhook events with a pool of workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Number of workers of the pool")
+        parser.add_argument("--pool", choices=("thread", "process"), default="thread",
+                            help="Run the workers as threads or as processes")
+        parser.add_argument("--batch-size", type=int, default=1,
+                            help="Number of events claimed per transaction, larger batches deadlock more between workers")
+        parser.add_argument("--interval", type=float, default=0,
+                            help="Seconds between two runs once the queue is empty, the command runs forever when given")
+
+    def handle(self, *args, **options):
+        workers = options["workers"]
+        if options["pool"] == "process":
+            # The forked workers must not share the database connections of this process
+            connections.close_all()
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+        else:
+            pool = ThreadPoolExecutor(workers)
+
+        with pool:
+            while True:
+                started = time.monotonic()
+                processed = sum(pool.map(drain, [options["batch_size"]] * workers))
+                elapsed = time.monotonic() - started
+                if processed or not options["interval"]:
+                    rate = processed / elapsed if elapsed else 0
+                    self.stdout.write(f"Processed {processed} events in {elapsed:.3f}s ({rate:.0f} events/s)")
+                if not options["interval"]:
+                    return
+                time.sleep(options["interval"])
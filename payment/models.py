@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from orders.models import Order
 
@@ -38,3 +39,43 @@ class Payment(models.Model):
 
     def __str__(self):
         return f"Payment of {self.order.buyer.get_full_name()}"
+
+
+class WebhookEvent(models.Model):
+    '''
+    Log of the raw events sent by the payment provider, one row per provider event id.
+    The webhook only inserts the event, the process_webhook_events workers apply it later (see payment.webhooks).
+    '''
+    PENDING = "P"
+    PROCESSED = "C"
+    FAILED = "F"
+
+    STATUS_CHOICES = (
+        (PENDING, _("pending")),
+        (PROCESSED, _("processed")),
+        (FAILED, _("failed"))
+    )
+
+    # The provider retries the deliveries, the unique id makes a redelivered event a no-op
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(
+        max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # A pending event is not claimed before this time, failed attempts push it back
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ("id",)
+        indexes = [
+            # The queue of the workers, only the pending events are indexed
+            models.Index(fields=("available_at", "id"), name="webhook_event_pending_idx",
+                         condition=models.Q(status="P")),
+        ]
+
+    def __str__(self):
+        return f"{self.type} event {self.event_id}"
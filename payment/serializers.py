@@ -52,80 +52,72 @@ class CheckoutSerializer(serializers.ModelSerializer):
 
     # This is the function that saves and links the Address model with the Order model
     # and also it links the Payment and Order model
+    # The addresses and the payment are loaded together with the order (see CheckoutAPIView.queryset),
+    # so each of them costs a single INSERT or UPDATE and no lookups.
     def update(self, instance, validated_data):
-        order_shipping_address = None
-        order_billing_address = None
-        order_payment = None
+        # The fields of the order row itself that have to be saved
+        changed_fields = []
 
         # PHASE -1: Setting the shipping address or Order
         shipping_address = validated_data.get("shipping_address", None)
         if shipping_address is not None:
-            # If the order doesn't have a shipping_address already created then
-            if not instance.shipping_address:
-                # Creates an instance of the Address
-                order_shipping_address = Address(**shipping_address)
-                # By calling .save(), you are telling Django to save this object to the corresponding database table (in this case, the Address table).
-                # So this line saves this record to the Address table
-                order_shipping_address.save()
-            else:
-                # If the order already has a shipping address created, then update it
-                # So first filter out and get the Address instance that is linked with the order and get its shipping address
-                # Here we user 'shipping_orders' because Address is connected to Orders via 'shipping_orders'
-                existing_shipping_address_instance = Address.objects.filter(
-                    shipping_orders=instance.id)
-                # Updating the existing address
-                existing_shipping_address_instance.update(**shipping_address)
-                # We set the updated address to the order_shipping_address variable
-                order_shipping_address = existing_shipping_address_instance.first()
+            if self.save_address(instance, "shipping_address", Address.SHIPPING, shipping_address):
+                changed_fields.append("shipping_address")
 
         # PHASE -2: Setting the billing address or Order
         billing_address = validated_data.get("billing_address", None)
         if billing_address is not None:
-            if not instance.billing_address:
-                order_billing_address = Address(**billing_address)
-                order_billing_address.save()
-            else:
-                existing_billing_address_instance = Address.objects.filter(
-                    billing_orders=instance.id)
-                existing_billing_address_instance.update(**billing_address)
-                order_billing_address = existing_billing_address_instance.first()
+            if self.save_address(instance, "billing_address", Address.BILLING, billing_address):
+                changed_fields.append("billing_address")
 
         # PHASE -3: Setting the payment details of Payment model
         payment = validated_data.get("payment", None)
         if payment is not None:
+            # The payment was selected with the order, so this doesn't query the Payment table again
             if not hasattr(instance, "payment"):
-                # Creates a payment instance
-                order_payment = Payment(**payment, order=instance)
-                # Saves this record to the Payment model
-                order_payment.save()
+                # Creates a payment instance linked to the order and saves this record to the Payment model
+                instance.payment = Payment.objects.create(**payment, order=instance)
             else:
-                # Already a payment option is set now we are updating its value
-                # Since we can directly access the order from payment model we pass the whole order instance to it.
-                # Earlier in the Address model we passed the instance.id because Address model didnt have the shipping_address fields we had to find the link with the orders table with an order instance id,
-                # but in this case the Payment model has an order field in it which needs the entire order instance.
-                existing_payment = Payment.objects.filter(order=instance)
-                existing_payment.update(**payment)
-                order_payment = existing_payment.first()
+                # Already a payment option is set now we are updating its value on the loaded payment
+                for attr, value in payment.items():
+                    setattr(instance.payment, attr, value)
+                instance.payment.save(update_fields=[*payment, "updated_at"])
 
         # Checking the if the products quantities are sufficient enough to place an order
-        insufficent_products = get_insufficient_products(instance.order_items.all())
+        # The product rows stay locked until the checkout commits, the buyer's own cart holds don't count.
+        # The cart is selected with the order, see CheckoutAPIView.queryset
+        cart = getattr(instance.buyer, "cart", None)
+        insufficent_products = get_insufficient_products(
+            instance.order_items.only("order_id", "product_id", "quantity"), lock=True,
+            exclude_cart=cart.id if cart is not None else None)
 
         if insufficent_products:
             raise serializers.ValidationError({
                 "detail": _("The following products are out of stock or insufficient: ") + ", ".join(insufficent_products)
             })
 
-        # These lines connects the Address table and the Order table
-        # We update the order table data and connect it with the already created Address records
-        if order_shipping_address is not None:
-            instance.shipping_address = order_shipping_address
-        if order_billing_address is not None:
-            instance.billing_address = order_billing_address
-        if order_payment is not None:
-            # We connect the Order table and Payments table by connecting the instance.payment in Order to the Payment record created
-            instance.payment = order_payment
-
-        # Connects & saves in the DB
-        instance.save()
+        # Connects the Order table with the newly created Address records
+        if changed_fields:
+            instance.save(update_fields=[*changed_fields, "updated_at"])
 
         return instance
+
+    def save_address(self, instance, field, address_type, data):
+        '''
+        Updates the loaded address of the order or creates it.
+
+        Returns:
+            bool: True when the address was created and the order has to be linked to it.
+        '''
+        # The address belongs to the buyer of the order. The nested user default is not applied on PATCH requests.
+        data = {attr: value for attr, value in data.items() if attr != "user"}
+        address = getattr(instance, field)
+        if address is None:
+            setattr(instance, field, Address.objects.create(
+                **data, user_id=instance.buyer_id, address_type=address_type))
+            return True
+
+        for attr, value in data.items():
+            setattr(address, attr, value)
+        address.save(update_fields=[*data, "updated_at"])
+        return False
@@ -1,3 +1,397 @@
-from django.test import TestCase
+import datetime
+import threading
+import time
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+from unittest import mock
+
+from cart.models import StockReservation
+from orders.models import Order, OrderItem
+from products.models import Product, ProductCategory
+from .management.commands.process_webhook_events import drain
+from users.exceptions import InternalServerErrorException
+from users.models import IdempotencyKey
+from .models import Payment, WebhookEvent
+from .views import CheckoutAPIView
+from .webhooks import process_webhook_events
+
+User = get_user_model()
+
+
+def create_paid_order(buyer, lines):
+    '''
+    Creates a pending order of the given (product, quantity) lines with its pending payment
+    '''
+    order = Order.objects.create(buyer=buyer)
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=product, quantity=quantity, unit_price=product.price,
+                  product_name=product.name, product_desc=product.desc)
+        for product, quantity in lines
+    ])
+    Payment.objects.create(order=order, payment_option=Payment.STRIPE)
+    return order
+
+
+def send_webhook(client, order, event_id=None):
+    event = {"id": event_id or f"evt_{order.id}", "type": "checkout.session.completed",
+             "data": {"object": {"metadata": {"order_id": order.id}}}}
+    return client.post("/api/payment/stripe/webhook/", {"event": event}, format="json")
+
+
+class StripeWebhookTests(TestCase):
+    '''
+    Tests for the storage of the Stripe events and their processing by the webhook workers
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(email="seller@example.com", username="seller", password="password")
+        cls.buyer = User.objects.create_user(email="buyer@example.com", username="buyer", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        cls.products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="1.00", quantity=5)
+            for i in range(3)
+        ])
+
+    def stock(self):
+        return list(Product.objects.filter(pk__in=[product.pk for product in self.products])
+                    .order_by("pk").values_list("quantity", flat=True))
+
+    def test_webhook_only_stores_the_event(self):
+        order = create_paid_order(self.buyer, [(self.products[0], 2)])
+        with self.assertNumQueries(1):
+            self.assertEqual(send_webhook(APIClient(), order).status_code, 200)
+        # A redelivered event is acknowledged again and stored once
+        self.assertEqual(send_webhook(APIClient(), order).status_code, 200)
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.event_id, event.status), (f"evt_{order.id}", WebhookEvent.PENDING))
+        self.assertEqual(self.stock(), [5, 5, 5])
+        self.assertEqual(Order.objects.get(pk=order.pk).status, Order.PENDING)
+
+    def test_event_without_an_id_is_rejected(self):
+        response = APIClient().post("/api/payment/stripe/webhook/",
+                                    {"event": {"type": "checkout.session.completed"}}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_storage_errors_are_logged(self):
+        order = create_paid_order(self.buyer, [(self.products[0], 1)])
+        with mock.patch("payment.views.store_event", side_effect=RuntimeError("database is down")):
+            with self.assertLogs("payment.views", "ERROR") as logs:
+                self.assertEqual(send_webhook(APIClient(), order).status_code,
+                                 InternalServerErrorException.status_code)
+        self.assertIn(f"evt_{order.id}", logs.output[0])
+        self.assertIn("database is down", logs.output[0])
+
+    def test_payment_takes_the_stock_of_every_line(self):
+        first, second, third = self.products
+        order = create_paid_order(self.buyer, [(first, 2), (third, 5)])
+        send_webhook(APIClient(), order)
+        # The same payment under another event id
+        send_webhook(APIClient(), order, event_id="evt_again")
+
+        self.assertEqual(process_webhook_events(batch_size=10), 2)
+        self.assertEqual(self.stock(), [3, 5, 0])
+        self.assertEqual(Order.objects.get(pk=order.pk).status, Order.COMPLETED)
+        self.assertEqual(Payment.objects.get(order=order).status, Payment.COMPLETED)
+        self.assertEqual(set(WebhookEvent.objects.values_list("status", flat=True)), {WebhookEvent.PROCESSED})
+        self.assertEqual(process_webhook_events(), 0)
+
+    def test_short_stock_puts_the_paid_order_on_hold(self):
+        first, second, third = self.products
+        order = create_paid_order(self.buyer, [(first, 1), (second, 6), (third, 9)])
+        paid = create_paid_order(self.buyer, [(first, 1)])
+        send_webhook(APIClient(), order)
+        send_webhook(APIClient(), paid)
+
+        with self.assertLogs("payment.webhooks", "ERROR") as logs:
+            self.assertEqual(process_webhook_events(batch_size=10), 2)
+        self.assertIn("Product 1, Product 2", logs.output[0])
+        # The payment is kept and the stock that is there is taken, the event is not retried
+        self.assertEqual(set(WebhookEvent.objects.values_list("status", flat=True)), {WebhookEvent.PROCESSED})
+        self.assertEqual(self.stock(), [3, 5, 5])
+        self.assertEqual(Order.objects.get(pk=order.pk).status, Order.ON_HOLD)
+        self.assertEqual(Payment.objects.get(order=order).status, Payment.COMPLETED)
+        self.assertEqual(Order.objects.get(pk=paid.pk).status, Order.COMPLETED)
+
+        send_webhook(APIClient(), order, event_id="evt_again")
+        self.assertEqual(process_webhook_events(), 1)
+        self.assertEqual(self.stock(), [3, 5, 5])
+
+    def test_deadlock_victims_are_retried_with_a_delay(self):
+        order = create_paid_order(self.buyer, [(self.products[0], 1)])
+        send_webhook(APIClient(), order)
+        deadlock = OperationalError("deadlock detected")
+        # Like the psycopg2 error that Django wraps
+        deadlock.__cause__ = Exception("deadlock detected")
+        deadlock.__cause__.pgcode = "40P01"
+
+        with self.settings(WEBHOOK_MAX_ATTEMPTS=2, WEBHOOK_TRANSIENT_RETRY_DELAY=60):
+            with mock.patch("payment.webhooks.apply_event", side_effect=deadlock):
+                self.assertEqual(process_webhook_events(), 1)
+                event = WebhookEvent.objects.get()
+                self.assertEqual((event.status, event.attempts), (WebhookEvent.PENDING, 1))
+                self.assertGreater(event.available_at, event.created_at + datetime.timedelta(seconds=29))
+                # Not claimed again before its delay
+                self.assertEqual(process_webhook_events(), 0)
+
+                WebhookEvent.objects.update(available_at=timezone.now())
+                self.assertEqual(process_webhook_events(), 1)
+                self.assertEqual(WebhookEvent.objects.get().status, WebhookEvent.FAILED)
+
+    def test_query_count_does_not_grow_with_the_order(self):
+        client = APIClient()
+        for products in (self.products[:1], self.products):
+            order = create_paid_order(self.buyer, [(product, 1) for product in products])
+            send_webhook(client, order)
+            # claim, locked payment, payment update, order, order items, stock update, order update, reservations,
+            # processed, and the savepoints of the batch and of the event (with their release)
+            with self.assertNumQueries(13):
+                self.assertEqual(process_webhook_events(), 1)
+
+
+class CheckoutIdempotencyTests(TestCase):
+    '''
+    Tests for the Idempotency-Key header of the checkout updates
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(email="seller@example.com", username="seller", password="password")
+        cls.buyer = User.objects.create_user(email="buyer@example.com", username="buyer", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        product = Product.objects.create(seller=seller, category=category, name="Speaker", desc="desc",
+                                         price="1.00", quantity=5)
+        cls.order = Order.objects.create(buyer=cls.buyer)
+        OrderItem.objects.create(order=cls.order, product=product, quantity=1, unit_price=product.price,
+                                 product_name=product.name, product_desc=product.desc)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def checkout(self, payment_option, key):
+        return self.client.patch(f"/api/payment/checkout/{self.order.id}/",
+                                 {"payment": {"payment_option": payment_option}},
+                                 format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_first_update(self):
+        first = self.checkout(Payment.STRIPE, "checkout-1")
+        self.assertEqual(first.status_code, 200)
+        payment = Payment.objects.get(order=self.order)
+
+        with self.assertNumQueries(1):
+            retry = self.checkout(Payment.STRIPE, "checkout-1")
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(Payment.objects.get(order=self.order).updated_at, payment.updated_at)
+
+        # The same key with another body is refused
+        self.assertEqual(self.checkout(Payment.PAYPAL, "checkout-1").status_code, 422)
+        self.assertEqual(Payment.objects.get(order=self.order).payment_option, Payment.STRIPE)
+
+    def test_keys_belong_to_their_user(self):
+        IdempotencyKey.objects.create(user=User.objects.get(username="seller"), key="checkout-1",
+                                      request_hash="", status_code=200, response_body={})
+        response = self.checkout(Payment.STRIPE, "checkout-1")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", response)
+
+
+class CheckoutTests(TestCase):
+    '''
+    Tests for the checkout updates of the addresses and the payment of an order
+    '''
+
+    address = {"country": "IN", "city": "Kochi", "street_address": "1 Road", "apartment_address": "2",
+               "postal_code": "682001"}
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(email="seller@example.com", username="seller", password="password")
+        cls.buyer = User.objects.create_user(email="buyer@example.com", username="buyer", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        cls.products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="1.00", quantity=5)
+            for i in range(5)
+        ])
+        cls.order = Order.objects.create(buyer=cls.buyer)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def add_items(self, products):
+        OrderItem.objects.bulk_create([
+            OrderItem(order=self.order, product=product, quantity=1, unit_price=product.price,
+                      product_name=product.name, product_desc=product.desc)
+            for product in products
+        ])
+
+    def checkout(self, data, method="put"):
+        return getattr(self.client, method)(f"/api/payment/checkout/{self.order.id}/", data, format="json")
+
+    def test_checkout_creates_then_updates_the_addresses_and_payment(self):
+        self.add_items(self.products[:1])
+        data = {"payment": {"payment_option": Payment.STRIPE},
+                "shipping_address": self.address, "billing_address": {**self.address, "city": "Delhi"}}
+        response = self.checkout(data, method="patch")
+        self.assertEqual(response.status_code, 200)
+        order = Order.objects.select_related("shipping_address", "billing_address", "payment").get(pk=self.order.pk)
+        self.assertEqual((order.shipping_address.city, order.shipping_address.address_type), ("Kochi", "S"))
+        self.assertEqual((order.billing_address.city, order.billing_address.user_id), ("Delhi", self.buyer.id))
+        self.assertEqual(order.payment.payment_option, Payment.STRIPE)
+
+        response = self.checkout({"payment": {"payment_option": Payment.PAYPAL},
+                                  "shipping_address": {"city": "Chennai"}}, method="patch")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["payment"]["payment_option"], Payment.PAYPAL)
+        updated = Order.objects.select_related("shipping_address", "payment").get(pk=self.order.pk)
+        self.assertEqual(updated.shipping_address_id, order.shipping_address_id)
+        self.assertEqual((updated.shipping_address.city, updated.shipping_address.street_address),
+                         ("Chennai", "1 Road"))
+        self.assertEqual(updated.payment.pk, order.payment.pk)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_out_of_stock_checkout_is_rolled_back(self):
+        self.add_items(self.products[:1])
+        Product.objects.filter(pk=self.products[0].pk).update(quantity=0)
+        response = self.checkout({"payment": {"payment_option": Payment.STRIPE}, "shipping_address": self.address},
+                                 method="patch")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Payment.objects.exists())
+        self.assertIsNone(Order.objects.get(pk=self.order.pk).shipping_address_id)
+
+    def test_stock_check_only_counts_the_holds_of_the_other_carts(self):
+        OrderItem.objects.create(order=self.order, product=self.products[0], quantity=3, unit_price="1.00",
+                                 product_name="Product 0", product_desc="desc")
+        expires_at = timezone.now() + datetime.timedelta(minutes=15)
+        # The buyer's own cart holds the stock it is checking out
+        StockReservation.objects.create(cart=self.buyer.cart, product=self.products[0], quantity=3,
+                                        expires_at=expires_at)
+        data = {"payment": {"payment_option": Payment.STRIPE}}
+        self.assertEqual(self.checkout(data, method="patch").status_code, 200)
+
+        other = User.objects.create_user(email="other@example.com", username="other", password="password")
+        StockReservation.objects.create(cart=other.cart, product=self.products[0], quantity=3, expires_at=expires_at)
+        response = self.checkout(data, method="patch")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Product 0", response.data["detail"])
+
+    def test_query_budget_does_not_grow_with_the_order(self):
+        data = {"payment": {"payment_option": Payment.STRIPE},
+                "shipping_address": self.address, "billing_address": self.address}
+        self.add_items(self.products[:1])
+        self.assertEqual(self.checkout(data).status_code, 200)
+
+        for products in (self.products[1:2], self.products[2:]):
+            self.add_items(products)
+            # order with its buyer, addresses and payment, savepoint, two address updates,
+            # payment update, order items, locked stock check, release
+            with self.assertNumQueries(8):
+                self.assertEqual(self.checkout(data).status_code, 200)
+
+    def test_permissions_stay_the_same_over_many_requests(self):
+        '''
+        The permissions of a checkout update are resolved per request, the permission list of the view never grows
+        '''
+        self.add_items(self.products[:1])
+        permission_classes = list(CheckoutAPIView.permission_classes)
+        data = {"payment": {"payment_option": Payment.STRIPE}}
+        for _ in range(3):
+            self.assertEqual(self.checkout(data, method="patch").status_code, 200)
+        self.assertEqual(CheckoutAPIView.permission_classes, permission_classes)
+
+        # An update with a completed order is still refused, a read is not
+        Order.objects.filter(pk=self.order.pk).update(status=Order.COMPLETED)
+        self.assertEqual(self.checkout(data, method="patch").status_code, 403)
+        self.assertEqual(self.client.get(f"/api/payment/checkout/{self.order.id}/").status_code, 200)
+        self.assertEqual(CheckoutAPIView.permission_classes, permission_classes)
+
+
+class StripeWebhookConcurrencyTests(TransactionTestCase):
+    '''
+    Tests for simultaneous webhooks of orders sharing products, each thread has its own database connection
+    '''
+
+    def setUp(self):
+        seller = User.objects.create_user(email="seller@example.com", username="seller", password="password")
+        self.buyer = User.objects.create_user(email="buyer@example.com", username="buyer", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        self.products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="1.00", quantity=100)
+            for i in range(4)
+        ])
+
+    def run_in_threads(self, targets):
+        barrier = threading.Barrier(len(targets))
+        results, errors = [], []
+
+        def run(target):
+            try:
+                barrier.wait()
+                results.append(target())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def run_webhooks(self, orders):
+        '''
+        Sends the events of the orders at the same time, then drains the queue with simultaneous workers
+        '''
+        statuses = self.run_in_threads([lambda order=order: send_webhook(APIClient(), order).status_code
+                                        for order in orders])
+        self.assertEqual(statuses, [200] * len(orders))
+        claimed = 0
+        # The deadlock victims come back after their short retry delay
+        with self.settings(WEBHOOK_TRANSIENT_RETRY_DELAY=0.01):
+            while True:
+                claimed += sum(self.run_in_threads([lambda: drain(5)] * 4))
+                if not WebhookEvent.objects.filter(status=WebhookEvent.PENDING).exists():
+                    return claimed
+                time.sleep(0.05)
+
+    def test_overlapping_orders_take_the_exact_stock(self):
+        orders = []
+        expected = {product.pk: 100 for product in self.products}
+        for i in range(12):
+            # Every order shares products with the others, with the lines in different orders
+            lines = [(self.products[(i + offset) % 4], offset + 1) for offset in range(3)]
+            if i % 2:
+                lines.reverse()
+            orders.append(create_paid_order(self.buyer, lines))
+            for product, quantity in lines:
+                expected[product.pk] -= quantity
+
+        # Redelivered events of the same orders are sent at the same time too
+        self.run_webhooks(orders + orders[:4])
+        self.assertEqual(WebhookEvent.objects.count(), 12)
+        self.assertEqual(set(WebhookEvent.objects.values_list("status", flat=True)), {WebhookEvent.PROCESSED})
+        self.assertEqual(dict(Product.objects.values_list("pk", "quantity")), expected)
+        self.assertEqual(Order.objects.filter(status=Order.COMPLETED).count(), 12)
+
+    def test_last_units_are_never_oversold(self):
+        product = self.products[0]
+        Product.objects.filter(pk=product.pk).update(quantity=5)
+        orders = [create_paid_order(self.buyer, [(product, 1)]) for _ in range(8)]
+
+        self.run_webhooks(orders)
+        self.assertEqual(WebhookEvent.objects.filter(status=WebhookEvent.PROCESSED).count(), 8)
+        self.assertEqual(Product.objects.get(pk=product.pk).quantity, 0)
+        self.assertEqual(Order.objects.filter(status=Order.COMPLETED).count(), 5)
+        # The late payments are kept, their orders wait for a refund
+        self.assertEqual(Order.objects.filter(status=Order.ON_HOLD).count(), 3)
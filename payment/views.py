@@ -1,34 +1,42 @@
+import logging
+
 from rest_framework.generics import RetrieveUpdateAPIView, CreateAPIView
 from .serializers import CheckoutSerializer
 from orders.models import Order
 from orders.permissions import IsOrderByBuyerOrAdmin
 from .permissions import IsOrderPendingWhenCheckout
 from django.db import transaction
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, ValidationError
 from users.exceptions import InternalServerErrorException
 from rest_framework.response import Response
 from django.utils.translation import gettext_lazy as _
 from rest_framework import status
-from .models import Payment
-from django.shortcuts import get_object_or_404
-from .exceptions import IsOrderOrPaymentAlreadyConfirmed
+from .webhooks import store_event
+from users.mixins import IdempotencyMixin
+
+logger = logging.getLogger(__name__)
 
 
-class CheckoutAPIView(RetrieveUpdateAPIView):
+class CheckoutAPIView(IdempotencyMixin, RetrieveUpdateAPIView):
     '''
     API view that is used for retrieving and updating the shipping address, billing address and payment details of an order.
 
     You can access this API only if it is a GET request or the UPDATE request provided the order is in PENDING state.
+    An update sent again with the same Idempotency-Key header gets the first response back, see users.mixins.IdempotencyMixin
     '''
-    queryset = Order.objects.all()
+    # The checkout reads and updates the addresses and the payment through these instances, see CheckoutSerializer.update,
+    # the buyer is the name of the payment in the response and its cart holds don't count in the stock check
+    queryset = Order.objects.select_related("buyer__cart", "shipping_address", "billing_address", "payment")
     serializer_class = CheckoutSerializer
     permission_classes = [IsOrderByBuyerOrAdmin]
 
     def get_permissions(self):
+        # The permissions are resolved for every request, the permission_classes attribute of the class is never extended
+        permission_classes = self.permission_classes
         if self.request.method in ["PUT", "PATCH"]:
-            self.permission_classes += [IsOrderPendingWhenCheckout]
+            permission_classes = [*permission_classes, IsOrderPendingWhenCheckout]
 
-        return super().get_permissions()
+        return [permission() for permission in permission_classes]
 
     def perform_update(self, serializer):
         try:
@@ -45,48 +53,20 @@ class StripeWebhookAPIView(CreateAPIView):
     '''
     This is the API View that handles the event send from Stripe Webhook after successfull payment.
 
-    After the frontend redirects the app to stripe for payment stripe sends a POST request to this API endpoint,
-    and based on the payment success status we update the payment and order status as well as the quantity of the product.
+    After the frontend redirects the app to stripe for payment stripe sends a POST request to this API endpoint.
+    The event is only stored here and acknowledged right away, so a slow database never makes stripe time out and retry.
+    The process_webhook_events workers then update the payment and order status as well as the quantity of the products.
     '''
 
     def post(self, request, *args, **kwargs):
-        try:
-            with transaction.atomic():
-                payload = request.data
-                event = payload["event"]
-                if event["type"] == "checkout.session.completed":
-                    session = event["data"]["object"]
-                    order_id = session["metadata"]["order_id"]
-
-                    print("Payment successfull")
-
-                    # Finds the payment object with the given order_id or throws an error
-                    payment = get_object_or_404(Payment, order=order_id)
-                    if payment.status == Payment.COMPLETED:
-                        raise IsOrderOrPaymentAlreadyConfirmed()
-                    # Updates the status of the payment
-                    payment.status = "C"
-                    # Saves it in the DB
-                    payment.save()
-
-                    order = get_object_or_404(Order, id=order_id)
-                    if order.status == Order.COMPLETED:
-                        raise IsOrderOrPaymentAlreadyConfirmed()
-                    order.status = "C"
-                    order.save()
+        event = request.data.get("event")
+        if not isinstance(event, dict) or not isinstance(event.get("id"), str) or not isinstance(event.get("type"), str):
+            raise ValidationError({"event": _("Expected a stripe event with an id and a type.")})
 
-                    # Now time to decrase the product quantity
-                    for order_item in order.order_items.all():
-                        product = order_item.product
-                        product.quantity -= order_item.quantity
-                        product.save()
-
-                    return Response({
-                        "message": _(f"Payment of {order.total_cost}/- successfull, Your order is on the way!!")
-                    }, status=status.HTTP_200_OK)
-
-        except APIException as e:
-            raise e
-        except Exception as e:
-            print(f"Error during stripe payment: {e}")
+        try:
+            store_event(event)
+        except Exception:
+            logger.exception("Error while storing the stripe event %s", event["id"])
             raise InternalServerErrorException()
+
+        return Response({"message": _("Event received")}, status=status.HTTP_200_OK)
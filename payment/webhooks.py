@@ -0,0 +1,154 @@
+import datetime
+import logging
+import random
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.utils import timezone
+
+from cart.models import StockReservation
+from orders.models import Order
+from products.utils import decrement_stock
+from .exceptions import IsOrderOrPaymentAlreadyConfirmed
+from .models import Payment, WebhookEvent
+
+
+# deadlock_detected and serialization_failure, the event can be applied again after a short delay
+TRANSIENT_ERROR_CODES = ("40P01", "40001")
+
+logger = logging.getLogger(__name__)
+
+
+def store_event(event):
+    '''
+    Appends a provider event to the WebhookEvent log with a single INSERT ... ON CONFLICT DO NOTHING,
+    a redelivered event id is ignored.
+    '''
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(event_id=event["id"], type=event["type"], payload=event)], ignore_conflicts=True)
+
+
+def complete_checkout(order_id):
+    '''
+    Marks the payment and the order of a successful checkout as completed and takes the sold stock.
+    Raises IsOrderOrPaymentAlreadyConfirmed when the order was already paid.
+
+    The buyer has paid whatever the stock: when some products are short the payment is still recorded as completed,
+    the stock that is there is taken and the order is put on hold for a staff member to ship or refund it.
+    Retrying would not bring the stock back.
+    '''
+    # The payment row stays locked, so a second event of the same order waits for this one and then sees it completed
+    payment = Payment.objects.select_for_update().get(order=order_id)
+    if payment.status == Payment.COMPLETED:
+        raise IsOrderOrPaymentAlreadyConfirmed()
+    # Updates the status of the payment
+    payment.status = Payment.COMPLETED
+    payment.save(update_fields=["status", "updated_at"])
+
+    order = Order.objects.get(id=order_id)
+    if order.status in (Order.COMPLETED, Order.ON_HOLD):
+        raise IsOrderOrPaymentAlreadyConfirmed()
+
+    # Now time to decrase the product quantity, all the lines with one UPDATE that never goes below 0
+    quantities = {}
+    names = {}
+    for product_id, quantity, product_name in order.order_items.values_list(
+            "product_id", "quantity", "product_name"):
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+        names[product_id] = product_name
+
+    out_of_stock = decrement_stock(quantities)
+    if out_of_stock:
+        logger.error("The paid order %s is on hold, not enough stock for: %s",
+                     order_id, ", ".join(names[product_id] for product_id in out_of_stock))
+        order.status = Order.ON_HOLD
+    else:
+        order.status = Order.COMPLETED
+    # total_amount is only written by the triggers on the order items
+    order.save(update_fields=["status", "updated_at"])
+
+    # The sold stock is no longer held for the buyer's cart
+    StockReservation.objects.filter(
+        cart__user=order.buyer_id, product__in=list(quantities)).delete()
+
+
+def apply_event(event):
+    '''
+    Applies a stored provider event, the event types we don't handle are ignored
+    '''
+    if event["type"] == "checkout.session.completed":
+        session = event["data"]["object"]
+        complete_checkout(session["metadata"]["order_id"])
+
+
+def record_failure(event, error, now, retry_delay=None):
+    '''
+    Schedules the next attempt of a failed event, with an exponential delay, or marks it as failed for good
+
+    Args:
+        retry_delay (float): Seconds before the first retry, WEBHOOK_RETRY_DELAY by default.
+                             The delay doubles on every attempt and is spread by a random jitter.
+    '''
+    event.attempts += 1
+    event.last_error = str(error)
+    if event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+        event.status = WebhookEvent.FAILED
+    else:
+        retry_delay = settings.WEBHOOK_RETRY_DELAY if retry_delay is None else retry_delay
+        # The jitter keeps the events that failed together, like the two sides of a deadlock, from colliding again
+        event.available_at = now + datetime.timedelta(
+            seconds=retry_delay * 2 ** (event.attempts - 1) * random.uniform(0.5, 1.5))
+    event.save(update_fields=["attempts", "last_error", "status", "available_at"])
+
+
+def process_webhook_events(batch_size=1):
+    '''
+    Claims up to batch_size pending events with SELECT ... FOR UPDATE SKIP LOCKED and applies them in one transaction,
+    so any number of workers can drain the queue side by side without waiting for each other's events.
+
+    Every event is applied in its own savepoint: a failing event is rolled back alone and retried later
+    with an exponential delay, after WEBHOOK_MAX_ATTEMPTS attempts it is marked as failed.
+
+    A single event locks its products in id order and never deadlocks. The events of a larger batch keep the locks
+    of the previous ones until the commit, which saves commits with few workers but makes workers deadlock
+    on popular products. A deadlock victim is retried after WEBHOOK_TRANSIENT_RETRY_DELAY seconds, doubled on
+    every attempt, and counts against WEBHOOK_MAX_ATTEMPTS like any other failure.
+
+    Returns:
+        int: The number of claimed events.
+    '''
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(status=WebhookEvent.PENDING, available_at__lte=now)
+            .order_by("available_at", "id")
+            .only("id", "event_id", "payload", "status", "attempts", "available_at")[:batch_size])
+
+        processed_ids = []
+        for event in events:
+            try:
+                with transaction.atomic():
+                    apply_event(event.payload)
+                processed_ids.append(event.id)
+            except IsOrderOrPaymentAlreadyConfirmed:
+                # The provider sent the same payment again under another event id
+                processed_ids.append(event.id)
+            except OperationalError as e:
+                if getattr(e.__cause__, "pgcode", None) in TRANSIENT_ERROR_CODES:
+                    # The events of a batch lock their products one after the other, so two workers can deadlock.
+                    # The victim is retried soon, an event that keeps deadlocking fails for good in the end.
+                    logger.warning("Retrying the webhook event %s: %s", event.event_id, e)
+                    record_failure(event, e, now, retry_delay=settings.WEBHOOK_TRANSIENT_RETRY_DELAY)
+                else:
+                    logger.exception("Error while processing the webhook event %s", event.event_id)
+                    record_failure(event, e, now)
+            except Exception as e:
+                logger.exception("Error while processing the webhook event %s", event.event_id)
+                record_failure(event, e, now)
+
+        if processed_ids:
+            WebhookEvent.objects.filter(id__in=processed_ids).update(
+                status=WebhookEvent.PROCESSED, processed_at=timezone.now())
+
+    return len(events)
@@ -0,0 +1,157 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+# Namespaces of the cached catalog responses, every namespace has its own version number
+PRODUCTS_NAMESPACE = "products"
+CATEGORIES_NAMESPACE = "categories"
+
+
+def _version_key(namespace):
+    return f"catalog:version:{namespace}"
+
+
+# Version of all the prices, moved by every price change before the versions of the changed products
+PRICES_VERSION_KEY = "catalog:prices:version"
+
+
+def _price_version_key(product_id):
+    return f"catalog:price:{product_id}"
+
+
+def _stats_key(namespace, outcome):
+    return f"catalog:stats:{namespace}:{outcome}"
+
+
+def get_namespace_version(namespace):
+    '''
+    Returns the current version number of the namespace, every cached response key contains it.
+    '''
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        # The version key is missing (first use or evicted), so start from the current time
+        # instead of 1 so that the keys of responses cached before the eviction are never reused.
+        cache.add(_version_key(namespace), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(namespace))
+    return version
+
+
+def bump_namespace_version(namespace):
+    '''
+    Invalidates every cached response of the namespace in O(1) by moving it to a new version number.
+    The responses cached under the old version are never read again and simply expire.
+
+    The version moves once the current transaction commits: a read that runs before the commit still sees
+    the old rows and must not cache them under the new version.
+    '''
+    def bump():
+        try:
+            cache.incr(_version_key(namespace))
+        except ValueError:
+            # incr raises ValueError when the key does not exist
+            cache.add(_version_key(namespace), time.time_ns(), timeout=None)
+
+    transaction.on_commit(bump)
+
+
+def get_price_versions(product_ids):
+    '''
+    Returns the price version of every product and the version of all the prices, with one cache read:
+    ({<product_id>: <version>}, <prices version>)
+
+    A product has no version (None) until its price changes, an evicted version is None again
+    and never equal to the version it had, so nothing is computed from an outdated price.
+    '''
+    keys = {_price_version_key(product_id): product_id for product_id in product_ids}
+    found = cache.get_many([PRICES_VERSION_KEY, *keys])
+    return {product_id: found.get(key) for key, product_id in keys.items()}, found.get(PRICES_VERSION_KEY)
+
+
+def bump_price_versions(product_ids):
+    '''
+    Moves the changed products to a new price version once the transaction commits, so the values computed
+    from their old prices (the cart summaries) are not used anymore. The stock changes never call this.
+
+    The version of all the prices is moved first, a value computed while a price changes can see it.
+    '''
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+
+    def bump():
+        try:
+            cache.incr(PRICES_VERSION_KEY)
+        except ValueError:
+            cache.set(PRICES_VERSION_KEY, time.time_ns(), timeout=None)
+        version = time.time_ns()
+        cache.set_many({_price_version_key(product_id): version for product_id in product_ids}, timeout=None)
+
+    transaction.on_commit(bump)
+
+
+def _count(namespace, outcome):
+    key = _stats_key(namespace, outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def get_cache_stats(namespace):
+    '''
+    Returns the hit and miss counters of the namespace, they are shared by all the workers using the same cache.
+    '''
+    return {
+        "hits": cache.get(_stats_key(namespace, "hits"), 0),
+        "misses": cache.get(_stats_key(namespace, "misses"), 0),
+    }
+
+
+def reset_cache_stats(namespace):
+    cache.delete_many([_stats_key(namespace, "hits"), _stats_key(namespace, "misses")])
+
+
+class CachedCatalogResponseMixin:
+    '''
+    Viewset mixin that caches the list and retrieve responses of anonymous users.
+
+    The cache key is built from the namespace version and the full request URL (path and query parameters),
+    so bumping the namespace version on every write invalidates all the cached responses without scanning keys.
+    '''
+    cache_namespace = None
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(super().retrieve, request, *args, **kwargs)
+
+    def get_cache_key(self, request):
+        url = request.build_absolute_uri()
+        digest = hashlib.md5(url.encode("utf-8")).hexdigest()
+        version = get_namespace_version(self.cache_namespace)
+        return f"catalog:{self.cache_namespace}:v{version}:{self.action}:{digest}"
+
+    def get_cached_response(self, handler, request, *args, **kwargs):
+        # Only the anonymous reads are cached, authenticated users always get fresh data
+        if request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+
+        key = self.get_cache_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            _count(self.cache_namespace, "hits")
+            data, status = cached
+            return Response(data, status=status)
+
+        _count(self.cache_namespace, "misses")
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            timeout = getattr(settings, "CATALOG_CACHE_TIMEOUT", 300)
+            cache.set(key, (response.data, response.status_code), timeout)
+        return response
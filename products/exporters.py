@@ -0,0 +1,62 @@
+import csv
+import json
+
+from .models import Product
+
+CSV = "csv"
+NDJSON = "ndjson"
+
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    NDJSON: "application/x-ndjson",
+}
+
+# Exported columns, category is the category name
+EXPORT_FIELDS = ("id", "name", "desc", "category", "category_id", "seller_id",
+                 "price", "quantity", "image", "created_at", "updated_at")
+
+# Product columns read for the export, in the order of EXPORT_FIELDS
+QUERY_FIELDS = ("id", "name", "desc", "category__name", "category_id", "seller_id",
+                "price", "quantity", "image", "created_at", "updated_at")
+
+
+class Echo:
+    '''
+    File like object whose write returns the value, so csv.writer can produce the lines lazily
+    '''
+
+    def write(self, value):
+        return value
+
+
+def iter_export_rows(queryset, request, chunk_size=2000):
+    '''
+    Yields the exported products as plain dicts.
+
+    The rows are read through a server side cursor in chunks and built from values_list tuples,
+    so neither model instances nor DRF serializers are created and the memory use stays constant.
+    '''
+    rows = queryset.order_by("id").values_list(*QUERY_FIELDS).iterator(chunk_size=chunk_size)
+    storage = Product._meta.get_field("image").storage
+    for values in rows:
+        row = dict(zip(EXPORT_FIELDS, values))
+        row["price"] = str(row["price"])
+        row["image"] = request.build_absolute_uri(storage.url(row["image"])) if row["image"] else ""
+        row["created_at"] = row["created_at"].isoformat()
+        row["updated_at"] = row["updated_at"].isoformat()
+        yield row
+
+
+def stream_export(rows, export_format):
+    '''
+    Encodes the rows lazily as CSV lines (with a header) or NDJSON lines
+    '''
+    if export_format == CSV:
+        writer = csv.DictWriter(Echo(), fieldnames=EXPORT_FIELDS)
+        yield writer.writeheader()
+        for row in rows:
+            yield writer.writerow(row)
+        return
+
+    for row in rows:
+        yield json.dumps(row) + "\n"
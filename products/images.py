@@ -0,0 +1,178 @@
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+# Bounding boxes of the generated derivatives, the aspect ratio of the original image is kept
+DERIVATIVE_SIZES = {
+    "thumbnail": (200, 200),
+    "medium": (600, 600),
+}
+
+# Pillow formats of the derivatives that keep the original file type
+FORMATS_BY_EXTENSION = {
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".png": "PNG",
+    ".gif": "PNG",
+    ".webp": "WEBP",
+}
+
+# A derivative never disappears once generated, the missing ones are looked up in the storage again after a minute
+DERIVATIVE_READY_TIMEOUT = 60 * 60 * 24
+DERIVATIVE_MISSING_TIMEOUT = 60
+
+_executor = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_derivative_name(name, variant, webp=False):
+    '''
+    Returns the storage name of a derivative of the image.
+
+    The names are derived from the original name only, so a derivative that already exists is never generated twice.
+    Eg: products/category/images/TV/tv.jpg -> products/category/images/TV/derivatives/tv_thumbnail.webp
+    '''
+    directory, filename = os.path.split(name)
+    stem, extension = os.path.splitext(filename)
+    if webp or extension.lower() not in FORMATS_BY_EXTENSION:
+        extension = ".webp"
+    elif extension.lower() == ".gif":
+        extension = ".png"
+    return os.path.join(directory, "derivatives", f"{stem}_{variant}{extension.lower()}")
+
+
+def get_derivative_key(name):
+    return "image-derivative:" + hashlib.md5(name.encode("utf-8")).hexdigest()
+
+
+def mark_derivatives_ready(names):
+    cache.set_many({get_derivative_key(name): True for name in names}, timeout=DERIVATIVE_READY_TIMEOUT)
+
+
+def get_ready_derivatives(storage, names):
+    '''
+    Returns the set of the derivative names that exist in the storage.
+    The answers are cached so that serializing a page of products doesn't hit the storage for every image.
+    '''
+    keys = {get_derivative_key(name): name for name in names}
+    found = cache.get_many(keys)
+    missing = {}
+    for key, name in keys.items():
+        if key not in found:
+            found[key] = missing[key] = storage.exists(name)
+    if missing:
+        cache.set_many({key: exists for key, exists in missing.items() if exists}, timeout=DERIVATIVE_READY_TIMEOUT)
+        cache.set_many({key: exists for key, exists in missing.items() if not exists},
+                       timeout=DERIVATIVE_MISSING_TIMEOUT)
+    return {name for key, name in keys.items() if found[key]}
+
+
+def get_derivative_urls(image, request=None):
+    '''
+    Returns the URLs of the derivatives of an image field, {} when there is no image.
+    Eg: {"thumbnail": ..., "thumbnail_webp": ..., "medium": ..., "medium_webp": ...}
+
+    The derivatives are generated in the background after the upload, until one exists (or when its generation
+    failed) its URL is the one of the original image.
+    '''
+    if not image:
+        return {}
+
+    names = {}
+    for variant in DERIVATIVE_SIZES:
+        for webp, key in ((False, variant), (True, f"{variant}_webp")):
+            names[key] = get_derivative_name(image.name, variant, webp)
+    ready = get_ready_derivatives(image.storage, names.values())
+
+    urls = {}
+    for key, name in names.items():
+        url = image.storage.url(name if name in ready else image.name)
+        urls[key] = request.build_absolute_uri(url) if request is not None else url
+    return urls
+
+
+def generate_derivatives(name):
+    '''
+    Generates the missing thumbnail and WebP derivatives of the stored image.
+    This is idempotent: the derivatives that already exist are skipped.
+
+    Returns:
+        list: Names of the derivatives that were created.
+    '''
+    created = []
+    ready = []
+    original = None
+
+    for variant, size in DERIVATIVE_SIZES.items():
+        for webp in (False, True):
+            target = get_derivative_name(name, variant, webp)
+            ready.append(target)
+            if default_storage.exists(target):
+                continue
+
+            if original is None:
+                with default_storage.open(name, "rb") as f:
+                    original = Image.open(f)
+                    original.load()
+
+            image_format = "WEBP" if webp else FORMATS_BY_EXTENSION.get(
+                os.path.splitext(target)[1], "WEBP")
+            derivative = original.copy()
+            derivative.thumbnail(size)
+            if image_format == "JPEG" and derivative.mode != "RGB":
+                derivative = derivative.convert("RGB")
+
+            buffer = io.BytesIO()
+            derivative.save(buffer, format=image_format)
+            saved = default_storage.save(target, ContentFile(buffer.getvalue()))
+            if saved != target:
+                # Another worker created it in the meantime and the storage picked an alternative name
+                default_storage.delete(saved)
+                continue
+            created.append(saved)
+
+    mark_derivatives_ready(ready)
+    return created
+
+
+def get_executor():
+    '''
+    Returns the process pool that generates the derivatives outside of the request threads.
+
+    The workers are spawned instead of forked so that they don't inherit the web server's threads
+    and database connections, they only need the settings to reach the media storage.
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=getattr(settings, "IMAGE_DERIVATIVE_WORKERS", 2),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        )
+    return _executor
+
+
+def _report_failure(future):
+    error = future.exception()
+    if error is not None:
+        logger.error("Error while generating image derivatives: %s", error, exc_info=error)
+
+
+def schedule_derivatives(name):
+    '''
+    Queues the derivative generation of the stored image on the worker pool and returns immediately
+    '''
+    future = get_executor().submit(generate_derivatives, name)
+    future.add_done_callback(_report_failure)
+    return future
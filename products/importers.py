@@ -0,0 +1,179 @@
+import codecs
+import csv
+import io
+import json
+import re
+from itertools import islice
+
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from .cache import bump_namespace_version, PRODUCTS_NAMESPACE, CATEGORIES_NAMESPACE
+from .models import Product, ProductCategory
+from .serializers import ProductImportRowSerializer
+
+CSV = "csv"
+NDJSON = "ndjson"
+
+# File extensions understood by the importer
+FORMATS_BY_EXTENSION = {
+    "csv": CSV,
+    "ndjson": NDJSON,
+    "jsonl": NDJSON,
+}
+
+# At most this many row errors are kept in the report so that a broken file can't exhaust the memory
+MAX_REPORTED_ERRORS = 1000
+
+# The bytes that are not valid UTF-8 are decoded to these lone surrogates by the surrogateescape error handler
+UNDECODABLE_RE = re.compile("[\udc80-\udcff]")
+UNDECODABLE_ERROR = "The row is not UTF-8 encoded."
+
+
+def get_import_format(filename):
+    '''
+    Returns the import format for the file name or None when the extension is not supported
+    '''
+    extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return FORMATS_BY_EXTENSION.get(extension)
+
+
+def iter_rows(stream, import_format):
+    '''
+    Lazily parses the binary stream into dicts, one row at a time, the file is never fully loaded in memory.
+
+    Rows that can't be parsed at all (invalid JSON or not UTF-8) are yielded as ValueError instances
+    so that they are reported with their row number instead of aborting the import.
+    '''
+    lines = codecs.iterdecode(stream, "utf-8-sig", errors="surrogateescape")
+    if import_format == CSV:
+        for row in csv.DictReader(lines):
+            # Extra columns are collected in a list under the None key and are ignored anyway
+            if any(UNDECODABLE_RE.search(value) for value in row.values() if isinstance(value, str)):
+                yield ValueError(UNDECODABLE_ERROR)
+            else:
+                yield row
+        return
+
+    for line in lines:
+        if not line.strip():
+            continue
+        if UNDECODABLE_RE.search(line):
+            yield ValueError(UNDECODABLE_ERROR)
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON: {e}")
+            continue
+        yield row if isinstance(row, dict) else ValueError("Each line must be a JSON object.")
+
+
+class ProductImporter:
+    '''
+    Streams product rows into the products table for a seller.
+
+    Rows are validated and inserted in batches: every batch resolves its categories with one query for the
+    names not seen before (creating the missing ones with one bulk_create) and inserts its valid products
+    with one postgres COPY. Invalid rows are skipped and reported with their row number.
+
+    COPY is used instead of Product.objects.bulk_create because building a model instance and compiling
+    the INSERT costs more per row than the insert itself. The database triggers (search vector, facet counts)
+    still run for the copied rows.
+    '''
+    # Columns written by the COPY, search_vector is filled in by its trigger
+    copy_fields = ("seller", "category", "name", "desc", "image", "price", "quantity", "created_at", "updated_at")
+
+    def __init__(self, seller, batch_size=2000):
+        self.seller = seller
+        self.batch_size = batch_size
+        # A single serializer validates every row, building one per row costs more than the validation itself
+        self.row_serializer = ProductImportRowSerializer()
+        # Category name -> id, so every distinct name is resolved once per import
+        self.category_ids = {}
+        self.created = 0
+        self.errors = []
+        self.error_count = 0
+
+    def run(self, rows):
+        '''
+        Imports the rows and returns the report: {"created": int, "error_count": int, "errors": [{"row", "errors"}]}
+        '''
+        rows = enumerate(rows, start=1)
+        try:
+            while True:
+                batch = list(islice(rows, self.batch_size))
+                if not batch:
+                    break
+                self.import_batch(batch)
+        finally:
+            if self.created:
+                # bulk_create does not send the post_save signals that invalidate the catalog cache
+                bump_namespace_version(PRODUCTS_NAMESPACE)
+                bump_namespace_version(CATEGORIES_NAMESPACE)
+
+        return {"created": self.created, "error_count": self.error_count, "errors": self.errors}
+
+    def add_error(self, row_number, errors):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row_number, "errors": errors})
+
+    def import_batch(self, batch):
+        valid_rows = []
+        for row_number, row in batch:
+            if isinstance(row, ValueError):
+                self.add_error(row_number, {"non_field_errors": [str(row)]})
+                continue
+            try:
+                valid_rows.append(self.row_serializer.run_validation(row))
+            except serializers.ValidationError as e:
+                self.add_error(row_number, e.detail)
+
+        if not valid_rows:
+            return
+
+        known_categories = set(self.category_ids)
+        try:
+            with transaction.atomic():
+                self.resolve_categories({row["category"] for row in valid_rows})
+                self.copy_products(valid_rows)
+        except Exception:
+            # The categories created by the rolled back batch don't exist anymore
+            for name in self.category_ids.keys() - known_categories:
+                del self.category_ids[name]
+            raise
+        self.created += len(valid_rows)
+
+    def copy_products(self, rows):
+        now = timezone.now()
+        buffer = io.StringIO()
+        # Quoting every value keeps empty strings from being read as NULL by COPY
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        for row in rows:
+            writer.writerow((
+                self.seller.id, self.category_ids[row["category"]], row["name"], row["desc"], "",
+                row["price"], row["quantity"], now, now,
+            ))
+        buffer.seek(0)
+
+        columns = ", ".join(
+            connection.ops.quote_name(Product._meta.get_field(field).column) for field in self.copy_fields)
+        table = connection.ops.quote_name(Product._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    def resolve_categories(self, names):
+        missing = names - self.category_ids.keys()
+        if not missing:
+            return
+
+        for category_id, name in ProductCategory.objects.filter(
+                name__in=missing).order_by("id").values_list("id", "name"):
+            # The category name is not unique, the first existing category wins like get_or_create would do
+            self.category_ids.setdefault(name, category_id)
+
+        new_categories = [ProductCategory(name=name) for name in missing - self.category_ids.keys()]
+        for category in ProductCategory.objects.bulk_create(new_categories):
+            self.category_ids[category.name] = category.id
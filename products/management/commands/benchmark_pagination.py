@@ -0,0 +1,63 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.test import APIRequestFactory
+
+from products.models import Product
+from products.pagination import ProductKeysetPagination
+from products.views import ProductViewSet
+
+
+class Command(BaseCommand):
+    '''
+    Compares PageNumberPagination and the keyset pagination mode of the product list at increasing depths.
+
+    Seed the catalog first (python manage.py seed_products --count 1000000), then run:
+    python manage.py benchmark_pagination
+    '''
+    help = "Benchmark page-number vs keyset pagination on the product list endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        total = Product.objects.filter(quantity__gt=0).count()
+        if not total:
+            raise CommandError("No products found, run seed_products first.")
+
+        page_size = ProductKeysetPagination.page_size
+        last_page = (total - 1) // page_size + 1
+        depths = sorted({1, 10, 100, last_page // 2, last_page})
+        view = ProductViewSet.as_view({"get": "list"})
+        factory = APIRequestFactory()
+        keyset = ProductKeysetPagination()
+
+        self.stdout.write(f"{total} products in stock, page size {page_size}")
+        self.stdout.write(f"{'page':>10} {'page-number ms':>16} {'cursor ms':>12}")
+
+        for page in depths:
+            page_number_ms = self.time_request(
+                view, factory.get("/api/products/", {"page": page}), options["repeat"])
+
+            params = {"pagination": "cursor"}
+            if page > 1:
+                # Position the cursor on the last row of the previous page, the lookup itself is not timed
+                anchor = Product.objects.filter(quantity__gt=0).order_by(
+                    "-created_at", "-id").only("created_at", "id")[(page - 1) * page_size - 1]
+                params["cursor"] = keyset.encode_cursor(anchor.created_at, anchor.id)
+            cursor_ms = self.time_request(
+                view, factory.get("/api/products/", params), options["repeat"])
+
+            self.stdout.write(f"{page:>10} {page_number_ms:>16.2f} {cursor_ms:>12.2f}")
+
+    def time_request(self, view, request, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = view(request)
+            response.render()
+            timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise CommandError(f"Request failed with status {response.status_code}")
+        return statistics.median(timings)
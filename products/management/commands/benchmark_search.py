@@ -0,0 +1,62 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from rest_framework.test import APIRequestFactory
+
+from products.models import Product
+from products.views import ProductViewSet
+
+
+class Command(BaseCommand):
+    '''
+    Measures the latency of the full text search endpoint against the ILIKE scan it replaces.
+
+    Seed the catalog first (python manage.py seed_products --count 1000000), then run:
+    python manage.py benchmark_search --terms "product 4242" "synthetic benchmarking"
+    '''
+    help = "Benchmark the product full text search against ILIKE lookups"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--terms", nargs="+", default=["product 4242", "synthetic benchmarking", "42"])
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        total = Product.objects.count()
+        if not total:
+            raise CommandError("No products found, run seed_products first.")
+
+        view = ProductViewSet.as_view({"get": "search"})
+        factory = APIRequestFactory()
+
+        self.stdout.write(f"{total} products")
+        self.stdout.write(f"{'terms':>24} {'search ms':>12} {'ilike ms':>12}")
+        for terms in options["terms"]:
+            search_ms = self.time_it(
+                lambda: self.render(view(factory.get("/api/products/search/", {"q": terms}))),
+                options["repeat"])
+            ilike_ms = self.time_it(lambda: self.ilike(terms), options["repeat"])
+            self.stdout.write(f"{terms:>24} {search_ms:>12.2f} {ilike_ms:>12.2f}")
+
+    def ilike(self, terms):
+        '''
+        The same first page and count done with the ILIKE '%terms%' lookups the admin search_fields run
+        '''
+        queryset = Product.objects.filter(quantity__gt=0).filter(
+            Q(name__icontains=terms) | Q(desc__icontains=terms))
+        list(queryset[:10])
+        queryset.count()
+
+    def render(self, response):
+        if response.status_code != 200:
+            raise CommandError(f"Request failed with status {response.status_code}")
+        response.render()
+
+    def time_it(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
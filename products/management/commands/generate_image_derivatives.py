@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from products.images import generate_derivatives, get_executor
+from products.models import Product, ProductCategory
+
+
+class Command(BaseCommand):
+    '''
+    Generates the missing thumbnails and WebP variants of the images uploaded before the derivative pipeline existed.
+    The generation is idempotent so the command can be re-run safely.
+
+    Usage: python manage.py generate_image_derivatives
+    '''
+    help = "Generate the missing derivatives of the product images and category icons"
+
+    def handle(self, *args, **options):
+        names = set(Product.objects.exclude(image="").values_list("image", flat=True).iterator())
+        names |= set(ProductCategory.objects.exclude(icon="").values_list("icon", flat=True).iterator())
+
+        created = failed = 0
+        futures = {get_executor().submit(generate_derivatives, name): name for name in names}
+        for future, name in futures.items():
+            try:
+                created += len(future.result())
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"{name}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {created} derivatives for {len(names)} images, {failed} images failed"))
@@ -0,0 +1,49 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from products.importers import ProductImporter, get_import_format, iter_rows
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    '''
+    Streams a CSV or NDJSON file of products into the catalog for a seller.
+
+    Usage: python manage.py import_products products.csv --seller seller@example.com
+    '''
+    help = "Bulk import products from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--seller", required=True, help="Email of the seller the products belong to")
+        parser.add_argument("--format", dest="import_format", choices=("csv", "ndjson"),
+                            help="Defaults to the format matching the file extension")
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        import_format = options["import_format"] or get_import_format(options["path"])
+        if import_format is None:
+            raise CommandError("Unknown file format, pass --format csv or --format ndjson.")
+
+        try:
+            seller = User.objects.get(email=options["seller"])
+        except User.DoesNotExist:
+            raise CommandError(f"No user with the email {options['seller']}")
+
+        started = time.perf_counter()
+        with open(options["path"], "rb") as stream:
+            report = ProductImporter(seller, batch_size=options["batch_size"]).run(
+                iter_rows(stream, import_format))
+        elapsed = time.perf_counter() - started
+
+        for error in report["errors"]:
+            self.stderr.write(f"Row {error['row']}: {error['errors']}")
+        if report["error_count"] > len(report["errors"]):
+            self.stderr.write(f"... {report['error_count'] - len(report['errors'])} more row errors")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {report['created']} products, {report['error_count']} rows rejected "
+            f"in {elapsed:.1f}s ({report['created'] / elapsed:.0f} rows/s)"))
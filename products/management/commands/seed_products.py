@@ -0,0 +1,61 @@
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from products.models import Product, ProductCategory
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    '''
+    Seeds the catalog with synthetic products so that the benchmarks can run against a realistically sized table.
+
+    Usage: python manage.py seed_products --count 1000000
+    '''
+    help = "Seed the products table with synthetic products for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=1_000_000)
+        parser.add_argument("--categories", type=int, default=50)
+        parser.add_argument("--batch-size", type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        batch_size = options["batch_size"]
+
+        seller, _ = User.objects.get_or_create(
+            email="benchmark-seller@example.com",
+            defaults={"username": "benchmark-seller"})
+        categories = [
+            ProductCategory.objects.get_or_create(name=f"Benchmark category {i}")[0]
+            for i in range(options["categories"])
+        ]
+
+        started = time.perf_counter()
+        created = 0
+        while created < count:
+            size = min(batch_size, count - created)
+            products = [
+                Product(
+                    seller=seller,
+                    category=categories[i % len(categories)],
+                    name=f"Benchmark product {i}",
+                    desc=f"Synthetic product number {i} used for benchmarking the catalog",
+                    price=Decimal(i % 100_000) / 100,
+                    quantity=i % 20,
+                )
+                for i in range(created, created + size)
+            ]
+            with transaction.atomic():
+                Product.objects.bulk_create(products, batch_size=batch_size)
+            created += size
+            self.stdout.write(f"\r{created}/{count} products", ending="")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write("")
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {created} products in {elapsed:.1f}s ({created / elapsed:.0f} rows/s)"))
@@ -0,0 +1,114 @@
+# Generated by Django 4.0.4 on 2026-10-17 07:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+PRICE_BUCKETS_SQL = "ARRAY[0, 25, 50, 100, 250, 500, 1000]::numeric[]"
+
+# Statement level triggers that apply the per (category, price bucket) deltas of the changed rows
+# in one grouped statement, so bulk_create and queryset.update() cost a single upsert per statement.
+# An UPDATE only writes the counts that really change, in key order: selling a product that stays in stock
+# or editing its price within its bucket doesn't touch the shared facet rows, so the stock changes
+# of a category don't queue, or deadlock, on the same facet row.
+CREATE_TRIGGER_SQL = """
+CREATE FUNCTION products_product_facet_counts_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        INSERT INTO products_productfacetcount (category_id, price_bucket, count)
+        SELECT category_id, price_bucket, sum(count) FROM (
+            SELECT category_id, width_bucket(price, {buckets}) AS price_bucket, -1 AS count
+            FROM old_rows WHERE quantity > 0
+            UNION ALL
+            SELECT category_id, width_bucket(price, {buckets}), 1
+            FROM new_rows WHERE quantity > 0
+        ) AS changes
+        GROUP BY 1, 2 HAVING sum(count) <> 0 ORDER BY 1, 2
+        ON CONFLICT (category_id, price_bucket)
+        DO UPDATE SET count = products_productfacetcount.count + EXCLUDED.count;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE products_productfacetcount AS facet
+        SET count = facet.count - delta.count
+        FROM (
+            SELECT category_id, width_bucket(price, {buckets}) AS price_bucket, count(*) AS count
+            FROM old_rows WHERE quantity > 0 GROUP BY 1, 2
+        ) AS delta
+        WHERE facet.category_id = delta.category_id AND facet.price_bucket = delta.price_bucket;
+    ELSE
+        INSERT INTO products_productfacetcount (category_id, price_bucket, count)
+        SELECT category_id, width_bucket(price, {buckets}), count(*)
+        FROM new_rows WHERE quantity > 0 GROUP BY 1, 2 ORDER BY 1, 2
+        ON CONFLICT (category_id, price_bucket)
+        DO UPDATE SET count = products_productfacetcount.count + EXCLUDED.count;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER products_product_facet_counts_insert
+    AFTER INSERT ON products_product REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION products_product_facet_counts_update();
+
+CREATE TRIGGER products_product_facet_counts_update
+    AFTER UPDATE ON products_product REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION products_product_facet_counts_update();
+
+CREATE TRIGGER products_product_facet_counts_delete
+    AFTER DELETE ON products_product REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION products_product_facet_counts_update();
+""".format(buckets=PRICE_BUCKETS_SQL)
+
+DROP_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS products_product_facet_counts_insert ON products_product;
+DROP TRIGGER IF EXISTS products_product_facet_counts_update ON products_product;
+DROP TRIGGER IF EXISTS products_product_facet_counts_delete ON products_product;
+DROP FUNCTION IF EXISTS products_product_facet_counts_update();
+"""
+
+# Builds the counts of the products that already exist
+BACKFILL_SQL = """
+INSERT INTO products_productfacetcount (category_id, price_bucket, count)
+SELECT category_id, width_bucket(price, {buckets}), count(*)
+FROM products_product WHERE quantity > 0 GROUP BY 1, 2;
+""".format(buckets=PRICE_BUCKETS_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price_bucket', models.PositiveSmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('quantity__gt', 0)), fields=['category', '-created_at', '-id'], name='product_category_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('quantity__gt', 0)), fields=['category', 'price'], name='product_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['seller', '-created_at', '-id'], name='product_seller_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='productfacetcount',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facet_counts', to='products.productcategory'),
+        ),
+        migrations.AddConstraint(
+            model_name='productfacetcount',
+            constraint=models.UniqueConstraint(fields=('category', 'price_bucket'), name='unique_product_facet_count'),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER_SQL, DROP_TRIGGER_SQL),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
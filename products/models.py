@@ -1,6 +1,14 @@
-from django.db import models
+from decimal import Decimal
+
+from django.db import models, transaction
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import get_user_model
+from django.dispatch import receiver
+from django.db.models.signals import post_init, post_save, post_delete
+from .cache import bump_namespace_version, bump_price_versions, PRODUCTS_NAMESPACE, CATEGORIES_NAMESPACE
+from .images import schedule_derivatives
 
 User = get_user_model()
 
@@ -32,6 +40,12 @@ class ProductCategory(models.Model):
         return self.name
 
 
+# Upper-exclusive price boundaries of the price facet buckets, bucket n covers [PRICE_BUCKETS[n-1], PRICE_BUCKETS[n])
+# and the last bucket is open ended. The products_product_facet_counts trigger uses the same boundaries,
+# so changing them needs a migration that recreates the trigger and rebuilds the ProductFacetCount rows.
+PRICE_BUCKETS = (0, 25, 50, 100, 250, 500, 1000)
+
+
 def get_default_product_category():
     return ProductCategory.objects.get_or_create(name="Others")[0]
 
@@ -49,12 +63,128 @@ class Product(models.Model):
     image = models.ImageField(upload_to=get_category_image_path, blank=True)
     price = models.DecimalField(decimal_places=2, max_digits=10)
     quantity = models.IntegerField(default=1)
+    # Weighted tsvector of the name (A) and desc (B) for the full text search.
+    # This is maintained by the products_product_search_vector_trigger database trigger on every INSERT/UPDATE
+    # so that bulk_create and queryset.update() also keep it in sync.
+    search_vector = SearchVectorField(null=True, editable=False)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        ordering = ("-created_at",)
+        # id breaks ties between products created at the same instant, so the ordering is stable for keyset pagination
+        ordering = ("-created_at", "-id")
+        indexes = [
+            # Serves the catalog listing (quantity > 0) in (created_at, id) order without sorting or OFFSET scans
+            models.Index(fields=["-created_at", "-id"], name="product_in_stock_created_idx",
+                         condition=models.Q(quantity__gt=0)),
+            GinIndex(fields=["search_vector"], name="product_search_vector_idx"),
+            # These serve the list filters combined with the catalog ordering
+            models.Index(fields=["category", "-created_at", "-id"], name="product_category_created_idx",
+                         condition=models.Q(quantity__gt=0)),
+            models.Index(fields=["category", "price"], name="product_category_price_idx",
+                         condition=models.Q(quantity__gt=0)),
+            models.Index(fields=["seller", "-created_at", "-id"], name="product_seller_created_idx"),
+        ]
 
     def __str__(self):
         return self.name
+
+
+class ProductFacetCount(models.Model):
+    '''
+    Number of in stock products per category and price bucket.
+
+    The rows are maintained incrementally by the products_product_facet_counts database triggers
+    whenever products are inserted, updated or deleted, so the facet counts of the product list
+    are read from this small table instead of running a GROUP BY over the products on every request.
+    '''
+    category = models.ForeignKey(
+        ProductCategory, related_name="facet_counts", on_delete=models.CASCADE)
+    # Index of the price bucket as returned by width_bucket(price, PRICE_BUCKETS)
+    price_bucket = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["category", "price_bucket"], name="unique_product_facet_count"),
+        ]
+
+    def __str__(self):
+        return f"{self.count} products in {self.category_id} priced in bucket {self.price_bucket}"
+
+
+# ********************** THIS SECTION CONTAINS THE SIGNALS CODE **********************
+# Any change of a product or category moves the cached catalog responses to a new version.
+# The product responses contain the category name, so a category change invalidates both namespaces.
+# queryset.update() and bulk_create() do not send these signals, code using them must call bump_namespace_version itself.
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_responses(sender, instance, **kwargs):
+    bump_namespace_version(PRODUCTS_NAMESPACE)
+
+
+@receiver([post_save, post_delete], sender=ProductCategory)
+def invalidate_category_responses(sender, instance, **kwargs):
+    bump_namespace_version(CATEGORIES_NAMESPACE)
+    bump_namespace_version(PRODUCTS_NAMESPACE)
+
+
+# The cart summaries are computed from the prices, a product is moved to a new price version
+# only when its price changes, so the stock updates and the other edits keep them.
+@receiver(post_init, sender=Product)
+def track_product_price(sender, instance, **kwargs):
+    instance._saved_price = instance.__dict__.get("price")
+
+
+@receiver(post_save, sender=Product)
+def invalidate_product_price(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and "price" not in update_fields):
+        return
+    price, saved_price = instance.__dict__.get("price"), instance._saved_price
+    if price is not None and saved_price is not None and Decimal(str(price)) == Decimal(str(saved_price)):
+        return
+    instance._saved_price = price
+    bump_price_versions([instance.pk])
+
+
+# The thumbnails and WebP variants of the uploaded images are generated by the worker pool of products.images
+# once the transaction commits, so the upload request returns without waiting for the resizing.
+# Only a new image is scheduled: the name loaded with the instance is kept, so the full save() of a price
+# or stock update doesn't queue the jobs again.
+def track_image_name(instance, field_name):
+    # Read from __dict__ so the file descriptor is not involved and a deferred image is not loaded
+    if field_name in instance.__dict__:
+        value = instance.__dict__[field_name]
+        instance._saved_image_name = getattr(value, "name", value)
+
+
+def schedule_image_derivatives(instance, field_name, update_fields):
+    image = getattr(instance, field_name)
+    if not image or (update_fields is not None and field_name not in update_fields):
+        return
+    name = image.name
+    if name == getattr(instance, "_saved_image_name", None):
+        return
+    instance._saved_image_name = name
+    transaction.on_commit(lambda: schedule_derivatives(name))
+
+
+@receiver(post_init, sender=Product)
+def track_product_image_name(sender, instance, **kwargs):
+    track_image_name(instance, "image")
+
+
+@receiver(post_init, sender=ProductCategory)
+def track_category_icon_name(sender, instance, **kwargs):
+    track_image_name(instance, "icon")
+
+
+@receiver(post_save, sender=Product)
+def generate_product_image_derivatives(sender, instance, update_fields=None, **kwargs):
+    schedule_image_derivatives(instance, "image", update_fields)
+
+
+@receiver(post_save, sender=ProductCategory)
+def generate_category_icon_derivatives(sender, instance, update_fields=None, **kwargs):
+    schedule_image_derivatives(instance, "icon", update_fields)
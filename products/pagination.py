@@ -0,0 +1,123 @@
+import base64
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class ProductKeysetPagination(BasePagination):
+    '''
+    Keyset (cursor) pagination for the product catalog, keyed on (created_at, id).
+
+    Unlike PageNumberPagination this never runs a COUNT(*) and never uses OFFSET,
+    every page is a `WHERE (created_at, id) < (<cursor>) ORDER BY created_at DESC, id DESC LIMIT n`
+    which is served straight from the products_product (created_at, id) index, so the latency stays flat at any depth.
+    '''
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = "cursor"
+    invalid_cursor_message = _("Invalid cursor")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+
+        # Fetching one extra row tells us whether there is another page without counting the table
+        results = list(self.get_page_queryset(queryset, request))
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if self.cursor is not None and self.cursor[2]:
+            results.reverse()
+            self.has_previous = has_more
+            self.has_next = True
+        else:
+            self.has_next = has_more
+            self.has_previous = self.cursor is not None
+
+        self.page = results
+        return results
+
+    def get_page_queryset(self, queryset, request):
+        '''
+        Returns the rows of the requested page in the cursor order, followed by the first row after it
+        '''
+        self.cursor = self.decode_cursor(request)
+
+        if self.cursor is None:
+            queryset = queryset.order_by("-created_at", "-id")
+        else:
+            created_at, pk, reverse = self.cursor
+            if reverse:
+                # Walking backwards: fetch the rows right after the cursor in ascending order and flip them afterwards
+                queryset = queryset.filter(
+                    Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+                ).order_by("created_at", "id")
+            else:
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                ).order_by("-created_at", "-id")
+
+        return queryset[:self.page_size + 1]
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "previous": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        last = self.page[-1]
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   self.encode_cursor(last.created_at, last.id))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        first = self.page[0]
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   self.encode_cursor(first.created_at, first.id, reverse=True))
+
+    def encode_cursor(self, created_at, pk, reverse=False):
+        '''
+        Returns an opaque cursor string for the given (created_at, id) position
+        '''
+        raw = f"{created_at.isoformat()}|{pk}|{int(reverse)}"
+        return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii")
+
+    def decode_cursor(self, request):
+        '''
+        Returns a (created_at, id, reverse) tuple from the request or None for the first page
+        '''
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode("ascii")).decode("ascii")
+            created_at, pk, reverse = raw.split("|")
+            created_at = parse_datetime(created_at)
+            if created_at is None:
+                raise ValueError(encoded)
+            return created_at, int(pk), bool(int(reverse))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
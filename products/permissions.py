@@ -1,9 +1,15 @@
-from rest_framework.permissions import BasePermission, SAFE_METHODS
+from rest_framework.permissions import BasePermission
 
 
 class IsSellerOrAdmin(BasePermission):
+    '''
+    Check if the product is owned by the seller or the user is an admin
+    '''
+
     def has_permission(self, request, view):
         return request.user.is_authenticated is True
 
     def has_object_permission(self, request, view, obj):
-        return request.method in SAFE_METHODS and (obj.seller == request.user or request.user.is_admin)
+        # Only used for the updates and the deletes of the products, the reads are open to everybody.
+        # Compares the ids so the seller of the product is not loaded, the users have no is_admin flag
+        return obj.seller_id == request.user.id or request.user.is_staff
@@ -1,15 +1,23 @@
 from .models import Product, ProductCategory
 from rest_framework import serializers
+from django.utils.translation import gettext_lazy as _
+from .images import get_derivative_urls
 
 
 class ProductCategorySerializer(serializers.ModelSerializer):
     '''
     Serializer to serialize product categories
     '''
+    # URLs of the thumbnail and WebP variants of the icon generated in the background, see products.images
+    icon_derivatives = serializers.SerializerMethodField()
+
     class Meta:
         model = ProductCategory
         fields = "__all__"
 
+    def get_icon_derivatives(self, obj):
+        return get_derivative_urls(obj.icon, self.context.get("request"))
+
 
 class ProductReadSerializer(serializers.ModelSerializer):
     '''
@@ -21,10 +29,29 @@ class ProductReadSerializer(serializers.ModelSerializer):
     # since we have the category instance inside the category we can access the names through category.name
     # if the serializer name was category_instance then to extract name we would write category_instance.name
     category = serializers.CharField(source="category.name", read_only=True)
+    # URLs of the thumbnail and WebP variants of the image generated in the background, see products.images
+    image_derivatives = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
-        fields = "__all__"
+        # search_vector is only used internally by the full text search
+        exclude = ("search_vector",)
+
+    def get_image_derivatives(self, obj):
+        return get_derivative_urls(obj.image, self.context.get("request"))
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        '''
+        Joins the seller and category into the product query and loads only the columns this serializer reads,
+        so serializing a page of products takes a single query instead of one seller and one category query per product.
+        '''
+        return queryset.select_related("seller", "category").only(
+            "id", "name", "desc", "image", "price", "quantity", "created_at", "updated_at",
+            # get_full_name() falls back to the username when the first or last name is missing
+            "seller__firstname", "seller__lastname", "seller__username",
+            "category__name",
+        )
 
 
 class ProductWriteSerializer(serializers.ModelSerializer):
@@ -75,3 +102,30 @@ class ProductWriteSerializer(serializers.ModelSerializer):
             category_serializer.update(
                 category_instance, category_updated_data)
         return super().update(instance, validated_data)
+
+
+class ProductImportRowSerializer(serializers.Serializer):
+    '''
+    Validates one row of a bulk product import (CSV or NDJSON).
+
+    The category is given by name and is resolved to a ProductCategory once per distinct name by the importer.
+    '''
+    name = serializers.CharField(max_length=200)
+    desc = serializers.CharField(max_length=300)
+    category = serializers.CharField(max_length=100)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    quantity = serializers.IntegerField(min_value=0, default=1)
+
+
+class ProductBulkUpdateRowSerializer(serializers.Serializer):
+    '''
+    Validates one {id, price?, quantity?} record of a bulk price and stock update
+    '''
+    id = serializers.IntegerField(min_value=1)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0, required=False)
+    quantity = serializers.IntegerField(min_value=0, required=False)
+
+    def validate(self, attrs):
+        if "price" not in attrs and "quantity" not in attrs:
+            raise serializers.ValidationError(_("Either price or quantity is required."))
+        return attrs
@@ -1,3 +1,784 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import shutil
+import tempfile
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+
+from .models import Product, ProductCategory
+from .serializers import ProductReadSerializer
+from .utils import get_facet_counts, bulk_update_products
+from .importers import ProductImporter, iter_rows
+from .images import generate_derivatives, get_derivative_urls
+from .cache import get_cache_stats, get_namespace_version, PRODUCTS_NAMESPACE, CATEGORIES_NAMESPACE
+
+User = get_user_model()
+
+
+class ProductKeysetPaginationTests(TestCase):
+    '''
+    Tests for the opt-in cursor pagination mode of the product list (?pagination=cursor)
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.category = ProductCategory.objects.create(name="Electronics")
+        cls.products = [
+            Product.objects.create(seller=cls.seller, category=cls.category, name=f"Product {i}",
+                                   desc="desc", price="10.00", quantity=5)
+            for i in range(25)
+        ]
+        # A product that is out of stock should never be listed
+        Product.objects.create(seller=cls.seller, category=cls.category, name="Sold out",
+                               desc="desc", price="10.00", quantity=0)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_walks_every_product_once_in_catalog_order(self):
+        expected = list(Product.objects.filter(quantity__gt=0).values_list("id", flat=True))
+        seen = []
+        url = "/api/products/?pagination=cursor"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            seen += [product["id"] for product in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(seen, expected)
+
+    def test_previous_link_returns_the_previous_page(self):
+        first = self.client.get("/api/products/?pagination=cursor")
+        second = self.client.get(first.data["next"])
+        back = self.client.get(second.data["previous"])
+        self.assertEqual(back.data["results"], first.data["results"])
+        self.assertIsNone(first.data["previous"])
+
+    def test_does_not_count_the_catalog(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/api/products/?pagination=cursor")
+        self.assertFalse(any("COUNT(" in query["sql"] for query in queries.captured_queries))
+
+    def test_invalid_cursor_returns_not_found(self):
+        response = self.client.get("/api/products/?pagination=cursor&cursor=garbage")
+        self.assertEqual(response.status_code, 404)
+
+    def test_page_number_pagination_stays_the_default(self):
+        response = self.client.get("/api/products/")
+        self.assertEqual(response.data["count"], 25)
+
+
+class ProductSearchTests(TestCase):
+    '''
+    Tests for the full text search endpoint /api/products/search/
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        cls.headphones = Product.objects.create(
+            seller=seller, category=category, name="Wireless headphones",
+            desc="Over ear with noise cancelling", price="99.00", quantity=3)
+        cls.speaker = Product.objects.create(
+            seller=seller, category=category, name="Bluetooth speaker",
+            desc="Pairs with wireless headphones", price="49.00", quantity=3)
+        cls.cable = Product.objects.create(
+            seller=seller, category=category, name="Audio cable",
+            desc="3.5mm jack", price="5.00", quantity=3)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def search(self, terms):
+        response = self.client.get("/api/products/search/", {"q": terms})
+        self.assertEqual(response.status_code, 200)
+        return [product["id"] for product in response.data["results"]]
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search("headphones"), [self.headphones.id, self.speaker.id])
+
+    def test_matches_word_stems(self):
+        self.assertEqual(self.search("cables"), [self.cable.id])
+
+    def test_vector_is_updated_on_save(self):
+        self.cable.name = "Headphone extension"
+        self.cable.save()
+        self.assertIn(self.cable.id, self.search("extension"))
+
+    def test_vector_is_updated_by_queryset_update(self):
+        Product.objects.filter(id=self.cable.id).update(desc="Gold plated connector")
+        self.assertEqual(self.search("gold"), [self.cable.id])
+
+    def test_out_of_stock_products_are_not_returned(self):
+        Product.objects.filter(id=self.speaker.id).update(quantity=0)
+        self.assertEqual(self.search("headphones"), [self.headphones.id])
+
+    def test_search_terms_are_required(self):
+        response = self.client.get("/api/products/search/")
+        self.assertEqual(response.status_code, 400)
+
+
+class ProductFacetTests(TestCase):
+    '''
+    Tests for the product list filters and the incrementally maintained facet counts
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.other_seller = User.objects.create_user(
+            email="other@example.com", username="other", password="password")
+        cls.audio = ProductCategory.objects.create(name="Audio")
+        cls.video = ProductCategory.objects.create(name="Video")
+        cls.cable = Product.objects.create(seller=cls.seller, category=cls.audio, name="Cable",
+                                           desc="desc", price="5.00", quantity=3)
+        cls.speaker = Product.objects.create(seller=cls.seller, category=cls.audio, name="Speaker",
+                                             desc="desc", price="60.00", quantity=3)
+        cls.tv = Product.objects.create(seller=cls.other_seller, category=cls.video, name="TV",
+                                        desc="desc", price="1500.00", quantity=3)
+        cls.sold_out = Product.objects.create(seller=cls.seller, category=cls.video, name="Projector",
+                                              desc="desc", price="700.00", quantity=0)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def list_ids(self, **params):
+        response = self.client.get("/api/products/", params)
+        self.assertEqual(response.status_code, 200)
+        return {product["id"] for product in response.data["results"]}
+
+    def facets(self):
+        return self.client.get("/api/products/").data["facets"]
+
+    def price_counts(self):
+        return [bucket["count"] for bucket in self.facets()["price"]]
+
+    def test_filters(self):
+        self.assertEqual(self.list_ids(category=self.audio.id), {self.cable.id, self.speaker.id})
+        self.assertEqual(self.list_ids(seller=self.other_seller.id), {self.tv.id})
+        self.assertEqual(self.list_ids(min_price="10", max_price="100"), {self.speaker.id})
+        self.assertEqual(self.list_ids(in_stock="false"), {self.sold_out.id})
+        self.assertEqual(self.list_ids(category=f"{self.audio.id},{self.video.id}", max_price="50"),
+                         {self.cable.id})
+
+    def test_invalid_filters_are_rejected(self):
+        response = self.client.get("/api/products/", {"category": "abc", "min_price": "cheap"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {"category", "min_price"})
+
+    def test_facet_counts(self):
+        facets = self.facets()
+        self.assertEqual(facets["categories"], [
+            {"id": self.audio.id, "name": "Audio", "count": 2},
+            {"id": self.video.id, "name": "Video", "count": 1},
+        ])
+        self.assertEqual(facets["price"][0], {"min": 0, "max": 25, "count": 1})
+        self.assertEqual(facets["price"][-1], {"min": 1000, "max": None, "count": 1})
+        self.assertEqual(self.price_counts(), [1, 0, 1, 0, 0, 0, 1])
+
+    def test_facet_counts_follow_product_changes(self):
+        self.speaker.price = "300.00"
+        self.speaker.save()
+        Product.objects.filter(id=self.sold_out.id).update(quantity=4)
+        Product.objects.bulk_create([
+            Product(seller=self.seller, category=self.video, name=f"Bulk {i}",
+                    desc="desc", price="10.00", quantity=1)
+            for i in range(3)
+        ])
+        self.tv.delete()
+        Product.objects.filter(id=self.cable.id).update(quantity=0)
+
+        self.assertEqual(self.price_counts(), [3, 0, 0, 0, 1, 1, 0])
+        self.assertEqual([category["count"] for category in self.facets()["categories"]], [1, 4])
+
+    def test_facet_counts_use_a_single_query(self):
+        with self.assertNumQueries(1):
+            get_facet_counts()
+
+    def test_prices_below_the_first_bucket_are_left_out_of_the_price_facet(self):
+        Product.objects.create(seller=self.seller, category=self.audio, name="Refund",
+                               desc="desc", price="-5.00", quantity=1)
+        facets = self.facets()
+        self.assertEqual([bucket["count"] for bucket in facets["price"]], [1, 0, 1, 0, 0, 0, 1])
+        self.assertEqual(facets["categories"][0]["count"], 3)
+
+    def test_stock_changes_within_a_bucket_dont_write_the_facet_rows(self):
+        def facet_row_versions():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT id, ctid FROM products_productfacetcount ORDER BY id")
+                return cursor.fetchall()
+
+        versions = facet_row_versions()
+        # Sales and restocks that keep the product in stock, a price edit within its bucket
+        Product.objects.filter(id=self.speaker.id).update(quantity=1)
+        Product.objects.filter(id__in=[self.cable.id, self.tv.id]).update(quantity=10)
+        Product.objects.filter(id=self.speaker.id).update(price="70.00")
+        self.assertEqual(facet_row_versions(), versions)
+
+        Product.objects.filter(id=self.speaker.id).update(quantity=0)
+        self.assertNotEqual(facet_row_versions(), versions)
+        self.assertEqual(self.price_counts(), [1, 0, 0, 0, 0, 0, 1])
+
+
+class ProductReadQueryCountTests(TestCase):
+    '''
+    Regression tests that pin the number of queries of the product read actions,
+    they must not grow with the number of products, sellers or categories on the page.
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(10):
+            seller = User.objects.create_user(
+                email=f"seller{i}@example.com", username=f"seller{i}", password="password",
+                firstname="Seller", lastname=str(i))
+            category = ProductCategory.objects.create(name=f"Category {i}")
+            Product.objects.create(seller=seller, category=category, name=f"Product {i}",
+                                   desc="searchable product", price="10.00", quantity=5)
+        cls.product = Product.objects.first()
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_list(self):
+        # count, page and facet counts
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/products/")
+        self.assertEqual(response.data["results"][0]["seller"], "Seller 9")
+        self.assertEqual(response.data["results"][0]["category"], "Category 9")
+
+    def test_cursor_list(self):
+        # page and facet counts
+        with self.assertNumQueries(2):
+            self.client.get("/api/products/?pagination=cursor")
+
+    def test_retrieve(self):
+        # etag aggregate and product
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/products/{self.product.id}/")
+        self.assertEqual(response.data["seller"], self.product.seller.get_full_name())
+
+    def test_search(self):
+        # count and page
+        with self.assertNumQueries(2):
+            self.client.get("/api/products/search/", {"q": "searchable"})
+
+    def test_only_serialized_columns_are_loaded(self):
+        product = ProductReadSerializer.setup_eager_loading(Product.objects.all()).first()
+        self.assertEqual(product.get_deferred_fields(), {"search_vector"})
+        self.assertNotIn("password", product.seller.__dict__)
+
+
+class CatalogResponseCacheTests(TestCase):
+    '''
+    Tests for the versioned cache of the anonymous catalog responses
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.category = ProductCategory.objects.create(name="Audio")
+        cls.product = Product.objects.create(seller=cls.seller, category=cls.category, name="Speaker",
+                                             desc="desc", price="60.00", quantity=3)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_anonymous_list_is_served_from_the_cache(self):
+        first = self.client.get("/api/products/")
+        with self.assertNumQueries(0):
+            second = self.client.get("/api/products/")
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(get_cache_stats(PRODUCTS_NAMESPACE), {"hits": 1, "misses": 1})
+
+    def test_query_parameters_are_part_of_the_key(self):
+        self.client.get("/api/products/")
+        response = self.client.get("/api/products/", {"in_stock": "false"})
+        self.assertEqual(response.data["count"], 0)
+        self.assertEqual(get_cache_stats(PRODUCTS_NAMESPACE), {"hits": 0, "misses": 2})
+
+    def test_saving_a_product_invalidates_the_cached_responses(self):
+        self.client.get(f"/api/products/{self.product.id}/")
+        version = get_namespace_version(PRODUCTS_NAMESPACE)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Loud speaker"
+            self.product.save()
+            # A read before the commit sees the old rows, they must not be cached under the new version
+            self.assertEqual(get_namespace_version(PRODUCTS_NAMESPACE), version)
+        self.assertNotEqual(get_namespace_version(PRODUCTS_NAMESPACE), version)
+        response = self.client.get(f"/api/products/{self.product.id}/")
+        self.assertEqual(response.data["name"], "Loud speaker")
+
+    def test_deleting_a_product_invalidates_the_cached_responses(self):
+        self.client.get("/api/products/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.delete()
+        self.assertEqual(self.client.get("/api/products/").data["count"], 0)
+
+    def test_saving_a_category_invalidates_categories_and_products(self):
+        self.client.get("/api/products/categories/")
+        self.client.get("/api/products/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = "Sound"
+            self.category.save()
+        self.assertEqual(self.client.get("/api/products/categories/").data["results"][0]["name"], "Sound")
+        self.assertEqual(self.client.get("/api/products/").data["results"][0]["category"], "Sound")
+        self.assertEqual(get_cache_stats(CATEGORIES_NAMESPACE), {"hits": 0, "misses": 2})
+
+    def test_evicted_version_does_not_resurrect_old_responses(self):
+        self.client.get("/api/products/")
+        cache.delete("catalog:version:products")
+        Product.objects.filter(id=self.product.id).update(name="Renamed")
+        self.assertEqual(self.client.get("/api/products/").data["results"][0]["name"], "Renamed")
+
+    def test_authenticated_requests_are_not_cached(self):
+        self.client.force_authenticate(self.seller)
+        self.client.get("/api/products/")
+        self.client.get("/api/products/")
+        self.assertEqual(get_cache_stats(PRODUCTS_NAMESPACE), {"hits": 0, "misses": 0})
+
+
+class ProductConditionalGetTests(TestCase):
+    '''
+    Tests for the ETag and If-None-Match support of the product list and retrieve actions
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        cls.product = Product.objects.create(seller=seller, category=category, name="Speaker",
+                                             desc="desc", price="60.00", quantity=3)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_unchanged_product_returns_not_modified_without_serializing(self):
+        url = f"/api/products/{self.product.id}/"
+        etag = self.client.get(url)["ETag"]
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_changed_product_returns_the_new_body(self):
+        url = f"/api/products/{self.product.id}/"
+        etag = self.client.get(url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = "70.00"
+            self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["price"], "70.00")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_list_is_tagged_with_the_catalog_version(self):
+        etag = self.client.get("/api/products/")["ETag"]
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get("/api/products/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertNotEqual(self.client.get("/api/products/?page=1")["ETag"], etag)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(seller=self.product.seller, category=self.product.category, name="Cable",
+                                   desc="desc", price="5.00", quantity=3)
+        self.assertEqual(self.client.get("/api/products/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_unknown_and_malformed_products_are_not_found(self):
+        self.assertEqual(self.client.get("/api/products/0/", HTTP_IF_NONE_MATCH="*").status_code, 404)
+        self.assertEqual(self.client.get("/api/products/abc/").status_code, 404)
+
+
+class ProductBulkImportTests(TestCase):
+    '''
+    Tests for the streaming bulk product import /api/products/import/
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.audio = ProductCategory.objects.create(name="Audio")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def upload(self, name, content):
+        return self.client.post("/api/products/import/", {"file": SimpleUploadedFile(name, content.encode())},
+                                format="multipart")
+
+    def test_csv_import(self):
+        content = (
+            "name,desc,category,price,quantity\n"
+            "Speaker,Loud,Audio,60.00,3\n"
+            "Cable,Long,Accessories,5,10\n"
+            "Broken,Bad price,Audio,cheap,1\n"
+            ",No name,Audio,1.00,1\n"
+        )
+        response = self.upload("products.csv", content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(response.data["error_count"], 2)
+        self.assertEqual([error["row"] for error in response.data["errors"]], [3, 4])
+        self.assertIn("price", response.data["errors"][0]["errors"])
+
+        speaker = Product.objects.get(name="Speaker")
+        self.assertEqual((speaker.seller, speaker.category, speaker.quantity), (self.seller, self.audio, 3))
+        self.assertEqual(Product.objects.get(name="Cable").category.name, "Accessories")
+
+    def test_ndjson_import(self):
+        content = (
+            '{"name": "Speaker", "desc": "Loud", "category": "Audio", "price": "60.00", "quantity": 3}\n'
+            "\n"
+            "not json\n"
+            '["not", "an", "object"]\n'
+        )
+        response = self.upload("products.ndjson", content)
+        self.assertEqual(response.data["created"], 1)
+        self.assertEqual([error["row"] for error in response.data["errors"]], [2, 3])
+
+    def test_imported_products_are_searchable_and_counted(self):
+        self.upload("products.csv", "name,desc,category,price,quantity\nSpeaker,Loud,Audio,60.00,3\n")
+        self.assertEqual(self.client.get("/api/products/search/", {"q": "loud"}).data["count"], 1)
+        self.assertEqual(get_facet_counts()["categories"][0]["count"], 1)
+
+    def test_categories_are_resolved_once_per_batch(self):
+        rows = "".join(f"Product {i},desc,Category {i % 3},1.00,1\n" for i in range(100))
+        # savepoint, new categories lookup, categories insert, products copy and savepoint release
+        with self.assertNumQueries(5):
+            ProductImporter(self.seller, batch_size=100).run(
+                iter_rows(io.BytesIO(("name,desc,category,price,quantity\n" + rows).encode()), "csv"))
+        self.assertEqual(ProductCategory.objects.filter(name__startswith="Category").count(), 3)
+
+    def test_rows_that_are_not_utf8_are_reported(self):
+        for name, content in (
+            ("products.csv", "name,desc,category,price,quantity\nCafé,desc,Audio,1.00,1\nTV,desc,Audio,9.00,1\n"),
+            ("products.ndjson", '{"name": "Café", "desc": "desc", "category": "Audio", "price": "1.00", '
+                                '"quantity": 1}\n'),
+        ):
+            response = self.client.post(
+                "/api/products/import/", {"file": SimpleUploadedFile(name, content.encode("latin-1"))},
+                format="multipart")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data["errors"][0]["row"], 1)
+            self.assertEqual(response.data["errors"][0]["errors"]["non_field_errors"],
+                             ["The row is not UTF-8 encoded."])
+        self.assertFalse(Product.objects.filter(name__startswith="Caf").exists())
+        self.assertTrue(Product.objects.filter(name="TV").exists())
+
+    def test_categories_of_a_failed_batch_are_forgotten(self):
+        importer = ProductImporter(self.seller)
+        rows = [{"name": "Speaker", "desc": "desc", "category": "New", "price": "1.00", "quantity": 1}]
+        with mock.patch.object(importer, "copy_products", side_effect=RuntimeError("copy failed")):
+            with self.assertRaises(RuntimeError):
+                importer.run(rows)
+        self.assertEqual(importer.category_ids, {})
+
+        self.assertEqual(importer.run(rows)["created"], 1)
+        self.assertEqual(Product.objects.get(name="Speaker").category.name, "New")
+
+    def test_unsupported_files_are_rejected(self):
+        self.assertEqual(self.upload("products.xlsx", "").status_code, 400)
+        self.assertEqual(self.client.post("/api/products/import/").status_code, 400)
+
+    def test_anonymous_users_can_not_import(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.upload("products.csv", "name\n").status_code, 401)
+
+
+class ProductBulkUpdateTests(TestCase):
+    '''
+    Tests for the bulk price and stock update /api/products/bulk-update/
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.other_seller = User.objects.create_user(
+            email="other@example.com", username="other", password="password")
+        cls.staff = User.objects.create_user(
+            email="staff@example.com", username="staff", password="password", is_staff=True)
+        category = ProductCategory.objects.create(name="Audio")
+        cls.speaker = Product.objects.create(seller=cls.seller, category=category, name="Speaker",
+                                             desc="desc", price="60.00", quantity=3)
+        cls.cable = Product.objects.create(seller=cls.seller, category=category, name="Cable",
+                                           desc="desc", price="5.00", quantity=10)
+        cls.tv = Product.objects.create(seller=cls.other_seller, category=category, name="TV",
+                                        desc="desc", price="900.00", quantity=1)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def bulk_update(self, records):
+        return self.client.patch("/api/products/bulk-update/", records, format="json")
+
+    def test_updates_only_the_given_fields(self):
+        response = self.bulk_update([
+            {"id": self.speaker.id, "price": "55.50"},
+            {"id": self.cable.id, "quantity": 0},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"updated": 2, "not_updated": []})
+
+        self.speaker.refresh_from_db()
+        self.cable.refresh_from_db()
+        self.assertEqual((str(self.speaker.price), self.speaker.quantity), ("55.50", 3))
+        self.assertEqual((str(self.cable.price), self.cable.quantity), ("5.00", 0))
+
+    def test_other_sellers_products_are_not_updated(self):
+        response = self.bulk_update([
+            {"id": self.speaker.id, "quantity": 1},
+            {"id": self.tv.id, "quantity": 50},
+            {"id": 999999, "quantity": 50},
+        ])
+        self.assertEqual(response.data, {"updated": 1, "not_updated": [self.tv.id, 999999]})
+        self.tv.refresh_from_db()
+        self.assertEqual(self.tv.quantity, 1)
+
+    def test_staff_can_update_any_product(self):
+        self.client.force_authenticate(self.staff)
+        response = self.bulk_update([{"id": self.tv.id, "price": "850.00"}])
+        self.assertEqual(response.data["updated"], 1)
+
+    def test_one_statement_per_chunk(self):
+        records = [{"id": self.speaker.id, "quantity": 2}, {"id": self.cable.id, "quantity": 2}]
+        with self.assertNumQueries(2):
+            bulk_update_products(records, self.seller, chunk_size=1)
+
+    def test_invalid_records_are_rejected(self):
+        response = self.bulk_update([{"id": self.speaker.id}, {"id": self.cable.id, "quantity": -1}])
+        self.assertEqual(response.status_code, 400)
+        self.speaker.refresh_from_db()
+        self.assertEqual(self.speaker.quantity, 3)
+
+    def test_updates_refresh_caches_and_facets(self):
+        self.client.force_authenticate(None)
+        self.client.get("/api/products/")
+        etag = self.client.get(f"/api/products/{self.speaker.id}/")["ETag"]
+        self.client.force_authenticate(self.seller)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bulk_update([{"id": self.cable.id, "quantity": 0}, {"id": self.speaker.id, "price": "1500"}])
+        self.client.force_authenticate(None)
+
+        response = self.client.get("/api/products/")
+        self.assertEqual(response.data["count"], 2)
+        self.assertEqual([bucket["count"] for bucket in response.data["facets"]["price"]], [0, 0, 0, 0, 0, 1, 1])
+        self.assertEqual(self.client.get(f"/api/products/{self.speaker.id}/",
+                                         HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class ProductPermissionTests(TestCase):
+    '''
+    Tests for the updates and deletes of a product by its seller, the other sellers and the staff
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.other_seller = User.objects.create_user(
+            email="other@example.com", username="other", password="password")
+        cls.staff = User.objects.create_user(
+            email="staff@example.com", username="staff", password="password", is_staff=True)
+        cls.category = ProductCategory.objects.create(name="Audio")
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.product = Product.objects.create(seller=self.seller, category=self.category, name="Speaker",
+                                              desc="desc", price="60.00", quantity=3)
+        self.url = f"/api/products/{self.product.id}/"
+
+    def test_sellers_can_not_change_the_products_of_other_sellers(self):
+        self.client.force_authenticate(self.other_seller)
+        self.assertEqual(self.client.patch(self.url, {"price": "1.00"}).status_code, 403)
+        self.assertEqual(self.client.delete(self.url).status_code, 403)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).price, Decimal("60.00"))
+
+    def test_sellers_change_their_own_products(self):
+        self.client.force_authenticate(self.seller)
+        self.assertEqual(self.client.patch(self.url, {"price": "55.00"}).status_code, 200)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).price, Decimal("55.00"))
+        self.assertEqual(self.client.delete(self.url).status_code, 204)
+        self.assertFalse(Product.objects.filter(pk=self.product.pk).exists())
+
+    def test_staff_can_delete_any_product(self):
+        self.client.force_authenticate(self.staff)
+        self.assertEqual(self.client.delete(self.url).status_code, 204)
+
+    def test_anonymous_users_can_only_read(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.client.delete(self.url).status_code, 401)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImageDerivativeTests(TestCase):
+    '''
+    Tests for the thumbnail and WebP derivatives of the product images
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.category = ProductCategory.objects.create(name="Audio")
+
+    def setUp(self):
+        cache.clear()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def make_image(self, name, size=(1200, 800)):
+        buffer = io.BytesIO()
+        Image.new("RGB", size, "red").save(buffer, format="JPEG")
+        return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_generates_resized_and_webp_variants_once(self):
+        name = self.make_image("products/tv.jpg")
+        created = generate_derivatives(name)
+        self.assertEqual(sorted(created), [
+            "products/derivatives/tv_medium.jpg", "products/derivatives/tv_medium.webp",
+            "products/derivatives/tv_thumbnail.jpg", "products/derivatives/tv_thumbnail.webp",
+        ])
+        with default_storage.open("products/derivatives/tv_thumbnail.webp") as f:
+            thumbnail = Image.open(f)
+            self.assertEqual((thumbnail.format, thumbnail.size), ("WEBP", (200, 133)))
+
+        self.assertEqual(generate_derivatives(name), [])
+
+    def test_saving_an_image_schedules_the_derivatives_after_commit(self):
+        with mock.patch("products.models.schedule_derivatives") as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                product = Product.objects.create(
+                    seller=self.seller, category=self.category, name="TV", desc="desc", price="10.00",
+                    image=SimpleUploadedFile("tv.jpg", b"not really an image"))
+            schedule.assert_called_once_with(product.image.name)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                product.save(update_fields=["price"])
+                # A full save of the unchanged image, like the serializer updates of the price or stock
+                product.quantity = 5
+                product.save()
+                Product.objects.get(pk=product.pk).save()
+                Product.objects.only("id", "price").get(pk=product.pk).save()
+            schedule.assert_called_once()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                product = Product.objects.get(pk=product.pk)
+                product.image = SimpleUploadedFile("tv2.jpg", b"not really an image")
+                product.save()
+            schedule.assert_called_with(product.image.name)
+            self.assertEqual(schedule.call_count, 2)
+
+    def test_serializer_exposes_the_derivative_urls(self):
+        name = self.make_image("products/monitor.jpg")
+        product = Product.objects.create(seller=self.seller, category=self.category, name="TV",
+                                         desc="desc", price="10.00", image=name)
+        response = APIClient().get(f"/api/products/{product.id}/")
+        self.assertEqual(set(response.data["image_derivatives"]),
+                         {"thumbnail", "thumbnail_webp", "medium", "medium_webp"})
+        # The derivatives are not generated yet, the original image is used meanwhile
+        self.assertEqual(response.data["image_derivatives"]["thumbnail_webp"],
+                         "http://testserver/media/" + name)
+
+        generate_derivatives(name)
+        cache.clear()
+        response = APIClient().get(f"/api/products/{product.id}/")
+        self.assertEqual(response.data["image_derivatives"]["thumbnail_webp"],
+                         "http://testserver/media/products/derivatives/monitor_thumbnail.webp")
+
+    def test_generated_derivatives_are_marked_ready(self):
+        name = self.make_image("products/radio.jpg")
+        product = Product(image=name)
+        with mock.patch.object(default_storage, "exists", wraps=default_storage.exists) as exists:
+            self.assertEqual(get_derivative_urls(product.image)["medium"], default_storage.url(name))
+            self.assertEqual(exists.call_count, 4)
+            # The missing derivatives are remembered for a while
+            get_derivative_urls(product.image)
+            self.assertEqual(exists.call_count, 4)
+
+        generate_derivatives(name)
+        with mock.patch.object(default_storage, "exists") as exists:
+            self.assertEqual(get_derivative_urls(product.image)["medium"],
+                             default_storage.url("products/derivatives/radio_medium.jpg"))
+            exists.assert_not_called()
+
+
+class ProductExportTests(TestCase):
+    '''
+    Tests for the streaming catalog export /api/products/export/
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(
+            email="seller@example.com", username="seller", password="password")
+        cls.audio = ProductCategory.objects.create(name="Audio")
+        video = ProductCategory.objects.create(name="Video")
+        cls.speaker = Product.objects.create(seller=seller, category=cls.audio, name="Speaker",
+                                             desc='Loud, "bass"', price="60.00", quantity=3)
+        cls.tv = Product.objects.create(seller=seller, category=video, name="TV", desc="desc",
+                                        price="900.00", quantity=1, image="products/tv.jpg")
+        Product.objects.create(seller=seller, category=video, name="Sold out", desc="desc",
+                               price="1.00", quantity=0)
+
+    def export(self, **params):
+        response = APIClient().get("/api/products/export/", params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b"".join(response.streaming_content).decode()
+
+    def test_ndjson_export(self):
+        response, content = self.export()
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row["id"] for row in rows], [self.speaker.id, self.tv.id])
+        self.assertEqual(rows[0]["category"], "Audio")
+        self.assertEqual(rows[0]["price"], "60.00")
+        self.assertEqual(rows[1]["image"], "http://testserver/media/products/tv.jpg")
+
+    def test_csv_export(self):
+        response, content = self.export(file_format="csv")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="products.csv"')
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual([row["name"] for row in rows], ["Speaker", "TV"])
+        self.assertEqual(rows[0]["desc"], 'Loud, "bass"')
+
+    def test_export_uses_the_list_filters(self):
+        _, content = self.export(category=self.audio.id)
+        self.assertEqual(len(content.splitlines()), 1)
+
+    def test_unknown_format_is_rejected(self):
+        self.assertEqual(APIClient().get("/api/products/export/", {"file_format": "xml"}).status_code, 400)
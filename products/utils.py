@@ -0,0 +1,155 @@
+from collections import OrderedDict
+
+from django.db import connection
+from django.utils import timezone
+
+from .cache import bump_namespace_version, bump_price_versions, PRODUCTS_NAMESPACE
+from .models import PRICE_BUCKETS, Product, ProductFacetCount
+
+
+def get_facet_counts():
+    '''
+    Returns the number of in stock products per category and per price bucket.
+
+    The counts are read from the incrementally maintained ProductFacetCount table in a single query,
+    so this costs the same however many products are in the catalog.
+
+    Returns:
+        dict: {"categories": [{"id", "name", "count"}], "price": [{"min", "max", "count"}]}
+    '''
+    categories = OrderedDict()
+    price_counts = [0] * len(PRICE_BUCKETS)
+
+    facets = ProductFacetCount.objects.filter(count__gt=0).select_related(
+        "category").only("price_bucket", "count", "category__name").order_by("category__name", "category_id")
+    for facet in facets:
+        category = categories.setdefault(facet.category_id, {
+            "id": facet.category_id, "name": facet.category.name, "count": 0})
+        category["count"] += facet.count
+        # width_bucket() returns 0 below the first boundary, those prices are in no price bucket
+        if facet.price_bucket > 0:
+            price_counts[facet.price_bucket - 1] += facet.count
+
+    price = [
+        {
+            "min": PRICE_BUCKETS[index],
+            "max": PRICE_BUCKETS[index + 1] if index + 1 < len(PRICE_BUCKETS) else None,
+            "count": count,
+        }
+        for index, count in enumerate(price_counts)
+    ]
+    return {"categories": list(categories.values()), "price": price}
+
+
+def bulk_update_products(records, user, chunk_size=1000):
+    '''
+    Applies price and stock changes to many products with set based statements, one per chunk of records:
+
+        UPDATE products_product SET price = ..., quantity = ... FROM (VALUES (id, price, quantity), ...) AS v
+        WHERE products_product.id = v.id AND products_product.seller_id = <user>
+
+    The seller ownership is enforced by the same statement, staff users can update any product.
+    Must be called inside a transaction.
+
+    Args:
+        records (iterable): Validated dicts with an 'id' and an optional 'price' and 'quantity'.
+        user: The user doing the update.
+
+    Returns:
+        tuple: (number of updated products, sorted list of the ids that don't exist or are not owned by the user)
+    '''
+    # The last record wins when the same product is sent twice, the VALUES must not contain duplicate ids
+    changes = {record["id"]: record for record in records}
+    # Sorted ids make concurrent bulk updates touch the rows in the same order
+    ids = sorted(changes)
+
+    table = connection.ops.quote_name(Product._meta.db_table)
+    ownership = "" if user.is_staff else "AND product.seller_id = %s"
+    now = timezone.now()
+    updated_ids = set()
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            values = ", ".join(["(%s::bigint, %s::numeric, %s::integer)"] * len(chunk))
+            params = [now]
+            for product_id in chunk:
+                record = changes[product_id]
+                params += [product_id, record.get("price"), record.get("quantity")]
+            if ownership:
+                params.append(user.id)
+
+            # A missing price or quantity is sent as NULL and keeps the current value
+            cursor.execute(f"""
+                UPDATE {table} AS product
+                SET price = COALESCE(v.price, product.price),
+                    quantity = COALESCE(v.quantity, product.quantity),
+                    updated_at = %s
+                FROM (VALUES {values}) AS v (id, price, quantity)
+                WHERE product.id = v.id {ownership}
+                RETURNING product.id
+            """, params)
+            updated_ids.update(row[0] for row in cursor.fetchall())
+
+    if updated_ids:
+        # queryset level updates don't send the post_save signals that invalidate the catalog cache
+        bump_namespace_version(PRODUCTS_NAMESPACE)
+        bump_price_versions(sorted(
+            product_id for product_id in updated_ids if changes[product_id].get("price") is not None))
+
+    return len(updated_ids), sorted(set(ids) - updated_ids)
+
+
+def decrement_stock(quantities):
+    '''
+    Takes the sold quantities off the stock of many products with one set based statement:
+
+        UPDATE products_product SET quantity = quantity - v.quantity FROM (VALUES (id, quantity), ...) AS v
+        WHERE products_product.id = v.id AND products_product.quantity >= v.quantity
+
+    The decrement reads the latest committed stock of every row, so concurrent sales never lose an update,
+    and the rows are locked in id order first so concurrent sales of overlapping products can't deadlock.
+    A product whose stock is lower than the quantity is left untouched and its id is returned,
+    the caller decides whether to roll back the other decrements. Must be called inside a transaction.
+
+    Args:
+        quantities (dict): {<product_id>: <quantity to take off>}
+
+    Returns:
+        list: Sorted ids of the products that don't exist or don't have enough stock.
+    '''
+    if not quantities:
+        return []
+
+    table = connection.ops.quote_name(Product._meta.db_table)
+    ids = sorted(quantities)
+    values = ", ".join(["(%s::bigint, %s::integer)"] * len(ids))
+    params = []
+    for product_id in ids:
+        params += [product_id, quantities[product_id]]
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH v (id, quantity) AS (VALUES {values}),
+            locked AS (
+                SELECT product.id FROM {table} AS product
+                WHERE product.id IN (SELECT id FROM v)
+                ORDER BY product.id
+                FOR UPDATE
+            ),
+            updated AS (
+                UPDATE {table} AS product
+                SET quantity = product.quantity - v.quantity, updated_at = %s
+                FROM v, locked
+                WHERE product.id = v.id AND locked.id = v.id AND product.quantity >= v.quantity
+                RETURNING product.id
+            )
+            SELECT v.id FROM v WHERE v.id NOT IN (SELECT id FROM updated) ORDER BY v.id
+        """, params + [timezone.now()])
+        failed_ids = [row[0] for row in cursor.fetchall()]
+
+    if len(failed_ids) < len(ids):
+        # queryset level updates don't send the post_save signals that invalidate the catalog cache
+        bump_namespace_version(PRODUCTS_NAMESPACE)
+
+    return failed_ids
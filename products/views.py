@@ -1,37 +1,224 @@
-from .serializers import ProductReadSerializer, ProductWriteSerializer, ProductCategorySerializer
+from .serializers import ProductReadSerializer, ProductWriteSerializer, ProductCategorySerializer, ProductBulkUpdateRowSerializer
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import transaction
+from django.db.models import F
+from decimal import Decimal, InvalidOperation
+from django.utils.translation import gettext_lazy as _
 from .models import Product, ProductCategory
 from rest_framework import permissions
 from .permissions import IsSellerOrAdmin
+from .pagination import ProductKeysetPagination
+from .utils import get_facet_counts, bulk_update_products
+from .importers import ProductImporter, get_import_format, iter_rows
+from .exporters import CONTENT_TYPES, iter_export_rows, stream_export
+from django.http import StreamingHttpResponse
+from .cache import CachedCatalogResponseMixin, get_namespace_version, PRODUCTS_NAMESPACE, CATEGORIES_NAMESPACE
+from users.mixins import ConditionalGetMixin
 
 
-class ProductCategoryViewSet(viewsets.ModelViewSet):
+class ProductCategoryViewSet(CachedCatalogResponseMixin, viewsets.ModelViewSet):
     '''
     This Viewset is for the CRUD operations of ProductCategories
+    The anonymous list and retrieve responses are cached, see products.cache
     '''
+    cache_namespace = CATEGORIES_NAMESPACE
     queryset = ProductCategory.objects.all()
     serializer_class = ProductCategorySerializer
     permission_classes = [permissions.AllowAny]
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ConditionalGetMixin, CachedCatalogResponseMixin, viewsets.ModelViewSet):
     '''
     Viewset for products CRUD operations.
     This is the one which suits the URLs generated from DefaultRouter
+    The anonymous list and retrieve responses are cached, see products.cache
+    and the list and retrieve responses support conditional GET requests, see users.mixins.ConditionalGetMixin
     '''
+    cache_namespace = PRODUCTS_NAMESPACE
     # Returns only those products whose count is greater than 0
     queryset = Product.objects.filter(quantity__gt=0)
 
+    @property
+    def paginator(self):
+        """
+        Clients opt in to keyset pagination of the product list with ?pagination=cursor,
+        otherwise the default PageNumberPagination from the settings is used.
+        The search results are ordered by rank so they always use the default pagination.
+        """
+        if not hasattr(self, "_paginator"):
+            if self.action == "list" and self.request.query_params.get("pagination") == "cursor":
+                self._paginator = ProductKeysetPagination()
+            else:
+                return super().paginator
+        return self._paginator
+
+    def get_queryset(self):
+        """
+        The list and search results can be narrowed with the query parameters:
+        category, seller (ids, comma separated), min_price, max_price and in_stock (true/false, defaults to true).
+        """
+        if self.action in ("list", "search", "export"):
+            queryset = self.filter_products(Product.objects.all())
+        else:
+            queryset = super().get_queryset()
+
+        if self.action in ("list", "retrieve", "search"):
+            queryset = ProductReadSerializer.setup_eager_loading(queryset)
+        return queryset
+
+    def filter_products(self, queryset):
+        params = self.request.query_params
+        errors = {}
+
+        in_stock = params.get("in_stock", "true").lower()
+        if in_stock in ("true", "1"):
+            queryset = queryset.filter(quantity__gt=0)
+        elif in_stock in ("false", "0"):
+            queryset = queryset.filter(quantity__lte=0)
+        else:
+            errors["in_stock"] = _("Must be true or false.")
+
+        for param, lookup in (("category", "category_id__in"), ("seller", "seller_id__in")):
+            if param in params:
+                try:
+                    ids = [int(value) for value in params[param].split(",")]
+                except ValueError:
+                    errors[param] = _("Must be a comma separated list of ids.")
+                else:
+                    queryset = queryset.filter(**{lookup: ids})
+
+        for param, lookup in (("min_price", "price__gte"), ("max_price", "price__lte")):
+            if param in params:
+                try:
+                    price = Decimal(params[param])
+                except InvalidOperation:
+                    price = None
+                if price is None or not price.is_finite():
+                    errors[param] = _("Must be a number.")
+                else:
+                    queryset = queryset.filter(**{lookup: price})
+
+        if errors:
+            raise ValidationError(errors)
+        return queryset
+
+    def get_etag_fingerprint(self, queryset):
+        """
+        The list pages carry the facet counts of the whole catalog, so instead of aggregating the products
+        they are tagged with the catalog cache version which changes on every product or category write.
+        The version is also added to the retrieve fingerprint because the product shows its category name.
+        """
+        version = get_namespace_version(PRODUCTS_NAMESPACE)
+        if self.action == "list":
+            return {"version": version}
+        return {**super().get_etag_fingerprint(queryset), "version": version}
+
+    def get_paginated_response(self, data):
+        """
+        The product list pages also carry the facet counts: the number of in stock products per category and price bucket.
+        """
+        response = super().get_paginated_response(data)
+        if self.action == "list":
+            response.data["facets"] = get_facet_counts()
+        return response
+
     def get_serializer_class(self):
-        if self.action in ("create", "update", "partial_update", "delete"):
+        if self.action in ("create", "update", "partial_update", "destroy"):
             return ProductWriteSerializer
         else:
             return ProductReadSerializer
 
     def get_permissions(self):
-        if self.action == "create":
+        if self.action in ("create", "bulk_import", "bulk_update"):
             return [permissions.IsAuthenticated()]
-        if self.action in ("update", "partial_update", "delete"):
+        if self.action in ("update", "partial_update", "destroy"):
             return [IsSellerOrAdmin()]
         else:
             return [permissions.AllowAny()]
+
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        '''
+        Full text search over the product name and description, ranked by relevance
+        PATH: /api/products/search/?q=<search terms>
+
+        The query goes through the GIN index on Product.search_vector instead of ILIKE scans
+        and supports the web search syntax: "quoted phrases", OR and -excluded words.
+        '''
+        terms = request.query_params.get("q", "").strip()
+        if not terms:
+            raise ValidationError({"q": _("This query parameter is required.")})
+
+        query = SearchQuery(terms, config="english", search_type="websearch")
+        queryset = self.filter_queryset(self.get_queryset()).filter(search_vector=query).annotate(
+            rank=SearchRank(F("search_vector"), query)
+        ).order_by("-rank", "-created_at", "-id")
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
+    @action(detail=False, methods=["post"], url_path="import")
+    def bulk_import(self, request):
+        '''
+        Bulk import of products for the logged in seller
+        PATH: /api/products/import/
+
+        Accepts a multipart upload in the "file" field of a .csv or .ndjson/.jsonl file whose rows have the columns:
+        name, desc, category (name), price and quantity.
+        The file is streamed, rows are validated and inserted in batches and the invalid rows are reported back.
+        '''
+        upload = request.FILES.get("file")
+        if upload is None:
+            raise ValidationError({"file": _("A CSV or NDJSON file is required.")})
+
+        import_format = get_import_format(upload.name)
+        if import_format is None:
+            raise ValidationError({"file": _("Only .csv, .ndjson and .jsonl files are supported.")})
+
+        report = ProductImporter(seller=request.user).run(iter_rows(upload, import_format))
+        return Response(report)
+
+    @action(detail=False, methods=["patch"], url_path="bulk-update")
+    def bulk_update(self, request):
+        '''
+        Bulk price and stock update of the logged in seller's products
+        PATH: /api/products/bulk-update/
+
+        Accepts a list of {"id", "price"?, "quantity"?} records which are applied with set based UPDATE statements.
+        Products that don't exist or belong to another seller are not updated and are returned in "not_updated".
+        '''
+        serializer = ProductBulkUpdateRowSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            updated, not_updated = bulk_update_products(serializer.validated_data, request.user)
+
+        return Response({"updated": updated, "not_updated": not_updated})
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        '''
+        Streams the whole catalog in one response
+        PATH: /api/products/export/?file_format=<ndjson|csv>
+
+        The same filters as the product list can be used. The products are read through a server side cursor
+        and written out row by row, so the memory use doesn't depend on the size of the catalog.
+        '''
+        export_format = request.query_params.get("file_format", "ndjson")
+        if export_format not in CONTENT_TYPES:
+            raise ValidationError({"file_format": _("Must be ndjson or csv.")})
+
+        rows = iter_export_rows(self.get_queryset(), request)
+        response = StreamingHttpResponse(stream_export(rows, export_format),
+                                         content_type=CONTENT_TYPES[export_format])
+        response["Content-Disposition"] = f'attachment; filename="products.{export_format}"'
+        return response
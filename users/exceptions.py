@@ -31,3 +31,15 @@ class TokenBlackListedException(APIException):
     status_code = 401
     default_detail = _("This token is blacklisted.")
     default_code = 'blacklisted-token'
+
+
+class IdempotencyKeyInUseException(APIException):
+    status_code = 409
+    default_detail = _("A request with this Idempotency-Key is still being processed.")
+    default_code = 'idempotency-key-in-use'
+
+
+class IdempotencyKeyMismatchException(APIException):
+    status_code = 422
+    default_detail = _("This Idempotency-Key was already used for another request.")
+    default_code = 'idempotency-key-mismatch'
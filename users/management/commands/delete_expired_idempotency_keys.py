@@ -0,0 +1,44 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    '''
+    Sweeper of the Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL. The expired keys are never replayed,
+    the sweeper keeps the table and its indexes small.
+
+    Usage: python manage.py delete_expired_idempotency_keys --interval 3600
+    '''
+    help = "Delete the expired idempotency keys in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0,
+                            help="Seconds between two sweeps, the command runs forever when given")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of keys deleted per statement")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            deleted = self.delete_expired(options["batch_size"])
+            if deleted or not options["interval"]:
+                self.stdout.write(f"Deleted {deleted} expired idempotency keys in {time.monotonic() - started:.3f}s")
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
+
+    def delete_expired(self, batch_size):
+        expires = timezone.now() - datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+        deleted = 0
+        while True:
+            # Short statements served by the created_at index, each one only locks a batch of rows
+            batch = IdempotencyKey.objects.filter(created_at__lte=expires).order_by("created_at").values("id")[:batch_size]
+            count, _ = IdempotencyKey.objects.filter(id__in=batch).delete()
+            deleted += count
+            if count < batch_size:
+                return deleted
@@ -0,0 +1,165 @@
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+
+from .exceptions import IdempotencyKeyInUseException, IdempotencyKeyMismatchException
+from .models import IdempotencyKey
+
+
+class ConditionalGetMixin:
+    '''
+    Adds ETag and If-None-Match (conditional GET) support to the list and retrieve actions of a view.
+
+    The ETag is computed from a cheap aggregate of the rows behind the response, by default the
+    max(updated_at) and the number of rows, instead of hashing the serialized body.
+    So a request whose If-None-Match matches gets a 304 Not Modified before anything is serialized.
+
+    Views override get_etag_aggregates() when the response also depends on related rows.
+    A 304 skips the object permission checks, so the view's get_queryset() must already
+    restrict the rows to the ones the user is allowed to read.
+    '''
+
+    def get_etag_aggregates(self):
+        '''
+        Returns the aggregate expressions that change whenever the response changes
+        '''
+        return {"updated_at": Max("updated_at"), "count": Count("pk")}
+
+    def get_etag_fingerprint(self, queryset):
+        return queryset.aggregate(**self.get_etag_aggregates())
+
+    def make_etag(self, request, fingerprint):
+        # The same rows are rendered differently for other URLs (filters, pages) and formats (json, browsable api)
+        parts = [request.get_full_path(), request.accepted_renderer.format]
+        parts += [f"{key}={fingerprint[key]}" for key in sorted(fingerprint)]
+        digest = hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()
+        # The tag describes the data not the exact bytes of the body, so it is a weak ETag
+        return "W/" + quote_etag(digest)
+
+    def is_not_modified(self, request, etag):
+        header = request.META.get("HTTP_IF_NONE_MATCH")
+        if not header:
+            return False
+        etags = parse_etags(header)
+        # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+        return "*" in etags or etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in etags]
+
+    def get_conditional_response(self, request, etag, handler, *args, **kwargs):
+        if self.is_not_modified(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response["ETag"] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        etag = self.make_etag(request, self.get_etag_fingerprint(queryset))
+        return self.get_conditional_response(request, etag, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            queryset = self.filter_queryset(self.get_queryset()).filter(
+                **{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+            fingerprint = self.get_etag_fingerprint(queryset)
+        except (TypeError, ValueError, ValidationError):
+            fingerprint = None
+
+        # Malformed lookups, unknown objects and objects outside of the user's queryset go through the normal 404 path
+        if not fingerprint or not fingerprint["count"]:
+            return super().retrieve(request, *args, **kwargs)
+
+        etag = self.make_etag(request, fingerprint)
+        return self.get_conditional_response(request, etag, super().retrieve, *args, **kwargs)
+
+
+class IdempotencyMixin:
+    '''
+    Makes the create and update actions of a view safe to retry with an Idempotency-Key request header.
+
+    The first request with a key runs the action and stores its response. A retry with the same key
+    gets the stored response back, with an Idempotent-Replayed header, after a single (user, key) index lookup
+    and without running the action again. The keys are kept for IDEMPOTENCY_KEY_TTL seconds.
+    Requests without the header are not affected.
+    '''
+    idempotency_header = "Idempotency-Key"
+
+    def create(self, request, *args, **kwargs):
+        return self.get_idempotent_response(request, super().create, *args, **kwargs)
+
+    def update(self, request, *args, **kwargs):
+        return self.get_idempotent_response(request, super().update, *args, **kwargs)
+
+    def get_request_hash(self, request):
+        parts = [request.method.encode("utf-8"), request.get_full_path().encode("utf-8"), request.body]
+        return hashlib.sha256(b"|".join(parts)).hexdigest()
+
+    def get_idempotency_record(self, request, key, expires):
+        return IdempotencyKey.objects.filter(user=request.user, key=key, created_at__gt=expires).only(
+            "request_hash", "status_code", "response_body").first()
+
+    def claim_idempotency_key(self, request, key, request_hash, expires):
+        '''
+        Inserts the key as in progress, or takes over an expired one, with a single INSERT ... ON CONFLICT.
+        The insert is committed right away so that a concurrent retry sees the key in use.
+
+        Returns:
+            bool: False when another request holds the key.
+        '''
+        table = connection.ops.quote_name(IdempotencyKey._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {table} (user_id, key, request_hash, created_at) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id, key) DO UPDATE
+                SET request_hash = EXCLUDED.request_hash, status_code = NULL, response_body = NULL,
+                    created_at = EXCLUDED.created_at
+                WHERE {table}.created_at <= %s
+                RETURNING id
+            """, [request.user.id, key, request_hash, timezone.now(), expires])
+            return cursor.fetchone() is not None
+
+    def replay(self, record, request_hash):
+        if record.status_code is None:
+            raise IdempotencyKeyInUseException()
+        if record.request_hash != request_hash:
+            raise IdempotencyKeyMismatchException()
+        return Response(record.response_body, status=record.status_code, headers={"Idempotent-Replayed": "true"})
+
+    def get_idempotent_response(self, request, handler, *args, **kwargs):
+        key = request.headers.get(self.idempotency_header)
+        if key is None:
+            return handler(request, *args, **kwargs)
+        if not key or len(key) > 255:
+            raise exceptions.ValidationError({self.idempotency_header: _("Must be 1 to 255 characters long.")})
+
+        request_hash = self.get_request_hash(request)
+        expires = timezone.now() - datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+        record = self.get_idempotency_record(request, key, expires)
+        if record is None and not self.claim_idempotency_key(request, key, request_hash, expires):
+            # Another request took the key between the lookup and the insert
+            record = self.get_idempotency_record(request, key, expires)
+        if record is not None:
+            return self.replay(record, request_hash)
+
+        try:
+            # The response is stored in the same transaction as the changes of the action
+            with transaction.atomic():
+                response = handler(request, *args, **kwargs)
+                IdempotencyKey.objects.filter(user=request.user, key=key).update(
+                    status_code=response.status_code, response_body=response.data)
+        except Exception:
+            # A failed request can be retried with the same key
+            IdempotencyKey.objects.filter(user=request.user, key=key).delete()
+            raise
+        return response
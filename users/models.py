@@ -13,6 +13,7 @@ import datetime  # For converting the time from settings inorder to check the to
 from django.utils import timezone
 # when verification code is not verified
 from rest_framework.exceptions import NotAcceptable
+from rest_framework.utils.encoders import JSONEncoder
 from django_countries.fields import CountryField
 
 # This is used for django signals
@@ -201,6 +202,33 @@ class Address(models.Model):
         return self.user.get_full_name()
 
 
+# Model that remembers the response of a write request sent with an Idempotency-Key header (see users.mixins.IdempotencyMixin)
+# so that a retried request gets the same response back instead of being applied twice
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(
+        CustomUser, related_name="idempotency_keys", on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    # Hash of the method, path and body of the request, a key can't be reused for another request
+    request_hash = models.CharField(max_length=64)
+    # Both stay empty while the first request is still running
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True)
+    response_body = models.JSONField(blank=True, null=True, encoder=JSONEncoder)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # The replay lookup is a single (user, key) index lookup
+            models.UniqueConstraint(fields=("user", "key"), name="unique_user_idempotency_key"),
+        ]
+        indexes = [
+            models.Index(fields=("created_at",), name="idempotency_key_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.key} of {self.user.get_full_name()}"
+
+
 # ********************** THIS SECTION CONTAINS THE SIGNALS CODE **********************
 # Here is where we write django signals needed when models are created
 # Now i need to create a Profile object, after a user gets saved to the DB
@@ -9,7 +9,7 @@ class IsUserProfileOwner(BasePermission):
     def has_object_permission(self, request, view, obj):
         # the obj we get in here is the obj returned by get_object() from the Profile APIView
         # so here the obj is a Profile instance
-        return obj.user == request.user or request.user.is_staff
+        return obj.user_id == request.user.id or request.user.is_staff
 
 
 class IsUserAddressOwner(BasePermission):
@@ -22,4 +22,4 @@ class IsUserAddressOwner(BasePermission):
         return request.user.is_authenticated is True
 
     def has_object_permission(self, request, view, obj):
-        return obj.user == request.user or request.user.is_staff
+        return obj.user_id == request.user.id or request.user.is_staff
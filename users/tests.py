@@ -1,3 +1,150 @@
-from django.test import TestCase
+import datetime
+import io
+import threading
+import time
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TransactionTestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from cart.models import CartItem
+from orders.models import Order, OrderItem
+from products.models import Product, ProductCategory
+from .models import IdempotencyKey
+from .utils import get_insufficient_products
+
+User = get_user_model()
+
+
+class StockCheckConcurrencyTests(TransactionTestCase):
+    '''
+    Tests for the locking stock check with parallel checkouts, each thread has its own database connection
+    '''
+
+    def setUp(self):
+        seller = User.objects.create_user(email="seller@example.com", username="seller", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        self.products = Product.objects.bulk_create([
+            Product(seller=seller, category=category, name=f"Product {i}", desc="desc", price="1.00", quantity=5)
+            for i in range(2)
+        ])
+
+    def checkout(self, lines, pause=0):
+        '''
+        Checks the stock of the lines with the rows locked, then takes the stock like a paid order does
+        '''
+        with transaction.atomic():
+            if get_insufficient_products(lines, lock=True):
+                return False
+            time.sleep(pause)
+            for line in lines:
+                Product.objects.filter(pk=line.product_id).update(quantity=F("quantity") - line.quantity)
+            return True
+
+    def run_in_threads(self, targets):
+        barrier = threading.Barrier(len(targets))
+        results, errors = [], []
+
+        def run(target):
+            try:
+                barrier.wait()
+                results.append(target())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_parallel_checkouts_never_oversell(self):
+        product = self.products[0]
+        lines = [OrderItem(product_id=product.id, quantity=2)]
+        results, errors = self.run_in_threads([lambda: self.checkout(lines, pause=0.01)] * 8)
+
+        self.assertEqual(errors, [])
+        # 5 in stock: two checkouts of 2 succeed, the others see the stock left by the committed ones
+        self.assertEqual(results.count(True), 2)
+        product.refresh_from_db()
+        self.assertEqual(product.quantity, 1)
+
+    def test_opposite_line_orders_do_not_deadlock(self):
+        first, second = self.products
+        forward = [OrderItem(product_id=first.id, quantity=1), OrderItem(product_id=second.id, quantity=1)]
+        backward = list(reversed(forward))
+        results, errors = self.run_in_threads(
+            [lambda: self.checkout(forward, pause=0.05), lambda: self.checkout(backward, pause=0.05)] * 2)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual(list(Product.objects.filter(pk__in=[first.id, second.id]).values_list("quantity", flat=True)),
+                         [1, 1])
+
+    def test_lines_are_checked_in_one_query(self):
+        lines = [OrderItem(product_id=product.id, quantity=3) for product in self.products]
+        lines.append(OrderItem(product_id=self.products[0].id, quantity=3))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_insufficient_products(lines), ["Product 0"])
+
+
+class IdempotencyKeyTests(TransactionTestCase):
+    '''
+    Tests for simultaneous requests with the same Idempotency-Key, each thread has its own database connection
+    '''
+
+    def setUp(self):
+        seller = User.objects.create_user(email="seller@example.com", username="seller", password="password")
+        self.buyer = User.objects.create_user(email="buyer@example.com", username="buyer", password="password")
+        category = ProductCategory.objects.create(name="Audio")
+        product = Product.objects.create(seller=seller, category=category, name="Speaker", desc="desc",
+                                         price="1.00", quantity=5)
+        CartItem.objects.create(cart=self.buyer.cart, product=product, quantity=1)
+
+    def test_simultaneous_retries_run_the_request_once(self):
+        barrier = threading.Barrier(6)
+        responses, errors = [], []
+
+        def create_order():
+            client = APIClient()
+            client.force_authenticate(self.buyer)
+            try:
+                barrier.wait()
+                responses.append(client.post("/api/orders/", HTTP_IDEMPOTENCY_KEY="order-1"))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=create_order) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        first = [response for response in responses
+                 if response.status_code == 201 and "Idempotent-Replayed" not in response]
+        self.assertEqual(len(first), 1)
+        # The others either saw the key in use or got the stored response
+        for response in responses:
+            self.assertIn(response.status_code, (201, 409))
+        self.assertEqual(Order.objects.filter(buyer=self.buyer).count(), 1)
+
+    def test_sweeper_deletes_the_expired_keys(self):
+        IdempotencyKey.objects.bulk_create([
+            IdempotencyKey(user=self.buyer, key=f"key-{i}", request_hash="", status_code=201, response_body={})
+            for i in range(5)
+        ])
+        IdempotencyKey.objects.filter(key__in=["key-0", "key-1", "key-2"]).update(
+            created_at=timezone.now() - datetime.timedelta(days=2))
+
+        call_command("delete_expired_idempotency_keys", batch_size=2, stdout=io.StringIO())
+        self.assertEqual(sorted(IdempotencyKey.objects.values_list("key", flat=True)), ["key-3", "key-4"])
@@ -1,6 +1,9 @@
 from .models import PhoneNumber
 from django.contrib.auth import get_user_model
+from collections import defaultdict
 from collections.abc import Iterable
+from cart.reservations import with_available_stock
+from products.models import Product
 
 User = get_user_model()
 
@@ -17,13 +20,20 @@ def send_or_resend_sms(phone_number):
 
 
 # Function to get the insufficient products name
-def get_insufficient_products(items):
+def get_insufficient_products(items, lock=False, exclude_cart=None):
     '''
     Returns a list of product names where the ordered/cart quantity 
     is greater than the available product stock.
 
+    All the lines are checked with one query that reads the stock of their products minus the live holds of the carts,
+    the products are never loaded item by item.
+
     Args:
-        items (iterable): An iterable of cart/order items with 'product' and 'quantity' attributes.
+        items (iterable): An iterable of cart/order items with 'product_id' and 'quantity' attributes.
+        lock (bool): Locks the product rows with SELECT ... FOR UPDATE until the end of the transaction,
+                     so that the stock can't change between the check and the caller's writes.
+                     The rows are always locked in primary key order so concurrent checkouts can't deadlock.
+        exclude_cart: The cart (or its id) whose own holds don't count against the items.
 
     Returns:
         list: List of product names with insufficient stock.
@@ -31,6 +41,20 @@ def get_insufficient_products(items):
     if not isinstance(items, Iterable):
         raise ValueError(
             "Expected an iterable of cart/order items, but got a non-iterable object.")
+
+    # The same product can be on several lines
+    quantities = defaultdict(int)
+    for item in items:
+        quantities[item.product_id] += item.quantity
+    if not quantities:
+        return []
+
+    products = with_available_stock(
+        Product.objects.filter(id__in=quantities).order_by("pk"), exclude_cart=exclude_cart)
+    if lock:
+        products = products.select_for_update(of=("self",))
+
     return [
-        item.product.name for item in items if item.quantity > item.product.quantity
+        name for product_id, name, available in products.values_list("id", "name", "available_quantity")
+        if quantities[product_id] > available
     ]